@@ -0,0 +1,70 @@
+import os
+import logging
+import torch
+
+from data_aug.data.autotune import autotune, format_table
+from data_aug.models import get_net
+from data_aug.datasets import get_cifar10, get_mnist, get_tiny_imagenet
+
+
+def main(
+    script="train_lik",
+    data_dir=None,
+    dataset="cifar10",
+    augment=True,
+    n_aug=1,
+    dirty_lik=True,
+    batch_size=128,
+    device=0,
+    n_batches=10,
+):
+    """Tune the train loader of script for the given arguments of its main.
+
+    Run under the same CPU affinity as the training runs. The workload tuples
+    below must match the ones built in each script.
+    """
+    if data_dir is None and os.environ.get("DATADIR") is not None:
+        data_dir = os.environ.get("DATADIR")
+
+    device = f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+
+    if script == "train_lik":
+        workload = ("train_lik", dataset, augment, dirty_lik, batch_size)
+        get_data = dict(
+            cifar10=get_cifar10, mnist=get_mnist, tiny_imagenet=get_tiny_imagenet
+        )[dataset.replace("-", "_")]
+        train_data, _ = get_data(root=data_dir, augment=bool(augment))
+    elif script == "train_aug_lik":
+        workload = ("train_aug_lik", dataset, n_aug, dirty_lik, batch_size)
+        get_data = dict(cifar10=get_cifar10, tiny_imagenet=get_tiny_imagenet)[
+            dataset.replace("-", "_")
+        ]
+        train_data, _ = get_data(root=data_dir, n_aug=n_aug, return_orig=True)
+    elif script == "train_cprior":
+        workload = ("train_cprior", dataset, dirty_lik, batch_size)
+        get_data = dict(cifar10=get_cifar10, tiny_imagenet=get_tiny_imagenet)[
+            dataset.replace("-", "_")
+        ]
+        train_data, _ = get_data(root=data_dir)
+    else:
+        raise NotImplementedError
+
+    config, table = autotune(
+        train_data,
+        get_net(dirty_lik, train_data.total_classes),
+        workload,
+        batch_size=batch_size,
+        device=device,
+        n_batches=n_batches,
+    )
+
+    print(format_table(table))
+    logging.info(f"Best configuration for {workload}: {config}")
+
+
+if __name__ == "__main__":
+    import fire
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    fire.Fire(main)
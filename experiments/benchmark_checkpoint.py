@@ -0,0 +1,143 @@
+import time
+import logging
+import torch
+import torch.nn.functional as F
+
+from data_aug.models import ResNet18, ResNet18FRN, ResNet18Fixup, checkpoint_stages, checkpoint_to_budget
+from data_aug.models.checkpoint import stages
+
+
+MODELS = {
+    "resnet18": ResNet18,
+    "resnet18_frn": ResNet18FRN,
+    "resnet18_fixup": ResNet18Fixup,
+}
+
+
+class SavedBytes:
+    """Bytes of distinct tensors saved for backward while active."""
+
+    def __init__(self):
+        self.total = 0
+        self._seen = set()
+
+    def _pack(self, t):
+        key = (t.untyped_storage().data_ptr(), t.storage_offset(), t.shape)
+        if key not in self._seen:
+            self._seen.add(key)
+            self.total += t.numel() * t.element_size()
+        return t
+
+    def __enter__(self):
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda t: t)
+        self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self._hooks.__exit__(*args)
+        self._seen.clear()
+
+
+def aug_step(net, X, X_aug, Y):
+    ## Same forward structure as the augmented likelihood in train_aug_lik.py.
+    net.zero_grad()
+    f_hat = net(X)
+    f_hat_aug = net(X_aug.view(-1, *X.shape[-3:])).view(*X_aug.shape[:2], -1)
+    loss = F.cross_entropy(f_hat, Y) + F.cross_entropy(
+        f_hat_aug.log_softmax(dim=-1).mean(dim=1), Y
+    )
+    loss.backward()
+
+
+def measure(net, X, X_aug, Y, device, n_steps=3, warmup=1):
+    for _ in range(warmup):
+        aug_step(net, X, X_aug, Y)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        with SavedBytes() as saved:
+            aug_step(net, X, X_aug, Y)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    step_time = (time.perf_counter() - start) / n_steps
+
+    ## On CPU there is no allocator peak to read, so report the activations
+    ## kept for backward, which is what checkpointing reduces.
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device) - base
+    else:
+        peak = saved.total
+
+    return step_time, peak
+
+
+def main(
+    model="resnet18",
+    n_augs=(1, 4, 8, 16),
+    batch_size=32,
+    budget=None,
+    device=0,
+    n_steps=3,
+    warmup=1,
+):
+    """Peak memory and step time of the augmented forward with and without
+    per-stage activation checkpointing.
+
+    budget (GiB) adds a row per n_aug checkpointing only as many stages as
+    checkpoint_to_budget needs.
+    """
+    n_augs = [n_augs] if isinstance(n_augs, int) else list(n_augs)
+    device = torch.device(
+        f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+    )
+
+    torch.manual_seed(0)
+
+    rows = []
+    for n_aug in n_augs:
+        X = torch.randn(batch_size, 3, 32, 32, device=device)
+        X_aug = torch.randn(batch_size, n_aug, 3, 32, 32, device=device)
+        Y = torch.randint(10, (batch_size,), device=device)
+
+        modes = ["none", "all"] + (["budget"] if budget is not None else [])
+        for mode in modes:
+            net = MODELS[model](num_classes=10).to(device).train()
+            if mode == "budget":
+                names = checkpoint_to_budget(
+                    net, X[:8], batch_size * (1 + n_aug), budget * 2**30
+                )
+            else:
+                names = stages(net) if mode == "all" else []
+                checkpoint_stages(net, names)
+
+            step_time, peak = measure(
+                net, X, X_aug, Y, device, n_steps=n_steps, warmup=warmup
+            )
+            rows.append((n_aug, mode, ",".join(names) or "-", step_time, peak))
+            logging.info(f"n_aug={n_aug} ({mode}): {1e3 * step_time:.1f} ms/step")
+
+    baseline = {n_aug: (t, m) for n_aug, mode, _, t, m in rows if mode == "none"}
+
+    print(
+        f"{'n_aug':>5} {'mode':<8} {'stages':<28} {'ms/step':>9} {'slowdown':>9} "
+        f"{'MiB':>9} {'saved':>6}"
+    )
+    for n_aug, mode, names, step_time, peak in rows:
+        t, m = baseline[n_aug]
+        print(
+            f"{n_aug:>5} {mode:<8} {names:<28} {1e3 * step_time:>9.1f} "
+            f"{step_time / t:>9.2f} {peak / 2**20:>9.1f} {1 - peak / m:>6.0%}"
+        )
+
+
+if __name__ == "__main__":
+    import fire
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    fire.Fire(main)
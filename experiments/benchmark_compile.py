@@ -0,0 +1,85 @@
+import time
+import logging
+import torch
+import torch.nn.functional as F
+from torch.optim import SGD
+
+from data_aug.models import ResNet18, ResNet18FRN, ResNet18Fixup, LeNet, prepare_model
+from data_aug.models.mlp import MLP
+
+
+MODELS = {
+    "resnet18": (ResNet18, (3, 32, 32)),
+    "resnet18_frn": (ResNet18FRN, (3, 32, 32)),
+    "resnet18_fixup": (ResNet18Fixup, (3, 32, 32)),
+    "lenet": (LeNet, (1, 28, 28)),
+    "mlp": (MLP, (1, 28, 28)),
+}
+
+MODES = {
+    "eager": dict(),
+    "channels_last": dict(channels_last=True),
+    "compiled": dict(compile=True),
+    "compiled+channels_last": dict(compile=True, channels_last=True),
+}
+
+
+def time_steps(net, X, Y, n_steps=10, warmup=3):
+    sgd = SGD(net.parameters(), lr=1e-3, momentum=0.9)
+
+    def step():
+        sgd.zero_grad()
+        loss = F.cross_entropy(net(X), Y)
+        loss.backward()
+        sgd.step()
+
+    ## Warm-up also triggers compilation, which is reported separately.
+    start = time.perf_counter()
+    for _ in range(warmup):
+        step()
+    warmup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    return (time.perf_counter() - start) / n_steps, warmup_time
+
+
+def main(models=None, modes=None, batch_size=32, n_steps=10, warmup=3, cache_dir=None):
+    """Per-model train step time on CPU for eager vs channels-last vs compiled."""
+    models = models.split(",") if isinstance(models, str) else models or list(MODELS)
+    modes = modes.split(",") if isinstance(modes, str) else modes or list(MODES)
+
+    torch.manual_seed(0)
+
+    rows = []
+    for name in models:
+        model_fn, shape = MODELS[name]
+        X, Y = torch.randn(batch_size, *shape), torch.randint(10, (batch_size,))
+        for mode in modes:
+            net = prepare_model(
+                model_fn(num_classes=10).train(), cache_dir=cache_dir, **MODES[mode]
+            )
+            step_time, warmup_time = time_steps(
+                net, X, Y, n_steps=n_steps, warmup=warmup
+            )
+            rows.append((name, mode, step_time, warmup_time))
+            logging.info(f"{name} ({mode}): {1e3 * step_time:.1f} ms/step")
+
+    eager = {name: t for name, mode, t, _ in rows if mode == "eager"}
+
+    print(f"{'model':<16} {'mode':<24} {'ms/step':>9} {'speedup':>8} {'warmup s':>9}")
+    for name, mode, step_time, warmup_time in rows:
+        speedup = eager[name] / step_time if name in eager else float("nan")
+        print(
+            f"{name:<16} {mode:<24} {1e3 * step_time:>9.1f} {speedup:>8.2f} "
+            f"{warmup_time:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    import fire
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    fire.Fire(main)
@@ -0,0 +1,133 @@
+import json
+import time
+import logging
+import threading
+import http.client
+import numpy as np
+import torch
+
+from data_aug.models import ResNet18, ResNet18FRN, ResNet18Fixup, LeNet, Ensemble, export_inference, load_ensemble
+from data_aug.serve import MicroBatcher, make_server, predictive_fn
+
+
+MODELS = {
+    "resnet18": (ResNet18, (3, 32, 32)),
+    "resnet18_frn": (ResNet18FRN, (3, 32, 32)),
+    "resnet18_fixup": (ResNet18Fixup, (3, 32, 32)),
+    "lenet": (LeNet, (1, 28, 28)),
+}
+
+
+def client(port, body, n_requests, latencies):
+    """Sends n_requests requests, one at a time, on one connection."""
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        conn.request("POST", "/predict", body, {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        assert response.status == 200, response.status
+    conn.close()
+
+
+def load_test(ensemble, input_shape, window, concurrency, n_requests, max_batch_size, device):
+    """Throughput and latencies of concurrency clients each sending
+    n_requests single-input requests to a server with a batch window of
+    window seconds."""
+    body = json.dumps({"inputs": torch.randn(1, *input_shape).tolist()})
+
+    with MicroBatcher(predictive_fn(ensemble, device=device), max_batch_size=max_batch_size, max_delay=window) as batcher:
+        server = make_server(batcher, input_shape, port=0)
+        port = server.server_address[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        client(port, body, 2, [])
+        batcher.stats.update(batches=0, inputs=0, compute=0.0)
+
+        latencies = []
+        clients = [
+            threading.Thread(target=client, args=(port, body, n_requests, latencies))
+            for _ in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.perf_counter() - start
+
+        server.shutdown()
+        server.server_close()
+        stats = dict(batcher.stats)
+
+    latencies = np.array(latencies)
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": np.percentile(latencies, 50),
+        "p99": np.percentile(latencies, 99),
+        "batch_size": stats["inputs"] / max(stats["batches"], 1),
+    }
+
+
+def main(
+    model="resnet18",
+    samples_dir=None,
+    n_samples=(1, 5, 10),
+    windows_ms=(0, 2, 5, 10),
+    concurrency=32,
+    n_requests=20,
+    max_batch_size=64,
+    device=0,
+):
+    """Throughput and p50/p99 latency of the inference server of
+    experiments/serve_ensemble.py under concurrency clients sending
+    single-input requests back to back, for each batch window and number of
+    samples.
+
+    Without samples_dir, the samples are randomly initialized networks,
+    which cost the same to evaluate.
+    """
+    n_samples = [n_samples] if isinstance(n_samples, int) else list(n_samples)
+    windows_ms = [windows_ms] if isinstance(windows_ms, (int, float)) else list(windows_ms)
+    device = torch.device(
+        f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+    )
+
+    torch.manual_seed(0)
+
+    net_fn, input_shape = MODELS[model]
+    if samples_dir is not None:
+        members = list(load_ensemble(net_fn(num_classes=10).to(device).eval(), samples_dir).members)
+    else:
+        members = [
+            export_inference(net_fn(num_classes=10).to(device).eval())
+            for _ in range(max(n_samples))
+        ]
+
+    rows = []
+    for S in n_samples:
+        ensemble = Ensemble(members[:S]).eval()
+        for window in windows_ms:
+            metrics = load_test(
+                ensemble, input_shape, window / 1e3, concurrency, n_requests, max_batch_size, device
+            )
+            rows.append((len(ensemble.members), window, metrics))
+            logging.info(f"S={S} window={window}ms: {metrics['throughput']:.1f} req/s")
+
+    print(
+        f"{'S':>3} {'window':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'batch':>6}"
+    )
+    for S, window, m in rows:
+        print(
+            f"{S:>3} {window:>7} {m['throughput']:>9.1f} {1e3 * m['p50']:>8.1f} "
+            f"{1e3 * m['p99']:>8.1f} {m['batch_size']:>6.1f}"
+        )
+
+
+if __name__ == "__main__":
+    import fire
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    fire.Fire(main)
@@ -0,0 +1,183 @@
+import os
+import time
+import logging
+from pathlib import Path
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.optim import SGD
+from torch.optim.lr_scheduler import CosineAnnealingLR
+from torch.utils.data import DataLoader
+from tqdm.auto import tqdm
+
+from data_aug.utils import set_seeds
+from data_aug.data import eval_loader
+from data_aug.models import get_net, export_inference, load_ensemble, predictive
+from data_aug.datasets import get_cifar10, get_mnist
+
+from bnn_priors.third_party.calibration_error import ece
+
+
+class Student(nn.Module):
+  '''A network with num_classes logits and, with epistemic, one more output
+  predicting the ensemble's mutual information (through a softplus).'''
+  def __init__(self, net_fn, num_classes, epistemic=False):
+    super().__init__()
+
+    self.num_classes = num_classes
+    self.epistemic = epistemic
+    self.net = net_fn(num_classes + int(epistemic))
+
+  def forward(self, X):
+    return self.split(self.net(X))
+
+  def split(self, out):
+    '''Outputs of net -> logits and predicted mutual information (or None).'''
+    if not self.epistemic:
+      return out, None
+    return out[:, :self.num_classes], F.softplus(out[:, self.num_classes])
+
+
+def distill(student, ensemble, train_loader, device=None, lr=1e-2, momentum=.9, epochs=1, epistemic_weight=1.):
+  '''Fit the student to the ensemble's posterior predictive on the (augmented)
+  training inputs, teacher predictions computed on the fly.'''
+  sgd = SGD(student.parameters(), lr=lr, momentum=momentum)
+  sgd_scheduler = CosineAnnealingLR(sgd, T_max=epochs)
+
+  for e in tqdm(range(epochs)):
+    student.train()
+    for i, (X, _) in tqdm(enumerate(train_loader), leave=False):
+      X = X.to(device)
+
+      with torch.no_grad():
+        teacher = predictive(ensemble(X))
+
+      sgd.zero_grad()
+
+      logits, mutual_info = student(X)
+      ## Cross entropy with the predictive distribution, i.e. KL up to a constant.
+      loss = -(teacher['probs'] * logits.log_softmax(dim=-1)).sum(dim=-1).mean()
+      if mutual_info is not None:
+        loss = loss + epistemic_weight * F.mse_loss(mutual_info, teacher['mutual_info'])
+
+      loss.backward()
+
+      sgd.step()
+
+    sgd_scheduler.step()
+
+    logging.info(f'Distillation (Epoch {e}): {loss.detach().item():.4f}')
+
+
+@torch.no_grad()
+def evaluate(model_fn, data_loader, device=None):
+  '''Accuracy, NLL and ECE of the probabilities from model_fn, its predictions
+  and wall time.'''
+  all_probs, all_Y, extra = [], [], []
+
+  start = time.perf_counter()
+  for X, Y in tqdm(data_loader, leave=False):
+    probs, _extra = model_fn(X.to(device))
+    all_probs.append(probs)
+    all_Y.append(Y.to(device))
+    if _extra is not None:
+      extra.append(_extra)
+  elapsed = time.perf_counter() - start
+
+  probs, Y = torch.cat(all_probs), torch.cat(all_Y)
+
+  return {
+    'acc': (probs.argmax(dim=-1) == Y).float().mean().item(),
+    'nll': -probs.clamp(min=1e-12).log().gather(-1, Y.unsqueeze(-1)).mean().item(),
+    'ece': ece(Y.cpu().numpy(), probs.cpu().numpy(), num_bins=30),
+    'time': elapsed,
+  }, probs, torch.cat(extra) if extra else None
+
+
+def main(seed=None, device=0, data_dir=None, samples_dir=None, out_path=None, dataset='cifar10', dirty_lik=True,
+         student=None, epistemic=False, epistemic_weight=1., batch_size=128, eval_batch_size=1024,
+         epochs=50, lr=1e-2, momentum=.9, eval_cache=None):
+  '''
+  Distill the samples under samples_dir (architecture dirty_lik) into one
+  student network (architecture student, default the same), trained on the
+  augmented training set, saved to out_path (default: student.pt next to
+  samples_dir). Reports accuracy, NLL and ECE of ensemble and student on
+  the test set, their agreement and the student's speedup, with both
+  evaluated as exported inference graphs (see export_inference).
+
+  out_path holds the state dict of the student's network alone, which
+  load_sample loads into get_net(student, num_classes), or with epistemic
+  get_net(student, num_classes + 1), whose last output is the mutual
+  information before the softplus.
+  '''
+  if data_dir is None and os.environ.get('DATADIR') is not None:
+      data_dir = os.environ.get('DATADIR')
+
+  samples_dir = Path(samples_dir)
+  assert samples_dir.is_dir()
+  out_path = Path(out_path or samples_dir.parent / 'student.pt')
+
+  set_seeds(seed)
+  device = f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+
+  get_data = dict(cifar10=get_cifar10, mnist=get_mnist)[dataset]
+  train_data, test_data = get_data(root=data_dir, augment=True)
+  num_classes = train_data.total_classes
+
+  train_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True, num_workers=2)
+  if eval_cache:
+    test_loader = eval_loader(test_data, f'{dataset}-test', eval_cache, batch_size=eval_batch_size, device=device)
+  else:
+    test_loader = DataLoader(test_data, batch_size=eval_batch_size, num_workers=2)
+
+  ensemble = load_ensemble(get_net(dirty_lik, num_classes).to(device), samples_dir)
+  logging.info(f'Distilling {len(ensemble.members)} samples.')
+
+  net_fn = lambda n: get_net(dirty_lik if student is None else student, n)
+  model = Student(net_fn, num_classes, epistemic=epistemic).to(device)
+
+  distill(model, ensemble, train_loader, device=device, lr=lr, momentum=momentum, epochs=epochs,
+          epistemic_weight=epistemic_weight)
+  torch.save(model.net.state_dict(), out_path)
+
+  def ensemble_fn(X):
+    pred = predictive(ensemble(X))
+    return pred['probs'], pred['mutual_info']
+
+  ## Timed like the ensemble members, which load_ensemble exports.
+  model.eval()
+  try:
+    student_net = export_inference(model.net)
+  except Exception as e:
+    logging.warning(f'Could not export the student, evaluating eagerly: {e}')
+    student_net = model.net
+
+  def student_fn(X):
+    logits, mutual_info = model.split(student_net(X))
+    return logits.softmax(dim=-1), mutual_info
+
+  ens_metrics, ens_probs, ens_mi = evaluate(ensemble_fn, test_loader, device=device)
+  student_metrics, student_probs, student_mi = evaluate(student_fn, test_loader, device=device)
+
+  metrics = {
+    **{ f'ensemble/{k}': v for k, v in ens_metrics.items() },
+    **{ f'student/{k}': v for k, v in student_metrics.items() },
+    'student/agreement': (student_probs.argmax(dim=-1) == ens_probs.argmax(dim=-1)).float().mean().item(),
+    'student/kl': (ens_probs * (ens_probs.clamp(min=1e-12).log()
+                                - student_probs.clamp(min=1e-12).log())).sum(dim=-1).mean().item(),
+    'student/speedup': ens_metrics['time'] / student_metrics['time'],
+  }
+  if student_mi is not None:
+    metrics['student/mutual_info_corr'] = torch.corrcoef(torch.stack([student_mi, ens_mi]))[0, 1].item()
+
+  logging.info(metrics)
+
+  return metrics
+
+
+if __name__ == '__main__':
+  import fire
+
+  logging.getLogger().setLevel(logging.INFO)
+
+  fire.Fire(main)
@@ -0,0 +1,67 @@
+import os
+import logging
+from pathlib import Path
+from torchvision.datasets import CIFAR10, MNIST
+
+from data_aug.data import write_aug_bank
+from data_aug.data import transforms as batch_transforms
+from data_aug.datasets import WrapperDataset
+
+
+def get_transform(augment, size):
+    if augment == "std":
+        return batch_transforms.Compose(
+            [
+                batch_transforms.RandomCrop(size, padding=4),
+                batch_transforms.RandomHorizontalFlip(),
+            ]
+        )
+    elif augment == "flips":
+        return batch_transforms.RandomHorizontalFlip()
+    elif augment == "vflips":
+        return batch_transforms.RandomVerticalFlip()
+    elif augment == "crops":
+        return batch_transforms.RandomCrop(size, padding=4)
+    else:
+        raise NotImplementedError
+
+
+def main(
+    data_dir=None,
+    out_dir=None,
+    dataset="cifar10",
+    augment="std",
+    n_aug=10,
+    batch_size=1024,
+    seed=0,
+):
+    if data_dir is None and os.environ.get("DATADIR") is not None:
+        data_dir = os.environ.get("DATADIR")
+
+    if dataset == "cifar10":
+        train_data = CIFAR10(root=data_dir, train=True, download=True)
+        size = 32
+    elif dataset == "mnist":
+        train_data = MNIST(root=data_dir, train=True, download=True)
+        size = 28
+    else:
+        raise NotImplementedError
+
+    out_dir = write_aug_bank(
+        WrapperDataset(train_data),
+        out_dir or Path(data_dir) / f"{dataset}-{augment}-x{n_aug}-s{seed}",
+        get_transform(augment, size),
+        n_aug=n_aug,
+        batch_size=batch_size,
+        seed=seed,
+    )
+
+    logging.info(f"Wrote {len(train_data) * n_aug} augmentations to {out_dir}")
+
+
+if __name__ == "__main__":
+    import fire
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    fire.Fire(main)
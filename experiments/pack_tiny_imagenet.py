@@ -0,0 +1,21 @@
+import os
+import logging
+
+from data_aug.data.tiny_imagenet import pack_tiny_imagenet
+
+
+def main(data_dir=None, num_workers=8):
+    if data_dir is None and os.environ.get("DATADIR") is not None:
+        data_dir = os.environ.get("DATADIR")
+
+    sizes = pack_tiny_imagenet(data_dir, num_workers=num_workers)
+
+    logging.info(f"Packed Tiny ImageNet under {data_dir}: {sizes}")
+
+
+if __name__ == "__main__":
+    import fire
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    fire.Fire(main)
@@ -0,0 +1,151 @@
+import os
+import json
+import shutil
+import logging
+from pathlib import Path
+import torch
+from torch.utils.data import DataLoader
+from tqdm.auto import tqdm
+
+from data_aug.utils import set_seeds
+from data_aug.data import eval_loader
+from data_aug.models import get_net, load_sample, predictive, select_samples
+from data_aug.datasets import get_cifar10, get_mnist
+
+from bnn_priors.third_party.calibration_error import ece
+
+
+@torch.no_grad()
+def bank_logits(net, data_loader, samples_dir, cache_path, export=True, device=None):
+  '''
+  Logits [S, N, C] of all samples under samples_dir on data_loader, and the
+  labels. Stored in cache_path and reused while the sample bank is unchanged.
+  '''
+  samples_dir = Path(samples_dir)
+  sample_paths = sorted(samples_dir.rglob('*.pt'))
+  names = [str(p.relative_to(samples_dir)) for p in sample_paths]
+  mtime = max(p.stat().st_mtime for p in sample_paths)
+
+  cache_path = Path(cache_path)
+  if cache_path.is_file():
+    cached = torch.load(cache_path)
+    if cached['names'] == names and cached['mtime'] == mtime:
+      return names, cached['logits'], cached['Y']
+
+  ens_logits = []
+  for sample_path in tqdm(sample_paths, leave=False):
+    model = load_sample(net, sample_path, export=export)
+
+    all_logits, all_Y = [], []
+    for X, Y in tqdm(data_loader, leave=False):
+      all_logits.append(model(X.to(device)).cpu())
+      all_Y.append(Y.cpu())
+    ens_logits.append(torch.cat(all_logits))
+  logits, Y = torch.stack(ens_logits), torch.cat(all_Y)
+
+  cache_path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+  torch.save({ 'names': names, 'mtime': mtime, 'logits': logits, 'Y': Y }, tmp_path)
+  os.replace(tmp_path, cache_path)
+
+  return names, logits, Y
+
+
+def ensemble_metrics(logits, Y, full_probs=None):
+  pred = predictive(logits)
+  metrics = {
+    'nll': -pred['log_probs'].gather(-1, Y.unsqueeze(-1)).mean().item(),
+    'acc': (pred['probs'].argmax(dim=-1) == Y).float().mean().item(),
+    'ece': ece(Y.numpy(), pred['probs'].numpy(), num_bins=30),
+  }
+  if full_probs is not None:
+    metrics['agreement'] = (pred['probs'].argmax(dim=-1) == full_probs.argmax(dim=-1)).float().mean().item()
+  return metrics
+
+
+def main(seed=None, device=0, data_dir=None, samples_dir=None, out_dir=None, logits_cache=None, dataset='cifar10',
+         dirty_lik=True, n_val=5000, criterion='nll', k=None, tolerance=.01, batch_size=2048, eval_cache=None,
+         export_samples=True):
+  '''
+  Select k samples from samples_dir that best preserve the predictive of
+  all of them (greedy forward selection, see select_samples, by criterion
+  'nll' or 'diversity'), on a fixed random split of n_val test inputs, and
+  copy them to out_dir (default: samples_k<k> next to samples_dir). The
+  training set is no validation set, as the samples were fit on all of it.
+  Without k, it is the smallest k whose validation NLL is within tolerance
+  (relative) of the full ensemble.
+
+  Test logits of all samples are cached under logits_cache (default: logits
+  next to samples_dir). The report (<out_dir>.json) lists NLL, accuracy,
+  ECE and agreement with the full ensemble on the validation split and on
+  the remaining test inputs for every k.
+  '''
+  if data_dir is None and os.environ.get('DATADIR') is not None:
+      data_dir = os.environ.get('DATADIR')
+
+  samples_dir = Path(samples_dir)
+  assert samples_dir.is_dir()
+  logits_cache = Path(logits_cache or samples_dir.parent / 'logits')
+
+  set_seeds(seed)
+  device = f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+
+  get_data = dict(cifar10=get_cifar10, mnist=get_mnist)[dataset]
+  train_data, test_data = get_data(root=data_dir, augment=False)
+
+  if eval_cache:
+    test_loader = eval_loader(test_data, f'{dataset}-test', eval_cache, batch_size=batch_size, device=device)
+  else:
+    test_loader = DataLoader(test_data, batch_size=batch_size, num_workers=2)
+
+  net = get_net(dirty_lik, train_data.total_classes).to(device).eval()
+
+  names, logits, Y = bank_logits(net, test_loader, samples_dir, logits_cache / 'test.pt',
+                                 export=export_samples, device=device)
+
+  assert 0 < n_val < Y.size(0), f'n_val must leave test inputs, got {n_val} of {Y.size(0)}.'
+
+  ## A fixed split, the same for every bank and criterion.
+  g = torch.Generator().manual_seed(0)
+  perm = torch.randperm(Y.size(0), generator=g)
+  val_idx, test_idx = perm[:n_val], perm[n_val:]
+  val_logits, val_Y = logits[:, val_idx], Y[val_idx]
+  test_logits, test_Y = logits[:, test_idx], Y[test_idx]
+
+  order = select_samples(val_logits, val_Y, criterion=criterion)
+
+  full_val_probs, full_test_probs = predictive(val_logits)['probs'], predictive(test_logits)['probs']
+  report = []
+  for i in range(1, len(order) + 1):
+    idx = order[:i]
+    report.append({
+      'k': i,
+      **{ f'val/{m}': v for m, v in ensemble_metrics(val_logits[idx], val_Y, full_val_probs).items() },
+      **{ f'test/{m}': v for m, v in ensemble_metrics(test_logits[idx], test_Y, full_test_probs).items() },
+    })
+    logging.info(report[-1])
+
+  if k is None:
+    full_nll = report[-1]['val/nll']
+    k = next(r['k'] for r in report if r['val/nll'] <= full_nll + tolerance * abs(full_nll))
+  k = min(k, len(order))
+
+  out_dir = Path(out_dir or samples_dir.parent / f'samples_k{k}')
+  for i in order[:k]:
+    (out_dir / names[i]).parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(samples_dir / names[i], out_dir / names[i])
+
+  with open(out_dir.with_suffix('.json'), 'w') as f:
+    json.dump({ 'criterion': criterion, 'k': k, 'order': [names[i] for i in order], 'report': report }, f, indent=2)
+
+  logging.info(f'Kept {k} of {len(order)} samples in {out_dir}: {report[k - 1]}')
+
+  return report[k - 1]
+
+
+if __name__ == '__main__':
+  import fire
+
+  logging.getLogger().setLevel(logging.INFO)
+
+  fire.Fire(main)
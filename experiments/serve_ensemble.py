@@ -0,0 +1,61 @@
+import logging
+from pathlib import Path
+import torch
+
+from data_aug.models import get_net, Ensemble, load_ensemble
+from data_aug.serve import MicroBatcher, make_server, predictive_fn
+
+
+INPUT_SHAPES = {
+  'cifar10': (3, 32, 32),
+  'mnist': (1, 28, 28),
+}
+
+NUM_CLASSES = {
+  'cifar10': 10,
+  'mnist': 10,
+}
+
+
+def get_ensemble(samples_dir, dataset='cifar10', dirty_lik=True, n_samples=None, export=True, device=None):
+  '''The first n_samples (default: all) samples under samples_dir.'''
+  net = get_net(dirty_lik, NUM_CLASSES[dataset]).to(device).eval()
+  ensemble = load_ensemble(net, samples_dir, export=export)
+  if n_samples is not None:
+    ensemble = Ensemble(list(ensemble.members)[:n_samples]).eval()
+  return ensemble
+
+
+def main(device=0, samples_dir=None, dataset='cifar10', dirty_lik=True, n_samples=None, export_samples=True,
+         host='127.0.0.1', port=8000, max_batch_size=64, max_delay_ms=5):
+  '''
+  Serve the posterior predictive (mean, entropy and mutual information) of
+  the samples under samples_dir over HTTP, see data_aug.serve. Requests are
+  grouped into batches of up to max_batch_size inputs, waiting at most
+  max_delay_ms for a batch to fill.
+  '''
+  assert Path(samples_dir).is_dir()
+
+  device = f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+
+  ensemble = get_ensemble(samples_dir, dataset=dataset, dirty_lik=dirty_lik, n_samples=n_samples,
+                          export=export_samples, device=device)
+
+  with MicroBatcher(predictive_fn(ensemble, device=device), max_batch_size=max_batch_size,
+                    max_delay=max_delay_ms / 1e3) as batcher:
+    server = make_server(batcher, INPUT_SHAPES[dataset], host=host, port=port)
+    logging.info(f'Serving {len(ensemble.members)} samples on http://{host}:{server.server_address[1]}/predict')
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+
+
+if __name__ == '__main__':
+  import fire
+
+  logging.getLogger().setLevel(logging.INFO)
+
+  fire.Fire(main)
@@ -1,4 +1,5 @@
 import os
+import time
 from pathlib import Path
 import torch
 from torch.utils.data import DataLoader
@@ -6,27 +7,31 @@ from tqdm.auto import tqdm
 import logging
 
 from data_aug.utils import set_seeds
-from data_aug.models import ResNet18
-from data_aug.datasets import get_cifar10
+from data_aug.data import eval_loader
+from data_aug.models import get_net, load_sample, calibration_batches, quantize_sample, sample_cache
+from data_aug.datasets import get_cifar10, get_mnist
 
 from bnn_priors.third_party.calibration_error import ece
 
 @torch.no_grad()
-def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
+def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None, export=True, quantize=None, calibration=None):
   net.eval()
 
   ens_logits = []
   ens_nll = []
 
   for sample_path in tqdm(Path(samples_dir).rglob('*.pt'), leave=False):
-    net.load_state_dict(torch.load(sample_path))
+    if quantize:
+      model = quantize_sample(net, sample_path, mode=quantize, calibration=calibration)
+    else:
+      model = load_sample(net, sample_path, export=export)
 
     all_logits = []
     all_Y = []
     all_nll = torch.tensor(0.0).to(device)
     for X, Y in tqdm(data_loader, leave=False):
       X, Y = X.to(device), Y.to(device)
-      _logits = net(X)
+      _logits = model(X)
       all_logits.append(_logits)
       all_Y.append(Y)
       if nll_criterion is not None:
@@ -54,36 +59,78 @@ def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
   return { 'acc': acc, 'nll': nll, 'ce_nll': ce_nll, 'ece': ece_val }
 
 
-def main(seed=None, device=0, data_dir=None, samples_dir=None, batch_size=2048):
+def timed_test_bma(*args, **kwargs):
+  start = time.perf_counter()
+  metrics = test_bma(*args, **kwargs)
+  return { **metrics, 'time': time.perf_counter() - start }
+
+
+def main(seed=None, device=0, data_dir=None, samples_dir=None, batch_size=2048, eval_cache=None, export_samples=True,
+         dataset='cifar10', dirty_lik=True, quantize=None, n_calibration=512, sample_cache_mb=None):
+  '''
+  With quantize ('dynamic' or 'static'), evaluates on CPU both the fp32 and
+  the int8 ensemble and reports the int8 metrics as <metric>_int8 and their
+  difference to fp32 as <metric>_drift. Static quantization is calibrated on
+  n_calibration random (unaugmented) training inputs.
+
+  Samples stay in memory (see SampleCache) across the train and test passes,
+  up to sample_cache_mb (default: $DATA_AUG_SAMPLE_CACHE_MB, or 1024).
+  '''
   if data_dir is None and os.environ.get('DATADIR') is not None:
       data_dir = os.environ.get('DATADIR')
 
   assert Path(samples_dir).is_dir()
 
+  if sample_cache_mb is not None:
+    sample_cache().max_bytes = sample_cache_mb * 2**20
+
   torch.backends.cudnn.benchmark = True
 
   set_seeds(seed)
   device = f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+  if quantize:
+    ## Quantized kernels are CPU only.
+    device = 'cpu'
 
-  train_data, test_data = get_cifar10(root=data_dir, seed=seed, augment=False)
+  get_data = dict(cifar10=get_cifar10, mnist=get_mnist)[dataset]
+  train_data, test_data = get_data(root=data_dir, augment=False)
   
-  train_loader = DataLoader(train_data, batch_size=batch_size, num_workers=2)
-  test_loader = DataLoader(test_data, batch_size=batch_size, num_workers=2)
-
-  net = ResNet18(num_classes=10).to(device).eval()
-
-  train_metrics = test_bma(net, train_loader, samples_dir, device=device)
-  train_metrics = { f'train/{k}': v for k, v in train_metrics.items() }
-  test_metrics = test_bma(net, test_loader, samples_dir, device=device)
-  test_metrics = { f'test/{k}': v for k, v in test_metrics.items() }
+  if eval_cache:
+    train_loader = eval_loader(train_data, f'{dataset}-train', eval_cache, batch_size=batch_size, device=device)
+    test_loader = eval_loader(test_data, f'{dataset}-test', eval_cache, batch_size=batch_size, device=device)
+  else:
+    train_loader = DataLoader(train_data, batch_size=batch_size, num_workers=2)
+    test_loader = DataLoader(test_data, batch_size=batch_size, num_workers=2)
+
+  net = get_net(dirty_lik, train_data.total_classes).to(device).eval()
+
+  calibration = None
+  if quantize == 'static':
+    calibration = calibration_batches(train_data, n_samples=n_calibration)
+
+  all_metrics = []
+  for split, loader in [('train', train_loader), ('test', test_loader)]:
+    metrics = timed_test_bma(net, loader, samples_dir, device=device, export=export_samples)
+    if quantize:
+      q_metrics = timed_test_bma(net, loader, samples_dir, device=device, quantize=quantize, calibration=calibration)
+      metrics = {
+        **metrics,
+        **{ f'{k}_int8': v for k, v in q_metrics.items() },
+        **{ f'{k}_drift': q_metrics[k] - v for k, v in metrics.items() if k != 'time' },
+        'speedup': metrics['time'] / q_metrics['time'],
+      }
+    all_metrics.append({ f'{split}/{k}': v for k, v in metrics.items() })
+
+  train_metrics, test_metrics = all_metrics
   
   logging.info(train_metrics)
   logging.info(test_metrics)
+  logging.info(f'Sample cache: {sample_cache().stats}')
 
   return train_metrics, test_metrics
 
 
-def main_sweep(sweep_dir=None):
+def main_sweep(sweep_dir=None, eval_cache=None):
   import yaml
   import pickle
 
@@ -101,7 +148,7 @@ def main_sweep(sweep_dir=None):
       config = yaml.safe_load(f)
     config['run_id'] = d
 
-    train_metrics, test_metrics = main(samples_dir=samples_dir)
+    train_metrics, test_metrics = main(samples_dir=samples_dir, eval_cache=eval_cache)
 
     results.append({ **config, **train_metrics, **test_metrics  })
 
@@ -1,4 +1,5 @@
 import logging
+import contextlib
 from pathlib import Path
 from tqdm.auto import tqdm
 import wandb
@@ -6,12 +7,14 @@ import torch
 from torch.utils.data import DataLoader
 from torch.optim import SGD
 
-from data_aug.optim import SGLD
+from data_aug.optim import SGLD, CompiledSGLDStep
 from data_aug.optim.lr_scheduler import CosineLR
 from data_aug.utils import set_seeds
-from data_aug.models import ResNet18, ResNet18FRN
+from data_aug.data import Prefetcher, eval_loader
+from data_aug.data.autotune import tuned_loader_kwargs
+from data_aug.models import ResNet18, ResNet18FRN, prepare_model, load_sample, checkpoint_to_budget
 from data_aug.datasets import get_cifar10, get_tiny_imagenet
-from data_aug.nn import GaussianPriorAugmentedCELoss, KLAugmentedNoisyDirichletLoss, NoisyDirichletLoss
+from data_aug.nn import GaussianPriorAugmentedCELoss, KLAugmentedNoisyDirichletLoss, NoisyDirichletLoss, ghost_batches
 
 
 @torch.no_grad()
@@ -42,21 +45,22 @@ def test(data_loader, net, criterion, device=None):
 
 
 @torch.no_grad()
-def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
+def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None, export=True):
   net.eval()
 
   ens_logits = []
   ens_nll = []
 
   for sample_path in tqdm(Path(samples_dir).rglob('*.pt'), leave=False):
-    net.load_state_dict(torch.load(sample_path))
+    ## No sample cache during training: it would hold memory next to the chain.
+    model = load_sample(net, sample_path, export=export, cache=False)
 
     all_logits = []
     all_Y = []
     all_nll = torch.tensor(0.0).to(device)
     for X, Y in tqdm(data_loader, leave=False):
       X, Y = X.to(device), Y.to(device)
-      _logits = net(X)
+      _logits = model(X)
       all_logits.append(_logits)
       all_Y.append(Y)
       if nll_criterion is not None:
@@ -81,8 +85,29 @@ def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
   return { 'acc': acc, 'nll': nll, 'ce_nll': ce_nll }
 
 
+def aug_forward(net, X, X_aug, fused_forward=None):
+  '''Logits of the clean views X and of the augmented views X_aug.
+
+  With fused_forward, both run as one concatenated batch. For BatchNorm, 'ghost'
+  normalizes the clean and the augmented part with their own batch statistics,
+  as two separate forwards do, and 'shared' uses the statistics of the joint
+  batch. Networks without batch statistics (FRN, Fixup) give the same logits
+  either way.
+  '''
+  X_aug = X_aug.view(-1, *X.shape[-3:])
+
+  if fused_forward is None:
+    f_hat, f_hat_aug = net(X), net(X_aug)
+  else:
+    sizes = [X.size(0), X_aug.size(0)]
+    with ghost_batches(net, sizes) if fused_forward == 'ghost' else contextlib.nullcontext():
+      f_hat, f_hat_aug = net(torch.cat([X, X_aug])).split(sizes)
+
+  return f_hat, f_hat_aug.view(X.size(0), -1, f_hat_aug.size(-1))
+
+
 def run_sgd(train_loader, test_loader, net, criterion, device=None,
-            lr=1e-2, momentum=.9, epochs=1):
+            lr=1e-2, momentum=.9, epochs=1, fused_forward=None):
   train_data = train_loader.dataset
   N = len(train_data)
 
@@ -98,8 +123,7 @@ def run_sgd(train_loader, test_loader, net, criterion, device=None,
 
       sgd.zero_grad()
 
-      f_hat = net(X)
-      f_hat_aug = net(X_aug.view(-1, *X.shape[-3:])).view(*X_aug.shape[:2], -1)
+      f_hat, f_hat_aug = aug_forward(net, X, X_aug, fused_forward=fused_forward)
       loss = criterion(f_hat, Y, logits_aug=f_hat_aug, N=N, K=train_data.total_augs)
 
       loss.backward()
@@ -116,6 +140,9 @@ def run_sgd(train_loader, test_loader, net, criterion, device=None,
 
     # sgd_scheduler.step()
 
+    if isinstance(train_loader, Prefetcher):
+      wandb.log({f'sgd/train/data_{k}': v for k, v in train_loader.stats.items() }, step=e)
+
     test_metrics = test(test_loader, net, criterion, device=device)
 
     wandb.log({f'sgd/test/{k}': v for k, v in test_metrics.items() }, step=e)
@@ -133,27 +160,34 @@ def run_sgd(train_loader, test_loader, net, criterion, device=None,
 
 def run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=None,
              lr=1e-7, momentum=.9, temperature=1, burn_in=0, n_samples=20,
-             epochs=1, nll_criterion=None):
+             epochs=1, nll_criterion=None, compile_step=False, fused_forward=None):
   train_data = train_loader.dataset
   N = len(train_data)
 
   sgld = SGLD(net.parameters(), lr=lr, momentum=momentum, temperature=temperature)
   sample_int = (epochs - burn_in) // n_samples
 
+  def energy_fn(X, X_aug, Y):
+    f_hat, f_hat_aug = aug_forward(net, X, X_aug, fused_forward=fused_forward)
+    return criterion(f_hat, Y, logits_aug=f_hat_aug, N=N, K=train_data.total_augs)
+
+  sgld_step = CompiledSGLDStep(sgld, energy_fn) if compile_step else None
+
   for e in tqdm(range(epochs)):
     net.train()
     for i, (X, X_aug, Y) in tqdm(enumerate(train_loader), leave=False):
       X, X_aug, Y = X.to(device), X_aug.to(device), Y.to(device)
 
-      sgld.zero_grad()
+      if sgld_step is not None:
+        loss = sgld_step(X, X_aug, Y)
+      else:
+        sgld.zero_grad()
 
-      f_hat = net(X)
-      f_hat_aug = net(X_aug.view(-1, *X.shape[-3:])).view(*X_aug.shape[:2], -1)
-      loss = criterion(f_hat, Y, logits_aug=f_hat_aug, N=N, K=train_data.total_augs)
+        loss = energy_fn(X, X_aug, Y)
 
-      loss.backward()
+        loss.backward()
 
-      sgld.step()
+        sgld.step()
 
       if i % 100 == 0:
         metrics = {
@@ -163,6 +197,9 @@ def run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=None
         }
         wandb.log({f'sgld/train/{k}': v for k, v in metrics.items() }, step=e)
 
+    if isinstance(train_loader, Prefetcher):
+      wandb.log({f'sgld/train/data_{k}': v for k, v in train_loader.stats.items() }, step=e)
+
     test_metrics = test(test_loader, net, criterion, device=device)
     wandb.log({f'sgld/test/{k}': v for k, v in test_metrics.items() }, step=e)
 
@@ -186,7 +223,7 @@ def run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=None
 
 def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=None,
               lr=1e-2, momentum=.9, temperature=1, n_samples=20, n_cycles=1,
-              epochs=1, nll_criterion=None):
+              epochs=1, nll_criterion=None, compile_step=False, fused_forward=None):
   train_data = train_loader.dataset
   N = len(train_data)
 
@@ -194,24 +231,30 @@ def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=Non
   sgld_scheduler = CosineLR(sgld, n_cycles=n_cycles, n_samples=n_samples,
                             T_max=len(train_loader) * epochs)
 
+  def energy_fn(X, X_aug, Y):
+    f_hat, f_hat_aug = aug_forward(net, X, X_aug, fused_forward=fused_forward)
+    return criterion(f_hat, Y, logits_aug=f_hat_aug, N=N, K=train_data.total_augs)
+
+  sgld_step = CompiledSGLDStep(sgld, energy_fn) if compile_step else None
+
   for e in tqdm(range(epochs)):
     net.train()
     for i, (X, X_aug, Y) in tqdm(enumerate(train_loader), leave=False):
       X, X_aug, Y = X.to(device), X_aug.to(device), Y.to(device)
 
-      sgld.zero_grad()
+      noise = sgld_scheduler.get_last_beta() >= sgld_scheduler.beta
+      if sgld_step is not None:
+        loss = sgld_step(X, X_aug, Y, noise=noise)
+      else:
+        sgld.zero_grad()
 
-      f_hat = net(X)
-      f_hat_aug = net(X_aug.view(-1, *X.shape[-3:])).view(*X_aug.shape[:2], -1)
-      loss = criterion(f_hat, Y, logits_aug=f_hat_aug, N=N, K=train_data.total_augs)
+        loss = energy_fn(X, X_aug, Y)
 
-      loss.backward()
+        loss.backward()
 
-      if sgld_scheduler.get_last_beta() < sgld_scheduler.beta:
-        sgld.step(noise=False)
-      else:
-        sgld.step()
+        sgld.step(noise=noise)
 
+      if noise:
         if sgld_scheduler.should_sample():
           torch.save(net.state_dict(), samples_dir / f's_e{e}_m{i}.pt')
           wandb.save('samples/*.pt')
@@ -232,6 +275,9 @@ def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=Non
         }
         wandb.log({f'csgld/train/{k}': v for k, v in metrics.items() }, step=e)
 
+    if isinstance(train_loader, Prefetcher):
+      wandb.log({f'csgld/train/data_{k}': v for k, v in train_loader.stats.items() }, step=e)
+
     test_metrics = test(test_loader, net, criterion, device=device)
 
     wandb.log({f'csgld/test/{k}': v for k, v in test_metrics.items() }, step=e)
@@ -247,7 +293,9 @@ def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=Non
 
 
 def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, dataset='cifar10',
-         batch_size=128, dirty_lik=True, prior_scale=1, aug_scale=1, n_aug=1,
+         batch_size=128, dirty_lik=True, prior_scale=1, aug_scale=1, n_aug=1, in_memory=False,
+         eval_cache=None, prefetch=0, channels_last=False, compile=False, compile_step=False, activation_budget=None,
+         fused_forward=None,
          epochs=0, lr=1e-7, noise=1e-4, likelihood='softmax', likelihood_temp=1, logits_temp=1,
          sgld_epochs=0, sgld_lr=1e-6, momentum=.9, temperature=1, burn_in=0, n_samples=20, n_cycles=0):
   if data_dir is None and os.environ.get('DATADIR') is not None:
@@ -276,6 +324,7 @@ def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, data
     'likelihood': likelihood,
     'likelihood_T': likelihood_temp,
     'logits_temp': logits_temp,
+    'fused_forward': fused_forward,
   })
 
   samples_dir = Path(wandb.run.dir) / 'samples'
@@ -286,13 +335,17 @@ def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, data
                                               n_aug=n_aug, return_orig=True)
   elif dataset == 'cifar10':
     train_data, test_data = get_cifar10(root=data_dir, label_noise=label_noise,
-                                        n_aug=n_aug, return_orig=True)
+                                        n_aug=n_aug, return_orig=True, in_memory=in_memory)
   else:
     raise NotImplementedError
   
-  train_loader = DataLoader(train_data, batch_size=batch_size, num_workers=2,
-                            shuffle=True)
-  test_loader = DataLoader(test_data, batch_size=batch_size, num_workers=2)
+  loader_kwargs = tuned_loader_kwargs(('train_aug_lik', dataset, n_aug, dirty_lik, batch_size))
+  train_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True, **loader_kwargs)
+  test_loader = DataLoader(test_data, batch_size=batch_size, **loader_kwargs)
+  if eval_cache:
+    test_loader = eval_loader(test_data, f'{dataset}-test', eval_cache, batch_size=batch_size, device=device)
+  if prefetch:
+    train_loader = Prefetcher(train_loader, device=device, depth=prefetch)
 
   if dirty_lik:
     net = ResNet18(num_classes=train_data.total_classes)
@@ -303,6 +356,11 @@ def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, data
   if ckpt_path is not None and ckpt_path.is_file():
     net.load_state_dict(torch.load(ckpt_path))
     logging.info(f'Loaded {ckpt_path}')
+  if activation_budget:
+    ## Budget in GiB for the activations of the clean and augmented forward.
+    X_probe = torch.stack([train_data[i][0] for i in range(8)]).to(device)
+    checkpoint_to_budget(net, X_probe, batch_size * (1 + n_aug), activation_budget * 2**30)
+  net = prepare_model(net, channels_last=channels_last, compile=compile)
   
   nll_criterion = None
   if likelihood == 'dirichlet':
@@ -319,15 +377,17 @@ def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, data
 
   if epochs:
     run_sgd(train_loader, test_loader, net, criterion, device=device,
-            lr=lr, epochs=epochs)
+            lr=lr, epochs=epochs, fused_forward=fused_forward)
 
   if sgld_epochs:
     if n_cycles:
       run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=device, nll_criterion=nll_criterion,
-                lr=sgld_lr, momentum=momentum, temperature=temperature, n_samples=n_samples, n_cycles=n_cycles, epochs=sgld_epochs)
+                lr=sgld_lr, momentum=momentum, temperature=temperature, n_samples=n_samples, n_cycles=n_cycles, epochs=sgld_epochs,
+                compile_step=compile_step, fused_forward=fused_forward)
     else:
       run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=device, nll_criterion=nll_criterion,
-                lr=sgld_lr, momentum=momentum, temperature=temperature, burn_in=burn_in, n_samples=n_samples, epochs=sgld_epochs)
+                lr=sgld_lr, momentum=momentum, temperature=temperature, burn_in=burn_in, n_samples=n_samples, epochs=sgld_epochs,
+                compile_step=compile_step, fused_forward=fused_forward)
 
 
 if __name__ == '__main__':
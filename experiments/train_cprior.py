@@ -6,10 +6,12 @@ import torch
 from torch.utils.data import DataLoader
 from torch.optim import SGD
 
-from data_aug.optim import SGLD
+from data_aug.optim import SGLD, CompiledSGLDStep
 from data_aug.optim.lr_scheduler import CosineLR
 from data_aug.utils import set_seeds
-from data_aug.models import ResNet18, ResNet18FRN
+from data_aug.data import Prefetcher, eval_loader
+from data_aug.data.autotune import tuned_loader_kwargs
+from data_aug.models import ResNet18, ResNet18FRN, prepare_model, load_sample
 from data_aug.datasets import get_cifar10, get_tiny_imagenet
 from data_aug.nn import CPriorAugmentedCELoss
 
@@ -42,21 +44,22 @@ def test(data_loader, net, criterion, device=None):
 
 
 @torch.no_grad()
-def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
+def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None, export=True):
   net.eval()
 
   ens_logits = []
   ens_nll = []
 
   for sample_path in tqdm(Path(samples_dir).rglob('*.pt'), leave=False):
-    net.load_state_dict(torch.load(sample_path))
+    ## No sample cache during training: it would hold memory next to the chain.
+    model = load_sample(net, sample_path, export=export, cache=False)
 
     all_logits = []
     all_Y = []
     all_nll = torch.tensor(0.0).to(device)
     for X, Y in tqdm(data_loader, leave=False):
       X, Y = X.to(device), Y.to(device)
-      _logits = net(X)
+      _logits = model(X)
       all_logits.append(_logits)
       all_Y.append(Y)
       if nll_criterion is not None:
@@ -115,6 +118,9 @@ def run_sgd(train_loader, test_loader, net, criterion, device=None,
 
     # sgd_scheduler.step()
 
+    if isinstance(train_loader, Prefetcher):
+      wandb.log({f'sgd/train/data_{k}': v for k, v in train_loader.stats.items() }, step=e)
+
     test_metrics = test(test_loader, net, criterion, device=device)
 
     wandb.log({f'sgd/test/{k}': v for k, v in test_metrics.items() }, step=e)
@@ -133,26 +139,33 @@ def run_sgd(train_loader, test_loader, net, criterion, device=None,
 
 def run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=None,
              lr=1e-7, momentum=.9, temperature=1, burn_in=0, n_samples=20,
-             epochs=1, nll_criterion=None):
+             epochs=1, nll_criterion=None, compile_step=False):
   train_data = train_loader.dataset
   N = len(train_data)
 
   sgld = SGLD(net.parameters(), lr=lr, momentum=momentum, temperature=temperature)
   sample_int = (epochs - burn_in) // n_samples
 
+  sgld_step = None
+  if compile_step:
+    sgld_step = CompiledSGLDStep(sgld, lambda X, Y: criterion(net(X), Y, N=N, diri=True))
+
   for e in tqdm(range(epochs)):
     net.train()
     for i, (X, Y) in tqdm(enumerate(train_loader), leave=False):
       X, Y = X.to(device).to(device), Y.to(device)
 
-      sgld.zero_grad()
+      if sgld_step is not None:
+        loss = sgld_step(X, Y)
+      else:
+        sgld.zero_grad()
 
-      f_hat = net(X)
-      loss = criterion(f_hat, Y, N=N, diri=True)
+        f_hat = net(X)
+        loss = criterion(f_hat, Y, N=N, diri=True)
 
-      loss.backward()
+        loss.backward()
 
-      sgld.step()
+        sgld.step()
 
       if i % 100 == 0:
         metrics = {
@@ -162,6 +175,9 @@ def run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=None
         }
         wandb.log({f'sgld/train/{k}': v for k, v in metrics.items() }, step=e)
 
+    if isinstance(train_loader, Prefetcher):
+      wandb.log({f'sgld/train/data_{k}': v for k, v in train_loader.stats.items() }, step=e)
+
     test_metrics = test(test_loader, net, criterion, device=device)
     wandb.log({f'sgld/test/{k}': v for k, v in test_metrics.items() }, step=e)
 
@@ -185,7 +201,7 @@ def run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=None
 
 def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=None,
               lr=1e-2, momentum=.9, temperature=1, n_samples=20, n_cycles=1,
-              epochs=1, nll_criterion=None):
+              epochs=1, nll_criterion=None, compile_step=False):
   train_data = train_loader.dataset
   N = len(train_data)
 
@@ -193,24 +209,30 @@ def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=Non
   sgld_scheduler = CosineLR(sgld, n_cycles=n_cycles, n_samples=n_samples,
                             T_max=len(train_loader) * epochs)
 
+  sgld_step = None
+  if compile_step:
+    sgld_step = CompiledSGLDStep(sgld, lambda X, Y: criterion(net(X), Y, N=N, diri=True))
+
   for e in tqdm(range(epochs)):
     net.train()
     for i, (X, Y) in tqdm(enumerate(train_loader), leave=False):
       X, Y = X.to(device), Y.to(device)
 
-      sgld.zero_grad()
+      noise = sgld_scheduler.get_last_beta() >= sgld_scheduler.beta
+      if sgld_step is not None:
+        loss = sgld_step(X, Y, noise=noise)
+      else:
+        sgld.zero_grad()
 
-      f_hat = net(X)
-      loss = criterion(f_hat, Y, N=N, diri=True)
+        f_hat = net(X)
+        loss = criterion(f_hat, Y, N=N, diri=True)
 
-      loss.backward()
-      # torch.nn.utils.clip_grad_norm_(net.parameters(), 200.)
+        loss.backward()
+        # torch.nn.utils.clip_grad_norm_(net.parameters(), 200.)
 
-      if sgld_scheduler.get_last_beta() < sgld_scheduler.beta:
-        sgld.step(noise=False)
-      else:
-        sgld.step()
+        sgld.step(noise=noise)
 
+      if noise:
         if sgld_scheduler.should_sample():
           torch.save(net.state_dict(), samples_dir / f's_e{e}_m{i}.pt')
           wandb.save('samples/*.pt')
@@ -231,6 +253,9 @@ def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=Non
         }
         wandb.log({f'csgld/train/{k}': v for k, v in metrics.items() }, step=e)
 
+    if isinstance(train_loader, Prefetcher):
+      wandb.log({f'csgld/train/data_{k}': v for k, v in train_loader.stats.items() }, step=e)
+
     test_metrics = test(test_loader, net, criterion, device=device)
 
     wandb.log({f'csgld/test/{k}': v for k, v in test_metrics.items() }, step=e)
@@ -247,6 +272,7 @@ def run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=Non
 
 def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, dataset='cifar10',
          batch_size=128, dirty_lik=True, prior_scale=1,
+         eval_cache=None, prefetch=0, channels_last=False, compile=False, compile_step=False,
          epochs=0, lr=1e-6, noise=1e-4,
          sgld_epochs=0, sgld_lr=1e-6, momentum=.9, temperature=1, burn_in=0, n_samples=20, n_cycles=0):
   if data_dir is None and os.environ.get('DATADIR') is not None:
@@ -282,9 +308,13 @@ def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, data
   else:
     raise NotImplementedError
   
-  train_loader = DataLoader(train_data, batch_size=batch_size, num_workers=2,
-                            shuffle=True)
-  test_loader = DataLoader(test_data, batch_size=batch_size, num_workers=2)
+  loader_kwargs = tuned_loader_kwargs(('train_cprior', dataset, dirty_lik, batch_size))
+  train_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True, **loader_kwargs)
+  test_loader = DataLoader(test_data, batch_size=batch_size, **loader_kwargs)
+  if eval_cache:
+    test_loader = eval_loader(test_data, f'{dataset}-test', eval_cache, batch_size=batch_size, device=device)
+  if prefetch:
+    train_loader = Prefetcher(train_loader, device=device, depth=prefetch)
 
   if dirty_lik:
     net = ResNet18(num_classes=train_data.total_classes)
@@ -295,6 +325,7 @@ def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, data
   if ckpt_path is not None and ckpt_path.is_file():
     net.load_state_dict(torch.load(ckpt_path))
     logging.info(f'Loaded {ckpt_path}')
+  net = prepare_model(net, channels_last=channels_last, compile=compile)
   
   nll_criterion = None
   criterion = CPriorAugmentedCELoss(net.parameters(), prior_scale=prior_scale, dir_noise=noise,
@@ -307,10 +338,12 @@ def main(seed=None, device=0, data_dir=None, ckpt_path=None, label_noise=0, data
   if sgld_epochs:
     if n_cycles:
       run_csgld(train_loader, test_loader, net, criterion, samples_dir, device=device, nll_criterion=nll_criterion,
-                lr=sgld_lr, momentum=momentum, temperature=1., n_samples=n_samples, n_cycles=n_cycles, epochs=sgld_epochs)
+                lr=sgld_lr, momentum=momentum, temperature=1., n_samples=n_samples, n_cycles=n_cycles, epochs=sgld_epochs,
+                compile_step=compile_step)
     else:
       run_sgld(train_loader, test_loader, net, criterion, samples_dir, device=device, nll_criterion=nll_criterion,
-                lr=sgld_lr, momentum=momentum, temperature=1., burn_in=burn_in, n_samples=n_samples, epochs=sgld_epochs)
+                lr=sgld_lr, momentum=momentum, temperature=1., burn_in=burn_in, n_samples=n_samples, epochs=sgld_epochs,
+                compile_step=compile_step)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+import logging
+import time
+from pathlib import Path
+from tqdm.auto import tqdm
+import wandb
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset
+
+from data_aug.optim import SGLD
+from data_aug.optim.lr_scheduler import CosineLR
+from data_aug.utils import set_seeds
+from data_aug.data import TensorLoader
+from data_aug.data.feature_bank import head, feature_bank
+from data_aug.models import ResNet18, ResNet18FRN, load_sample
+from data_aug.datasets import get_cifar10, get_tiny_imagenet
+from data_aug.nn import GaussianPriorAugmentedCELoss, KLAugmentedNoisyDirichletLoss, NoisyDirichletLoss
+
+
+@torch.no_grad()
+def test(data_loader, net, criterion, device=None):
+  net.eval()
+
+  total_loss = 0.
+  N = 0
+  Nc = 0
+
+  for X, Y in data_loader:
+    X, Y = X.to(device), Y.to(device)
+
+    f_hat = net(X)
+    Y_pred = f_hat.argmax(dim=-1)
+    loss = criterion(f_hat, Y, N=X.size(0))
+
+    N += Y.size(0)
+    Nc += (Y_pred == Y).sum().item()
+    total_loss += loss
+
+  acc = Nc / N
+
+  return {
+    'total_loss': total_loss.item(),
+    'acc': acc,
+  }
+
+
+@torch.no_grad()
+def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
+  net.eval()
+
+  ens_logits = []
+  ens_nll = []
+
+  for sample_path in Path(samples_dir).rglob('*.pt'):
+    ## No sample cache during training: it would hold memory next to the chain.
+    model = load_sample(net, sample_path, export=False, cache=False)
+
+    all_logits = []
+    all_Y = []
+    all_nll = torch.tensor(0.0).to(device)
+    for X, Y in data_loader:
+      X, Y = X.to(device), Y.to(device)
+      _logits = model(X)
+      all_logits.append(_logits)
+      all_Y.append(Y)
+      if nll_criterion is not None:
+        all_nll += nll_criterion(_logits, Y)
+    all_logits = torch.cat(all_logits)
+    all_Y = torch.cat(all_Y)
+
+    ens_logits.append(all_logits)
+    ens_nll.append(all_nll)
+
+  ens_logits = torch.stack(ens_logits)
+  ens_nll = torch.stack(ens_nll)
+
+  ce_nll = - torch.distributions.Categorical(logits=ens_logits)\
+              .log_prob(all_Y).sum(dim=-1).mean(dim=-1)
+
+  nll = ens_nll.mean(dim=-1)
+
+  Y_pred = ens_logits.softmax(dim=-1).mean(dim=0).argmax(dim=-1)
+  acc = (Y_pred == all_Y).sum().item() / Y_pred.size(0)
+
+  return { 'acc': acc, 'nll': nll, 'ce_nll': ce_nll }
+
+
+def make_energy_fn(net, criterion, N, K):
+  '''Energy of a batch of features [B, 1 + n_aug, D]: clean view first.'''
+  def energy_fn(F, Y):
+    logits = net(F)
+    f_hat, f_hat_aug = logits[:, 0], logits[:, 1:]
+    if f_hat_aug.size(1) == 0:
+      f_hat_aug = None
+    return criterion(f_hat, Y, logits_aug=f_hat_aug, N=N, K=K)
+  return energy_fn
+
+
+def run_sgld(train_loader, test_loader, net, criterion, samples_dir, K=1, device=None,
+             lr=1e-7, momentum=.9, temperature=1, burn_in=0, n_samples=20,
+             epochs=1, nll_criterion=None):
+  N = train_loader.n
+
+  sgld = SGLD(net.parameters(), lr=lr, momentum=momentum, temperature=temperature)
+  sample_int = (epochs - burn_in) // n_samples
+  energy_fn = make_energy_fn(net, criterion, N, K)
+
+  for e in tqdm(range(epochs)):
+    net.train()
+    for i, (F, Y) in enumerate(train_loader):
+      sgld.zero_grad()
+
+      loss = energy_fn(F, Y)
+
+      loss.backward()
+
+      sgld.step()
+
+    test_metrics = test(test_loader, net, criterion, device=device)
+    wandb.log({f'sgld/test/{k}': v for k, v in test_metrics.items() }, step=e)
+
+    if e + 1 > burn_in and (e + 1 - burn_in) % sample_int == 0:
+        torch.save(net.state_dict(), samples_dir / f's_e{e}.pt')
+
+  bma_test_metrics = test_bma(net, test_loader, samples_dir, nll_criterion=nll_criterion, device=device)
+  wandb.log({f'sgld/test/bma_{k}': v for k, v in bma_test_metrics.items() })
+  wandb.run.summary['sgld/test/bma_acc'] = bma_test_metrics['acc']
+
+  logging.info(f"SGLD BMA: {wandb.run.summary['sgld/test/bma_acc']:.4f}")
+
+
+def run_csgld(train_loader, test_loader, net, criterion, samples_dir, K=1, device=None,
+              lr=1e-2, momentum=.9, temperature=1, n_samples=20, n_cycles=1,
+              epochs=1, nll_criterion=None):
+  N = train_loader.n
+
+  sgld = SGLD(net.parameters(), lr=lr, momentum=momentum, temperature=temperature)
+  sgld_scheduler = CosineLR(sgld, n_cycles=n_cycles, n_samples=n_samples,
+                            T_max=len(train_loader) * epochs)
+  energy_fn = make_energy_fn(net, criterion, N, K)
+
+  for e in tqdm(range(epochs)):
+    net.train()
+    for i, (F, Y) in enumerate(train_loader):
+      noise = sgld_scheduler.get_last_beta() >= sgld_scheduler.beta
+
+      sgld.zero_grad()
+
+      loss = energy_fn(F, Y)
+
+      loss.backward()
+
+      sgld.step(noise=noise)
+
+      if noise and sgld_scheduler.should_sample():
+        torch.save(net.state_dict(), samples_dir / f's_e{e}_m{i}.pt')
+
+      sgld_scheduler.step()
+
+    test_metrics = test(test_loader, net, criterion, device=device)
+    wandb.log({f'csgld/test/{k}': v for k, v in test_metrics.items() }, step=e)
+
+  bma_test_metrics = test_bma(net, test_loader, samples_dir, nll_criterion=nll_criterion, device=device)
+  wandb.log({f'csgld/test/bma_{k}': v for k, v in bma_test_metrics.items() })
+  wandb.run.summary['csgld/test/bma_acc'] = bma_test_metrics['acc']
+
+  logging.info(f"cSGLD BMA: {wandb.run.summary['csgld/test/bma_acc']:.4f}")
+
+
+def main(seed=None, device=0, data_dir=None, ckpt_path=None, feature_cache=None, label_noise=0, dataset='cifar10',
+         batch_size=128, dirty_lik=True, prior_scale=1, aug_scale=1, n_aug=0,
+         noise=1e-4, likelihood='softmax', likelihood_temp=1, logits_temp=1,
+         sgld_epochs=0, sgld_lr=1e-6, momentum=.9, temperature=1, burn_in=0, n_samples=20, n_cycles=0):
+  '''
+  SGLD/cSGLD over the last linear layer of a trained ResNet18 (FRN), on its
+  penultimate features. The features of the training set (clean, plus n_aug
+  fixed augmentations per image that enter the augmented likelihood as in
+  train_aug_lik.py) and of the test set are computed once and cached under
+  feature_cache (default: next to ckpt_path).
+  '''
+  if data_dir is None and os.environ.get('DATADIR') is not None:
+    data_dir = os.environ.get('DATADIR')
+  ckpt_path = Path(ckpt_path).resolve()
+  feature_cache = Path(feature_cache or ckpt_path.parent / 'features')
+
+  set_seeds(seed)
+  device = f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
+
+  wandb.init(config={
+    'seed': seed,
+    'dataset': dataset,
+    'batch_size': batch_size,
+    'prior_scale': prior_scale,
+    'aug_scale': aug_scale,
+    'n_aug': n_aug,
+    'dirty_lik': dirty_lik,
+    'temperature': temperature,
+    'burn_in': burn_in,
+    'sgld_lr': sgld_lr,
+    'dir_noise': noise,
+    'likelihood': likelihood,
+    'likelihood_T': likelihood_temp,
+    'logits_temp': logits_temp,
+    'last_layer': True,
+  })
+
+  samples_dir = Path(wandb.run.dir) / 'samples'
+  samples_dir.mkdir()
+
+  get_data = { 'cifar10': get_cifar10, 'tiny-imagenet': get_tiny_imagenet }[dataset]
+  train_data, test_data = get_data(root=data_dir, label_noise=label_noise, augment=False)
+
+  if dirty_lik:
+    trunk = ResNet18(num_classes=train_data.total_classes)
+  else:
+    trunk = ResNet18FRN(num_classes=train_data.total_classes)
+  trunk.load_state_dict(torch.load(ckpt_path, map_location='cpu'))
+  trunk = trunk.to(device)
+
+  name = f'{dataset}-noise{label_noise}'
+  start = time.perf_counter()
+  F, Y = feature_bank(trunk, train_data, f'{name}-train', feature_cache, device=device)
+  if n_aug:
+    aug_data, _ = get_data(root=data_dir, label_noise=label_noise, augment=True)
+    F_aug, _ = feature_bank(trunk, aug_data, f'{name}-train-aug', feature_cache, n_views=n_aug, device=device)
+    F = torch.cat([F, F_aug], dim=1)
+  F_test, Y_test = feature_bank(trunk, test_data, f'{dataset}-test', feature_cache, device=device)
+  wandb.run.summary['feature_time'] = time.perf_counter() - start
+
+  train_loader = TensorLoader(TensorDataset(F, Y), batch_size=batch_size, shuffle=True, device=device)
+  test_loader = TensorLoader(TensorDataset(F_test[:, 0], Y_test), batch_size=1024, device=device)
+
+  ## The head starts from the trained last layer. Losses get a list, so the
+  ## prior is evaluated on every step.
+  net = nn.Linear(F.size(-1), train_data.total_classes).to(device)
+  net.load_state_dict(head(trunk).state_dict())
+  params = list(net.parameters())
+  K = train_data.total_augs
+
+  nll_criterion = None
+  if likelihood == 'dirichlet':
+    criterion = KLAugmentedNoisyDirichletLoss(params, num_classes=train_data.total_classes, noise=noise,
+                                              likelihood_temp=likelihood_temp,
+                                              prior_scale=prior_scale, aug_scale=aug_scale)
+    nll_criterion = NoisyDirichletLoss(params, num_classes=train_data.total_classes, noise=noise,
+                                       likelihood_temp=likelihood_temp, reduction=None)
+  elif likelihood == 'softmax':
+    criterion = GaussianPriorAugmentedCELoss(params, likelihood_temp=likelihood_temp,
+                                             prior_scale=prior_scale, aug_scale=aug_scale, logits_temp=logits_temp)
+  else:
+    raise NotImplementedError
+
+  start = time.perf_counter()
+  if sgld_epochs:
+    if n_cycles:
+      run_csgld(train_loader, test_loader, net, criterion, samples_dir, K=K, device=device, nll_criterion=nll_criterion,
+                lr=sgld_lr, momentum=momentum, temperature=temperature, n_samples=n_samples, n_cycles=n_cycles, epochs=sgld_epochs)
+    else:
+      run_sgld(train_loader, test_loader, net, criterion, samples_dir, K=K, device=device, nll_criterion=nll_criterion,
+                lr=sgld_lr, momentum=momentum, temperature=temperature, burn_in=burn_in, n_samples=n_samples, epochs=sgld_epochs)
+  wandb.run.summary['sampling_time'] = time.perf_counter() - start
+
+
+if __name__ == '__main__':
+  import fire
+  import os
+
+  logging.getLogger().setLevel(logging.INFO)
+
+  os.environ['WANDB_MODE'] = os.environ.get('WANDB_MODE', default='dryrun')
+  fire.Fire(main)
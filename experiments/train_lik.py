@@ -1,4 +1,6 @@
+import copy
 import logging
+import time
 from pathlib import Path
 from tqdm.auto import tqdm
 import wandb
@@ -7,10 +9,20 @@ from torch.utils.data import DataLoader
 from torch.optim import SGD
 from torch.optim.lr_scheduler import CosineAnnealingLR
 
-from data_aug.optim import SGLD
+from data_aug.optim import (
+    SGLD,
+    CompiledSGLDStep,
+    TrajectoryCollector,
+    Subspace,
+    SubspaceModel,
+    SWAGCollector,
+    bn_update,
+)
 from data_aug.optim.lr_scheduler import CosineLR
 from data_aug.utils import set_seeds
-from data_aug.models import ResNet18, ResNet18FRN, ResNet18Fixup, LeNet
+from data_aug.data import TensorLoader, Prefetcher, eval_loader
+from data_aug.data.autotune import tuned_loader_kwargs
+from data_aug.models import ResNet18, ResNet18FRN, ResNet18Fixup, LeNet, prepare_model, load_sample
 from data_aug.models.mlp import MLP
 from data_aug.datasets import (
     get_cifar10,
@@ -53,31 +65,23 @@ def test(data_loader, net, criterion, device=None):
 
 
 @torch.no_grad()
-def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
-    net.eval()
-
-    ens_logits = []
-    ens_nll = []
-
-    for sample_path in tqdm(Path(samples_dir).rglob("*.pt"), leave=False):
-        net.load_state_dict(torch.load(sample_path))
-
-        all_logits = []
-        all_Y = []
-        all_nll = torch.tensor(0.0).to(device)
-        for X, Y in tqdm(data_loader, leave=False):
-            X, Y = X.to(device), Y.to(device)
-            _logits = net(X)
-            all_logits.append(_logits)
-            all_Y.append(Y)
-            if nll_criterion is not None:
-                all_nll += nll_criterion(_logits, Y)
-        all_logits = torch.cat(all_logits)
-        all_Y = torch.cat(all_Y)
+def predict(model, data_loader, nll_criterion=None, device=None):
+    """Logits of model on data_loader, the summed nll_criterion and the labels."""
+    all_logits = []
+    all_Y = []
+    all_nll = torch.tensor(0.0).to(device)
+    for X, Y in tqdm(data_loader, leave=False):
+        X, Y = X.to(device), Y.to(device)
+        _logits = model(X)
+        all_logits.append(_logits)
+        all_Y.append(Y)
+        if nll_criterion is not None:
+            all_nll += nll_criterion(_logits, Y)
+    return torch.cat(all_logits), all_nll, torch.cat(all_Y)
 
-        ens_logits.append(all_logits)
-        ens_nll.append(all_nll)
 
+def ensemble_metrics(ens_logits, ens_nll, all_Y):
+    """BMA metrics of the per-sample logits and nll (as from predict)."""
     ens_logits = torch.stack(ens_logits)
     ens_nll = torch.stack(ens_nll)
 
@@ -96,6 +100,60 @@ def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None):
     return {"acc": acc, "nll": nll, "ce_nll": ce_nll}
 
 
+@torch.no_grad()
+def test_bma(net, data_loader, samples_dir, nll_criterion=None, device=None, export=True):
+    net.eval()
+
+    ens_logits = []
+    ens_nll = []
+
+    for sample_path in tqdm(Path(samples_dir).rglob("*.pt"), leave=False):
+        ## No sample cache during training: it would hold memory next to the chain.
+        model = load_sample(net, sample_path, export=export, cache=False)
+
+        all_logits, all_nll, all_Y = predict(
+            model, data_loader, nll_criterion=nll_criterion, device=device
+        )
+        ens_logits.append(all_logits)
+        ens_nll.append(all_nll)
+
+    return ensemble_metrics(ens_logits, ens_nll, all_Y)
+
+
+@torch.no_grad()
+def test_swag(
+    net,
+    swag,
+    data_loader,
+    train_loader,
+    n_samples=20,
+    bn_batches=50,
+    nll_criterion=None,
+    device=None,
+):
+    """test_bma over n_samples drawn from swag, refreshing BatchNorm
+    statistics on bn_batches training batches for each. net is restored."""
+    state_dict = copy.deepcopy(net.state_dict())
+
+    ens_logits = []
+    ens_nll = []
+
+    for _ in tqdm(range(n_samples), leave=False):
+        swag.sample_into(net)
+        bn_update(net, train_loader, n_batches=bn_batches, device=device)
+        net.eval()
+
+        all_logits, all_nll, all_Y = predict(
+            net, data_loader, nll_criterion=nll_criterion, device=device
+        )
+        ens_logits.append(all_logits)
+        ens_nll.append(all_nll)
+
+    net.load_state_dict(state_dict)
+
+    return ensemble_metrics(ens_logits, ens_nll, all_Y)
+
+
 @torch.no_grad()
 def get_log_p(data_loader, net, logits_temp, device=None):
     net.eval()
@@ -122,6 +180,7 @@ def run_sgd(
     lr=1e-2,
     momentum=0.9,
     epochs=1,
+    collectors=(),
 ):
     train_data = train_loader.dataset
     N = len(train_data)
@@ -153,8 +212,17 @@ def run_sgd(
                 }
                 wandb.log({f"sgd/train/{k}": v for k, v in metrics.items()}, step=e)
 
+        if isinstance(train_loader, Prefetcher):
+            wandb.log(
+                {f"sgd/train/data_{k}": v for k, v in train_loader.stats.items()},
+                step=e,
+            )
+
         sgd_scheduler.step()
 
+        for collector in collectors:
+            collector.collect(net)
+
         test_metrics = test(test_loader, net, criterion, device=device)
 
         wandb.log({f"sgd/test/{k}": v for k, v in test_metrics.items()}, step=e)
@@ -186,26 +254,36 @@ def run_sgld(
     n_samples=20,
     epochs=1,
     nll_criterion=None,
+    compile_step=False,
 ):
     train_data = train_loader.dataset
     N = len(train_data)
 
     sgld = SGLD(net.parameters(), lr=lr, momentum=momentum, temperature=temperature)
     sample_int = (epochs - burn_in) // n_samples
+    ## Subspace samples are coordinates (plus buffers), evaluated through the subspace.
+    export = not isinstance(net, SubspaceModel)
+
+    sgld_step = None
+    if compile_step:
+        sgld_step = CompiledSGLDStep(sgld, lambda X, Y: criterion(net(X), Y, N=N))
 
     for e in tqdm(range(epochs)):
         net.train()
         for i, (X, Y) in tqdm(enumerate(train_loader), leave=False):
             X, Y = X.to(device), Y.to(device)
 
-            sgld.zero_grad()
+            if sgld_step is not None:
+                loss = sgld_step(X, Y)
+            else:
+                sgld.zero_grad()
 
-            f_hat = net(X)
-            loss = criterion(f_hat, Y, N=N)
+                f_hat = net(X)
+                loss = criterion(f_hat, Y, N=N)
 
-            loss.backward()
+                loss.backward()
 
-            sgld.step()
+                sgld.step()
 
             if i % 50 == 0:
                 metrics = {
@@ -215,6 +293,12 @@ def run_sgld(
                 }
                 wandb.log({f"sgld/train/{k}": v for k, v in metrics.items()}, step=e)
 
+        if isinstance(train_loader, Prefetcher):
+            wandb.log(
+                {f"sgld/train/data_{k}": v for k, v in train_loader.stats.items()},
+                step=e,
+            )
+
         test_metrics = test(test_loader, net, criterion, device=device)
         wandb.log({f"sgld/test/{k}": v for k, v in test_metrics.items()}, step=e)
 
@@ -230,13 +314,19 @@ def run_sgld(
                 samples_dir,
                 nll_criterion=nll_criterion,
                 device=device,
+                export=export,
             )
             wandb.log({f"sgld/test/bma_{k}": v for k, v in bma_test_metrics.items()})
 
             logging.info(f"SGLD BMA (Epoch {e}): {bma_test_metrics['acc']:.4f}")
 
     bma_test_metrics = test_bma(
-        net, test_loader, samples_dir, nll_criterion=nll_criterion, device=device
+        net,
+        test_loader,
+        samples_dir,
+        nll_criterion=nll_criterion,
+        device=device,
+        export=export,
     )
     wandb.log({f"sgld/test/bma_{k}": v for k, v in bma_test_metrics.items()})
     wandb.run.summary["sgld/test/bma_acc"] = bma_test_metrics["acc"]
@@ -260,6 +350,7 @@ def run_csgld(
     n_cycles=1,
     epochs=1,
     nll_criterion=None,
+    compile_step=False,
 ):
     train_data = train_loader.dataset
     N = len(train_data)
@@ -269,24 +360,30 @@ def run_csgld(
         sgld, n_cycles=n_cycles, n_samples=n_samples, T_max=len(train_loader) * epochs
     )
 
+    sgld_step = None
+    if compile_step:
+        sgld_step = CompiledSGLDStep(sgld, lambda X, Y: criterion(net(X), Y, N=N))
+
     for e in tqdm(range(epochs)):
         net.train()
 
         for i, (X, Y) in tqdm(enumerate(train_loader), leave=False):
             X, Y = X.to(device), Y.to(device)
 
-            sgld.zero_grad()
+            noise = sgld_scheduler.get_last_beta() >= sgld_scheduler.beta
+            if sgld_step is not None:
+                loss = sgld_step(X, Y, noise=noise)
+            else:
+                sgld.zero_grad()
 
-            f_hat = net(X)
-            loss = criterion(f_hat, Y, N=N)
+                f_hat = net(X)
+                loss = criterion(f_hat, Y, N=N)
 
-            loss.backward()
+                loss.backward()
 
-            if sgld_scheduler.get_last_beta() < sgld_scheduler.beta:
-                sgld.step(noise=False)
-            else:
-                sgld.step()
+                sgld.step(noise=noise)
 
+            if noise:
                 if sgld_scheduler.should_sample():
                     torch.save(net.state_dict(), samples_dir / f"s_e{e}_m{i}.pt")
                     wandb.save("samples/*.pt")
@@ -300,6 +397,12 @@ def run_csgld(
 
             sgld_scheduler.step()
 
+        if isinstance(train_loader, Prefetcher):
+            wandb.log(
+                {f"csgld/train/data_{k}": v for k, v in train_loader.stats.items()},
+                step=e,
+            )
+
         # log_p_train = get_log_p(train_loader, net, device=device)
         log_p_test = get_log_p(test_loader, net, logits_temp, device=device)
         # nll_train = log_p_train.mean().item()
@@ -333,6 +436,22 @@ def main(
     augment=True,
     replacement=False,
     perm=False,
+    perm_seed=1,
+    in_memory=False,
+    tensor_loader=False,
+    eval_cache=None,
+    prefetch=0,
+    channels_last=False,
+    compile=False,
+    compile_step=False,
+    subspace=None,
+    subspace_dim=10,
+    subspace_start=None,
+    swag=False,
+    swag_start=None,
+    swag_rank=20,
+    swag_samples=20,
+    swag_bn_batches=50,
     noise=0.1,
     likelihood="softmax",
     likelihood_temp=1,
@@ -354,6 +473,21 @@ def main(
 
     torch.backends.cudnn.benchmark = True
 
+    if subspace not in (None, "pca", "random"):
+        raise ValueError(f"Unknown subspace {subspace!r}, expected 'pca' or 'random'.")
+    if subspace == "pca":
+        start = epochs // 2 if subspace_start is None else subspace_start
+        if epochs - start < 2:
+            raise ValueError(
+                f"--subspace=pca needs at least two SGD epochs after --subspace_start "
+                f"to build the subspace, got epochs={epochs} and subspace_start={start}."
+            )
+    if swag and epochs - (epochs // 2 if swag_start is None else swag_start) < 1:
+        raise ValueError(
+            f"--swag needs at least one SGD epoch after --swag_start, got epochs={epochs} "
+            f"and swag_start={swag_start}."
+        )
+
     set_seeds(seed)
     device = f"cuda:{device}" if (device >= 0 and torch.cuda.is_available()) else "cpu"
 
@@ -373,6 +507,10 @@ def main(
             "likelihood": likelihood,
             "likelihood_T": likelihood_temp,
             "logits_temp": logits_temp,
+            "subspace": subspace,
+            "subspace_dim": subspace_dim,
+            "swag": swag,
+            "swag_rank": swag_rank,
         }
     )
 
@@ -387,11 +525,19 @@ def main(
         )
     elif dataset == "cifar10":
         train_data, test_data = get_cifar10(
-            root=data_dir, augment=bool(augment), label_noise=label_noise
+            root=data_dir,
+            augment=bool(augment),
+            label_noise=label_noise,
+            in_memory=in_memory,
         )
     elif dataset == "mnist":
         train_data, test_data = get_mnist(
-            root=data_dir, augment=bool(augment), label_noise=label_noise, perm=perm
+            root=data_dir,
+            augment=bool(augment),
+            label_noise=label_noise,
+            perm=perm,
+            perm_seed=perm_seed,
+            in_memory=in_memory,
         )
     else:
         raise NotImplementedError
@@ -399,11 +545,27 @@ def main(
     if type(augment) is not bool and augment != "true":
         train_data = prepare_transforms(augment=augment, train_data=train_data)
         # train_data.transform = prepare_transforms(augment=augment)
+    ## Batched datasets keep per-step augmentation on the device-resident
+    ## path; others only when their transform is deterministic.
+    use_tensor_loader = getattr(train_data, "batched", False) or not augment
+    loader_kwargs = tuned_loader_kwargs(
+        ("train_lik", dataset, augment, dirty_lik, batch_size)
+    )
+    if tensor_loader and use_tensor_loader:
+        train_loader = TensorLoader(
+            train_data, batch_size=batch_size, shuffle=True, device=device
+        )
+        test_loader = TensorLoader(test_data, batch_size=batch_size, device=device)
     else:
         train_loader = DataLoader(
-            train_data, batch_size=batch_size, num_workers=2, shuffle=True
+            train_data, batch_size=batch_size, shuffle=True, **loader_kwargs
+        )
+        test_loader = DataLoader(test_data, batch_size=batch_size, **loader_kwargs)
+    if eval_cache:
+        test_name = f"{dataset}-test" + (f"-perm{perm_seed}" if perm else "")
+        test_loader = eval_loader(
+            test_data, test_name, eval_cache, batch_size=batch_size, device=device
         )
-        test_loader = DataLoader(test_data, batch_size=batch_size, num_workers=2)
     if replacement:
         from torch.utils.data import RandomSampler
         from torch.utils.data import Subset
@@ -415,10 +577,21 @@ def main(
             np.arange(0, n_train, 1), int(n_train * 0.01), replace=False
         )
         subset_train = Subset(train_data, idx)
-        sampler = RandomSampler(subset_train, replacement=True, num_samples=n_train)
-        train_loader = DataLoader(
-            subset_train, batch_size=batch_size, num_workers=2, sampler=sampler
-        )
+        if tensor_loader and use_tensor_loader:
+            train_loader = TensorLoader(
+                subset_train,
+                batch_size=batch_size,
+                replacement=True,
+                num_samples=n_train,
+                device=device,
+            )
+        else:
+            sampler = RandomSampler(
+                subset_train, replacement=True, num_samples=n_train
+            )
+            train_loader = DataLoader(
+                subset_train, batch_size=batch_size, sampler=sampler, **loader_kwargs
+            )
     if dirty_lik == "mlp":
         from torch.utils.data import RandomSampler
         from torch.utils.data import Subset
@@ -428,11 +601,18 @@ def main(
         n_train = train_data.targets.shape[0]
         idx = np.random.choice(np.arange(0, n_train, 1), 50, replace=False)
         subset_train = Subset(train_data, idx)
-        sampler = RandomSampler(subset_train, replacement=False, num_samples=50)
-        train_loader = DataLoader(
-            subset_train, batch_size=batch_size, num_workers=2, sampler=sampler
-        )
+        if tensor_loader and use_tensor_loader:
+            train_loader = TensorLoader(
+                subset_train, batch_size=batch_size, shuffle=True, device=device
+            )
+        else:
+            sampler = RandomSampler(subset_train, replacement=False, num_samples=50)
+            train_loader = DataLoader(
+                subset_train, batch_size=batch_size, sampler=sampler, **loader_kwargs
+            )
         logits_temp = 0.1
+    if prefetch:
+        train_loader = Prefetcher(train_loader, device=device, depth=prefetch)
     if dirty_lik is True or dirty_lik == "std":
         net = ResNet18(num_classes=train_data.total_classes).to(device)
     elif dirty_lik is False or dirty_lik == "frn":
@@ -450,6 +630,7 @@ def main(
     if ckpt_path is not None and ckpt_path.is_file():
         net.load_state_dict(torch.load(ckpt_path))
         logging.info(f"Loaded {ckpt_path}")
+    net = prepare_model(net, channels_last=channels_last, compile=compile)
 
     nll_criterion = None
     if likelihood == "dirichlet":
@@ -477,7 +658,24 @@ def main(
     else:
         raise NotImplementedError
 
+    collectors = []
+    if subspace == "pca":
+        ## Snapshots of the second half of the SGD run by default.
+        trajectory = TrajectoryCollector(
+            start=epochs // 2 if subspace_start is None else subspace_start,
+            max_snapshots=2 * subspace_dim,
+        )
+        collectors.append(trajectory)
+    if swag:
+        ## SWAG moments over the second half of the SGD run by default.
+        swag_collector = SWAGCollector(
+            start=epochs // 2 if swag_start is None else swag_start,
+            max_rank=swag_rank,
+        )
+        collectors.append(swag_collector)
+
     if epochs:
+        start = time.perf_counter()
         run_sgd(
             train_loader,
             test_loader,
@@ -486,7 +684,44 @@ def main(
             device=device,
             lr=lr,
             epochs=epochs,
+            collectors=collectors,
+        )
+        wandb.run.summary["sgd/time"] = time.perf_counter() - start
+
+    if swag:
+        torch.save(swag_collector.state_dict(), Path(wandb.run.dir) / "swag.pt")
+        wandb.save("swag.pt")
+
+        start = time.perf_counter()
+        swag_metrics = test_swag(
+            net,
+            swag_collector,
+            test_loader,
+            train_loader,
+            n_samples=swag_samples,
+            bn_batches=swag_bn_batches,
+            nll_criterion=nll_criterion,
+            device=device,
         )
+        wandb.log({f"swag/test/bma_{k}": v for k, v in swag_metrics.items()})
+        wandb.run.summary["swag/test/bma_acc"] = swag_metrics["acc"]
+        wandb.run.summary["swag/test/time"] = time.perf_counter() - start
+
+        logging.info(f"SWAG BMA: {swag_metrics['acc']:.4f}")
+
+    if subspace:
+        if subspace == "pca":
+            space = Subspace.pca(net, trajectory.snapshots, subspace_dim)
+        else:
+            space = Subspace.random(net, subspace_dim, seed=seed or 0)
+        torch.save(space.state_dict(), Path(wandb.run.dir) / "subspace.pt")
+        wandb.save("subspace.pt")
+
+        net = SubspaceModel(net, space.to(device))
+        ## The prior is over the subspace coordinates.
+        criterion.theta = list(net.parameters())
+        if nll_criterion is not None:
+            nll_criterion.theta = criterion.theta
 
     if sgld_epochs:
         if n_cycles:
@@ -506,6 +741,7 @@ def main(
                 n_cycles=n_cycles,
                 epochs=sgld_epochs,
                 nll_criterion=nll_criterion,
+                compile_step=compile_step,
             )
         else:
             run_sgld(
@@ -522,6 +758,7 @@ def main(
                 n_samples=n_samples,
                 epochs=sgld_epochs,
                 nll_criterion=nll_criterion,
+                compile_step=compile_step,
             )
 
 
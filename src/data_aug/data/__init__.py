@@ -0,0 +1,7 @@
+from .memory import cache_key, read_idx, shared_array, UInt8Dataset
+from .augmix import AugMix
+from .aug_bank import write_aug_bank, AugBankDataset
+from .loader import TensorLoader
+from .eval_cache import eval_tensors, eval_loader
+from .prefetch import Prefetcher
+from . import transforms
@@ -0,0 +1,145 @@
+"""Fixed augmentation banks.
+
+A bank is a directory with
+
+  images.npy   uint8 (M x C x H x W), the augmented images
+  index.npy    int64 (M x 2), source index and target of each row
+
+written once by write_aug_bank (see experiments/make_aug_bank.py) and read
+through memory maps by AugBankDataset.
+"""
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+__all__ = [
+    "write_aug_bank",
+    "AugBankDataset",
+]
+
+
+@torch.no_grad()
+def write_aug_bank(dataset, out_dir, transform, n_aug=1, batch_size=1024, seed=0):
+    """Write n_aug augmentations of every image in dataset to out_dir.
+
+    dataset must provide decode(indices) returning uint8 (B x C x H x W)
+    images and (B,) targets, e.g. datasets.WrapperDataset or UInt8Dataset.
+    transform is a uint8 batch transform. Rows are grouped by source image,
+    so row r comes from source image r // n_aug.
+    """
+    out_dir = Path(out_dir)
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.{os.getpid()}.tmp")
+    tmp_dir.mkdir(parents=True)
+
+    N = len(dataset)
+    X, _ = dataset.decode([0])
+    images = np.lib.format.open_memmap(
+        tmp_dir / "images.npy", mode="w+", dtype=np.uint8, shape=(N * n_aug, *X.shape[1:])
+    )
+    index = np.empty((N * n_aug, 2), dtype=np.int64)
+
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+
+        for start in range(0, N, batch_size):
+            indices = torch.arange(start, min(start + batch_size, N))
+            X, Y = dataset.decode(indices)
+
+            X_aug = transform(X.unsqueeze(1).expand(-1, n_aug, *X.shape[1:]))
+            assert X_aug.dtype == torch.uint8, "Bank transforms must return uint8."
+
+            rows = slice(start * n_aug, (start + len(indices)) * n_aug)
+            images[rows] = X_aug.reshape(-1, *X_aug.shape[2:]).numpy()
+            index[rows, 0] = indices.repeat_interleave(n_aug).numpy()
+            index[rows, 1] = torch.as_tensor(Y).repeat_interleave(n_aug).numpy()
+
+    images.flush()
+    del images
+    np.save(tmp_dir / "index.npy", index)
+
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+    return out_dir
+
+
+class AugBankDataset(Dataset):
+    """Reads a bank written by write_aug_bank.
+
+    Nothing is read at construction: index and images are memory-mapped on
+    first access in each process, and batches are gathered straight from the
+    mapping.
+    """
+
+    batched = True
+
+    def __init__(self, bank_dir, transform=None):
+        super().__init__()
+
+        self.bank_dir = Path(bank_dir)
+        self.transform = transform
+
+        self._data = None
+        self._index = None
+
+    def _map(self, name):
+        return torch.from_numpy(np.load(self.bank_dir / name, mmap_mode="c"))
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._map("images.npy")
+        return self._data
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self._map("index.npy")
+        return self._index
+
+    @property
+    def source_indices(self):
+        return self.index[:, 0]
+
+    @property
+    def targets(self):
+        return self.index[:, 1]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = state["_index"] = None
+        return state
+
+    def decode(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        if len(indices) and bool((indices[1:] - indices[:-1] == 1).all()):
+            ## Contiguous rows are a view on the mapping.
+            X = self.data[int(indices[0]) : int(indices[-1]) + 1]
+        else:
+            X = self.data[indices]
+        return X, self.targets[indices]
+
+    def transform_batch(self, X, Y):
+        if self.transform is not None:
+            X = self.transform(X)
+        return X, Y
+
+    def get_batch(self, indices):
+        return self.transform_batch(*self.decode(indices))
+
+    def __getitems__(self, indices):
+        X, Y = self.get_batch(indices)
+        return list(zip(X, Y))
+
+    def __getitem__(self, i):
+        X, Y = self.get_batch([i])
+        return X[0], Y[0]
+
+    def __len__(self):
+        return len(self.index)
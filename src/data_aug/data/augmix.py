@@ -0,0 +1,212 @@
+"""AugMix on uint8 image batches.
+
+A tensor port of datasets.aug and the augmentations.py operators. Point
+operations (autocontrast, equalize, posterize, solarize) are lookup tables
+gathered per image and channel, geometric operations are one batched affine
+warp, and every image in a batch draws its own chains, operators, levels and
+Dirichlet/Beta mixing weights in single vectorized calls.
+"""
+import torch
+import torch.nn.functional as F
+from torch.distributions import Beta, Dirichlet
+
+
+__all__ = [
+    "AugMix",
+]
+
+
+def _sample_level(n, size):
+    return torch.empty(size).uniform_(0.1, n)
+
+
+def _random_sign(size):
+    return torch.where(torch.rand(size) > 0.5, -1.0, 1.0)
+
+
+def _apply_lut(x, lut):
+    """x is uint8 (B x C x H x W), lut is (B x C x 256) or (B x 1 x 256)."""
+    B, C, H, W = x.shape
+    lut = lut.expand(B, C, 256).to(x.device)
+    return lut.gather(-1, x.view(B, C, H * W).long()).view(B, C, H, W).to(torch.uint8)
+
+
+def _histogram(x):
+    B, C, H, W = x.shape
+    x = x.view(B, C, H * W).long()
+    hist = torch.zeros(B, C, 256, dtype=torch.long, device=x.device)
+    return hist.scatter_add_(-1, x, torch.ones_like(x))
+
+
+def autocontrast(x, _):
+    hist = _histogram(x)
+    levels = torch.arange(256, device=x.device)
+    present = hist > 0
+    lo = torch.where(present, levels, 256).amin(-1, keepdim=True)
+    hi = torch.where(present, levels, -1).amax(-1, keepdim=True)
+
+    ## Double precision to truncate exactly like PIL.ImageOps.autocontrast.
+    scale = 255.0 / (hi - lo).clamp(min=1).double()
+    lut = (levels * scale - lo * scale).long().clamp(0, 255)
+    lut = torch.where(hi > lo, lut, levels)
+    return _apply_lut(x, lut)
+
+
+def equalize(x, _):
+    hist = _histogram(x)
+    levels = torch.arange(256, device=x.device)
+
+    ## Same table as PIL.ImageOps.equalize, which ignores the last non-empty bin.
+    last = torch.where(hist > 0, levels, -1).amax(-1, keepdim=True)
+    step = (hist.sum(-1, keepdim=True) - hist.gather(-1, last.clamp(min=0))) // 255
+    n_bins = (hist > 0).sum(-1, keepdim=True)
+
+    cum = hist.cumsum(-1) - hist
+    lut = (step // 2 + cum) // step.clamp(min=1)
+    lut = torch.where((n_bins > 1) & (step > 0), lut.clamp(max=255), levels)
+    return _apply_lut(x, lut)
+
+
+def posterize(x, level):
+    bits = 4 - (_sample_level(level, x.size(0)) * 4 / 10).long()
+    mask = (~(2 ** (8 - bits) - 1)) & 0xFF
+    lut = torch.arange(256) & mask.view(-1, 1, 1)
+    return _apply_lut(x, lut)
+
+
+def solarize(x, level):
+    threshold = 256 - (_sample_level(level, x.size(0)) * 256 / 10).long()
+    levels = torch.arange(256)
+    lut = torch.where(levels < threshold.view(-1, 1, 1), levels, 255 - levels)
+    return _apply_lut(x, lut)
+
+
+def _affine(x, matrix):
+    """Bilinear warp with zero fill, like PIL.Image.transform(..., Image.AFFINE).
+
+    matrix is (B x 2 x 3) in PIL convention, mapping output pixel coordinates
+    to input pixel coordinates.
+    """
+    B, C, H, W = x.shape
+    a, b, c = matrix[:, 0].unbind(-1)
+    d, e, f = matrix[:, 1].unbind(-1)
+
+    ## Convert from pixel coordinates to the [-1, 1] convention of affine_grid.
+    theta = torch.stack(
+        [
+            torch.stack([a, b * H / W, (a + b * H / W + 2 * c / W - 1)], -1),
+            torch.stack([d * W / H, e, (d * W / H + e + 2 * f / H - 1)], -1),
+        ],
+        1,
+    ).to(x.device)
+
+    grid = F.affine_grid(theta, [B, C, H, W], align_corners=False)
+    out = F.grid_sample(x.float(), grid, mode="bilinear", align_corners=False)
+    return out.round_().clamp_(0, 255).to(torch.uint8)
+
+
+def _identity_matrix(B):
+    return torch.eye(2, 3).repeat(B, 1, 1)
+
+
+def rotate(x, level):
+    B, _, H, W = x.shape
+    degrees = (_sample_level(level, B) * 30 / 10).long() * _random_sign(B)
+
+    t = -torch.deg2rad(degrees)
+    cx, cy = W / 2.0, H / 2.0
+    m = _identity_matrix(B)
+    m[:, 0, 0], m[:, 0, 1] = t.cos(), t.sin()
+    m[:, 1, 0], m[:, 1, 1] = -t.sin(), t.cos()
+    m[:, 0, 2] = -m[:, 0, 0] * cx - m[:, 0, 1] * cy + cx
+    m[:, 1, 2] = -m[:, 1, 0] * cx - m[:, 1, 1] * cy + cy
+    return _affine(x, m)
+
+
+def shear_x(x, level):
+    m = _identity_matrix(x.size(0))
+    m[:, 0, 1] = _sample_level(level, x.size(0)) * 0.3 / 10 * _random_sign(x.size(0))
+    return _affine(x, m)
+
+
+def shear_y(x, level):
+    m = _identity_matrix(x.size(0))
+    m[:, 1, 0] = _sample_level(level, x.size(0)) * 0.3 / 10 * _random_sign(x.size(0))
+    return _affine(x, m)
+
+
+def translate_x(x, level):
+    m = _identity_matrix(x.size(0))
+    shift = (_sample_level(level, x.size(0)) * (x.size(-1) / 3) / 10).long()
+    m[:, 0, 2] = shift * _random_sign(x.size(0))
+    return _affine(x, m)
+
+
+def translate_y(x, level):
+    m = _identity_matrix(x.size(0))
+    shift = (_sample_level(level, x.size(0)) * (x.size(-2) / 3) / 10).long()
+    m[:, 1, 2] = shift * _random_sign(x.size(0))
+    return _affine(x, m)
+
+
+augmentations = [
+    autocontrast, equalize, posterize, rotate, solarize, shear_x, shear_y,
+    translate_x, translate_y
+]
+
+
+class AugMix:
+    """Batched counterpart of datasets.aug.
+
+    Takes uint8 (... x C x H x W) images and returns normalized float images.
+    Normalization is applied once to the mixture, since it commutes with the
+    convex combination of the chains.
+    """
+
+    def __init__(
+        self,
+        mean,
+        std,
+        mixture_width=3,
+        mixture_depth=1,
+        aug_severity=3,
+        ops=augmentations,
+    ):
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+        self.mixture_width = mixture_width
+        self.mixture_depth = mixture_depth
+        self.aug_severity = aug_severity
+        self.ops = ops
+
+    def _chain(self, x):
+        depth = self.mixture_depth
+        if depth <= 0:
+            depth = torch.randint(1, 4, (x.size(0),))
+        else:
+            depth = torch.full((x.size(0),), depth)
+
+        x = x.clone()
+        for d in range(int(depth.max())):
+            op_idx = torch.randint(len(self.ops), (x.size(0),))
+            op_idx[depth <= d] = -1
+            for k, op in enumerate(self.ops):
+                sel = (op_idx == k).nonzero().squeeze(-1).to(x.device)
+                if len(sel):
+                    x[sel] = op(x[sel], self.aug_severity)
+        return x
+
+    def __call__(self, x):
+        shape = x.shape
+        x = x.reshape(-1, *shape[-3:])
+        B, w = x.size(0), self.mixture_width
+
+        ws = Dirichlet(torch.ones(w)).sample((B,)).to(x.device)
+        m = Beta(torch.ones(1), torch.ones(1)).sample((B,)).to(x.device)
+
+        chains = self._chain(x.repeat_interleave(w, dim=0)).view(B, w, *x.shape[1:])
+        mix = (ws.view(B, w, 1, 1, 1) * chains.float()).sum(dim=1)
+        mixed = ((1 - m.view(B, 1, 1, 1)) * x.float() + m.view(B, 1, 1, 1) * mix) / 255.0
+
+        mixed = (mixed - self.mean.to(x.device)) / self.std.to(x.device)
+        return mixed.view(*shape[:-3], *mixed.shape[1:])
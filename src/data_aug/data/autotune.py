@@ -0,0 +1,210 @@
+"""DataLoader autotuning.
+
+autotune times short training passes (forward and backward of the actual
+model) over a grid of DataLoader workers, DataLoader prefetch_factor and
+intra-op threads, within the CPUs available to the process. The best
+configuration is stored per host and workload under
+
+  $DATA_AUG_CACHE_DIR/autotune/   (default ~/.cache/data_aug/autotune/)
+
+and tuned_loader_kwargs hands it to the training scripts.
+"""
+import itertools
+import json
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+
+import torch
+from torch.utils.data import DataLoader
+
+from .memory import cache_key
+
+
+__all__ = [
+    "autotune",
+    "format_table",
+    "load_tuned",
+    "tuned_loader_kwargs",
+]
+
+
+def _cache_dir():
+    cache_dir = os.environ.get("DATA_AUG_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = Path.home() / ".cache" / "data_aug"
+    cache_dir = Path(cache_dir) / "autotune"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def _n_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def _path(workload, max_cpus=None):
+    host = f"{socket.gethostname()}-{max_cpus or _n_cpus()}"
+    return _cache_dir() / f"{host}-{cache_key(*workload)}.json"
+
+
+def _powers_of_two(n):
+    return [2**i for i in range(n.bit_length()) if 2**i <= n]
+
+
+def _step(net, batch, device):
+    *inputs, _ = batch
+
+    net.zero_grad()
+    for X in inputs:
+        X = X.to(device, non_blocking=True)
+        if X.dim() == 5:
+            X = X.flatten(0, 1)
+        net(X).float().logsumexp(dim=-1).mean().backward()
+
+
+def _measure(dataset, net, batch_size, device, n_batches, warmup, **loader_kwargs):
+    loader = DataLoader(
+        dataset, batch_size=batch_size, shuffle=True, drop_last=True, **loader_kwargs
+    )
+
+    wait = 0.0
+    batches = iter(loader)
+    for i in range(warmup + n_batches):
+        if i == warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start, wait = time.perf_counter(), 0.0
+
+        t0 = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            batches = iter(loader)
+            batch = next(batches)
+        wait += time.perf_counter() - t0
+
+        _step(net, batch, device)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    del batches
+
+    return n_batches * batch_size / elapsed, wait / elapsed
+
+
+def autotune(
+    dataset,
+    net,
+    workload,
+    batch_size=128,
+    device=None,
+    workers=None,
+    prefetch=(2, 4),
+    threads=None,
+    max_cpus=None,
+    n_batches=10,
+    warmup=3,
+):
+    """Benchmark loader configurations and cache the fastest for workload.
+
+    workload is a tuple identifying dataset, transform, model and batch size
+    (see tuned_loader_kwargs). Combinations whose workers and threads exceed
+    max_cpus (default: the CPUs this process may run on) are skipped.
+    Returns the best configuration and the table of all measurements.
+    """
+    device = torch.device(device or "cpu")
+    max_cpus = max_cpus or _n_cpus()
+    workers = workers or [0] + _powers_of_two(max_cpus - 1)
+    threads = threads or _powers_of_two(max_cpus)
+
+    net = net.to(device).train()
+    num_threads = torch.get_num_threads()
+
+    table = []
+    for w, t in itertools.product(workers, threads):
+        if w > 0 and w + t > max_cpus:
+            continue
+        for p in prefetch if w > 0 else [None]:
+            torch.set_num_threads(t)
+            throughput, wait = _measure(
+                dataset,
+                net,
+                batch_size,
+                device,
+                n_batches,
+                warmup,
+                num_workers=w,
+                prefetch_factor=p,
+            )
+            table.append(
+                {
+                    "num_workers": w,
+                    "prefetch_factor": p,
+                    "num_threads": t,
+                    "throughput": throughput,
+                    "data_wait": wait,
+                }
+            )
+            logging.debug(table[-1])
+
+    torch.set_num_threads(num_threads)
+
+    best = max(table, key=lambda row: row["throughput"])
+    config = {k: best[k] for k in ["num_workers", "prefetch_factor", "num_threads"]}
+
+    path = _path(workload, max_cpus=max_cpus)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {"workload": [str(p) for p in workload], "config": config, "table": table},
+            f,
+            indent=2,
+        )
+    os.replace(tmp_path, path)
+
+    return config, table
+
+
+def format_table(table):
+    lines = [
+        f"{'workers':>8} {'prefetch':>8} {'threads':>8} {'img/s':>10} {'data wait':>10}"
+    ]
+    for row in sorted(table, key=lambda row: -row["throughput"]):
+        lines.append(
+            f"{row['num_workers']:>8} {str(row['prefetch_factor']):>8} "
+            f"{row['num_threads']:>8} {row['throughput']:>10.1f} "
+            f"{row['data_wait']:>10.1%}"
+        )
+    return "\n".join(lines)
+
+
+def load_tuned(workload, max_cpus=None):
+    """Cached configuration for workload on this host, or None."""
+    path = _path(workload, max_cpus=max_cpus)
+    if not path.is_file():
+        return None
+    with open(path) as f:
+        return json.load(f)["config"]
+
+
+def tuned_loader_kwargs(workload, default_workers=2):
+    """DataLoader kwargs for workload, applying the tuned thread count.
+
+    Without a cached result for this host, returns num_workers=default_workers
+    and leaves the torch thread pool alone.
+    """
+    config = load_tuned(workload)
+    if config is None:
+        return {"num_workers": default_workers}
+
+    logging.info(f"Using tuned loader configuration {config}")
+    torch.set_num_threads(config["num_threads"])
+    return {
+        "num_workers": config["num_workers"],
+        "prefetch_factor": config["prefetch_factor"],
+    }
@@ -0,0 +1,79 @@
+"""Evaluation sets materialized once on disk.
+
+The transformed inputs and targets of an evaluation set are written once
+as float32/int64 .npy files named by a fingerprint of the dataset and its
+transform, then memory-mapped by every run and every evaluation pass of a
+sweep that points at the same cache directory.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from .loader import TensorLoader
+from .memory import cache_key
+
+
+__all__ = [
+    "eval_tensors",
+    "eval_loader",
+]
+
+
+def _fingerprint(dataset, name):
+    transform = getattr(dataset, "transform", None)
+    return cache_key(name, type(dataset).__name__, len(dataset), repr(transform))
+
+
+@torch.no_grad()
+def _write(dataset, x_path, y_path, batch_size=1024, num_workers=2):
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+
+    X_out, Y = None, []
+    start = 0
+    for X, _Y in loader:
+        if X_out is None:
+            tmp_path = x_path.with_suffix(f".{os.getpid()}.tmp")
+            X_out = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=np.float32, shape=(len(dataset), *X.shape[1:])
+            )
+        X_out[start : start + len(X)] = X.numpy()
+        Y.append(torch.as_tensor(_Y))
+        start += len(X)
+
+    X_out.flush()
+    del X_out
+    ## Y first: X appearing marks the entry complete.
+    y_tmp_path = y_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(y_tmp_path, "wb") as f:
+        np.save(f, torch.cat(Y).long().numpy())
+    os.replace(y_tmp_path, y_path)
+    os.replace(tmp_path, x_path)
+
+
+def eval_tensors(dataset, name, cache_dir):
+    """Memory-mapped (X, Y) of the transformed dataset, built on first use.
+
+    name identifies the data (e.g. "cifar10-test"); the dataset class, size
+    and transform are added to the fingerprint. Transforms must be
+    deterministic for the cache to be meaningful.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    key = f"{name}-{_fingerprint(dataset, name)}"
+    x_path, y_path = cache_dir / f"{key}-X.npy", cache_dir / f"{key}-Y.npy"
+    if not x_path.is_file():
+        _write(dataset, x_path, y_path)
+
+    X = torch.from_numpy(np.load(x_path, mmap_mode="c"))
+    Y = torch.from_numpy(np.load(y_path, mmap_mode="c"))
+    return X, Y
+
+
+def eval_loader(dataset, name, cache_dir, batch_size=1024, device=None):
+    """TensorLoader over the cached tensors, in order and in contiguous batches."""
+    X, Y = eval_tensors(dataset, name, cache_dir)
+    return TensorLoader(TensorDataset(X, Y), batch_size=batch_size, device=device)
@@ -0,0 +1,101 @@
+"""Penultimate-layer features of a fixed network, materialized once on disk.
+
+The inputs to the final linear layer of a trained network are computed once
+over a dataset, for the untransformed inputs or for K augmented views drawn
+with a fixed seed, and stored as float32 .npy files named by a fingerprint
+of the network weights, the dataset and its transform. Runs that only sample
+the last layer (experiments/train_last_layer.py) memory-map them.
+"""
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from .memory import cache_key
+
+
+__all__ = [
+    "head",
+    "extract_features",
+    "feature_bank",
+]
+
+
+def head(net):
+    """The final linear layer of net."""
+    return [m for m in net.modules() if isinstance(m, nn.Linear)][-1]
+
+
+def _weights_key(net):
+    digest = hashlib.sha1()
+    for k, v in net.state_dict().items():
+        digest.update(k.encode())
+        digest.update(v.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+
+@torch.no_grad()
+def extract_features(net, dataset, n_views=1, batch_size=512, device=None, seed=0, num_workers=2):
+    """Inputs of the final linear layer of net, [N, n_views, D], and targets.
+
+    Views are successive passes over dataset, so a random transform yields
+    n_views augmentations per input; the generator is seeded for each pass.
+    """
+    features = []
+    hook = head(net).register_forward_hook(
+        lambda module, inputs, output: features.append(inputs[0].float().cpu())
+    )
+
+    net.eval()
+    try:
+        views, Y = [], None
+        for v in range(n_views):
+            torch.manual_seed(seed + v)
+            loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+
+            features.clear()
+            _Y = []
+            for X, y in loader:
+                net(X.to(device))
+                _Y.append(torch.as_tensor(y))
+            views.append(torch.cat(features))
+            Y = torch.cat(_Y).long()
+    finally:
+        hook.remove()
+
+    return torch.stack(views, dim=1), Y
+
+
+def feature_bank(net, dataset, name, cache_dir, n_views=1, device=None, seed=0):
+    """Memory-mapped (features [N, n_views, D], Y) of net on dataset, built on
+    first use.
+
+    name identifies the data (e.g. "cifar10-train-aug"); the weights of net,
+    the dataset class, size and transform, n_views and seed are added to the
+    fingerprint.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    transform = getattr(dataset, "transform", None)
+    fingerprint = cache_key(
+        name, _weights_key(net), type(dataset).__name__, len(dataset), repr(transform), n_views, seed
+    )
+    key = f"{name}-{fingerprint}"
+    f_path, y_path = cache_dir / f"{key}-F.npy", cache_dir / f"{key}-Y.npy"
+
+    if not f_path.is_file():
+        features, Y = extract_features(net, dataset, n_views=n_views, device=device, seed=seed)
+        ## Y first: the features appearing mark the entry complete.
+        for path, array in [(y_path, Y.numpy()), (f_path, features.numpy())]:
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    features = torch.from_numpy(np.load(f_path, mmap_mode="c"))
+    Y = torch.from_numpy(np.load(y_path, mmap_mode="c"))
+    return features, Y
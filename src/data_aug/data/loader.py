@@ -0,0 +1,95 @@
+import math
+import torch
+from torch.utils.data import Subset, TensorDataset
+
+
+__all__ = [
+    "TensorLoader",
+]
+
+
+class TensorLoader:
+    """DataLoader replacement for datasets that fit in memory.
+
+    The dataset is materialized once as tensors on device. Each epoch draws
+    all minibatch indices in one call (a permutation, or uniform draws with
+    replacement) and yields slices, with no worker processes and no per-item
+    collation.
+
+    Batched datasets (UInt8Dataset, AugmentedDataset, ... with batched = True)
+    are stored raw and their transform_batch is applied per minibatch, so
+    random augmentations are redrawn every step. Any other dataset is stored
+    already transformed, which is only exact for deterministic transforms.
+
+    Subset is unwrapped, so the subset regimes of train_lik.py also qualify.
+    TensorDataset tensors are used as they are, e.g. the memory-mapped
+    evaluation tensors of data_aug.data.eval_cache, and without shuffling
+    batches are contiguous slices of them.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size=1,
+        shuffle=False,
+        replacement=False,
+        num_samples=None,
+        drop_last=False,
+        device=None,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.replacement = replacement
+        self.drop_last = drop_last
+        self.device = device
+
+        base, indices = dataset, torch.arange(len(dataset))
+        if isinstance(dataset, Subset):
+            base, indices = dataset.dataset, torch.as_tensor(dataset.indices)
+
+        self.n = len(indices)
+        self.num_samples = num_samples or self.n
+
+        if isinstance(base, TensorDataset) and not isinstance(dataset, Subset):
+            self.transform_batch = None
+            X, Y = base.tensors
+        elif getattr(base, "batched", False):
+            self.transform_batch = base.transform_batch
+            X, Y = base.decode(indices)
+        else:
+            self.transform_batch = None
+            X, Y = zip(*[base[int(i)] for i in indices])
+            X, Y = torch.stack(X), torch.tensor([int(y) for y in Y])
+
+        self.X, self.Y = X.to(device), Y.to(device)
+
+    def _indices(self):
+        if self.replacement:
+            return torch.randint(self.n, (self.num_samples,))
+        if self.shuffle:
+            return torch.randperm(self.n)
+        return torch.arange(self.n)
+
+    def __iter__(self):
+        ordered = not (self.replacement or self.shuffle)
+        indices = self._indices().to(self.X.device)
+        for batch_idx in indices.split(self.batch_size):
+            if self.drop_last and len(batch_idx) < self.batch_size:
+                break
+
+            if ordered:
+                start = int(batch_idx[0])
+                X = self.X[start : start + len(batch_idx)]
+                Y = self.Y[start : start + len(batch_idx)]
+            else:
+                X, Y = self.X[batch_idx], self.Y[batch_idx]
+            if self.transform_batch is not None:
+                yield self.transform_batch(X, Y)
+            else:
+                yield X, Y
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return int(math.ceil(self.num_samples / self.batch_size))
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+__all__ = [
+    "cache_key",
+    "read_idx",
+    "shared_array",
+    "UInt8Dataset",
+]
+
+
+def _shm_dir():
+    shm_dir = os.environ.get("DATA_AUG_SHM_DIR")
+    if shm_dir is None:
+        shm_dir = "/dev/shm" if Path("/dev/shm").is_dir() else tempfile.gettempdir()
+    shm_dir = Path(shm_dir) / "data_aug"
+    shm_dir.mkdir(parents=True, exist_ok=True)
+    return shm_dir
+
+
+def cache_key(*parts):
+    """Short stable key for a dataset, e.g. from its name and resolved root."""
+    return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()[:12]
+
+
+def read_idx(path):
+    """Memory-map a uint8 file in the idx format of the raw MNIST files."""
+    with open(path, "rb") as f:
+        zeros, dtype, ndim = f.read(2), f.read(1)[0], f.read(1)[0]
+        shape = tuple(np.frombuffer(f.read(4 * ndim), dtype=">i4").tolist())
+    assert zeros == b"\x00\x00" and dtype == 0x08, f"{path} is not a uint8 idx file."
+
+    return np.memmap(path, dtype=np.uint8, mode="c", offset=4 + 4 * ndim, shape=shape)
+
+
+def _open(path):
+    ## Copy-on-write mapping: pages stay shared with every other process
+    ## mapping the same file, and tensors built on top are writable.
+    if Path(path).suffix == ".npy":
+        return torch.from_numpy(np.load(path, mmap_mode="c"))
+    return torch.from_numpy(read_idx(path))
+
+
+def shared_array(name, load_fn):
+    """Memory-map the array called name, creating it with load_fn on first use.
+
+    The array lives as an .npy file in shared memory (/dev/shm, or
+    $DATA_AUG_SHM_DIR), so every DataLoader worker and every concurrent run on
+    the host maps the same physical pages. Creation goes through an atomic
+    rename, so racing processes at worst both compute load_fn().
+    """
+    path = _shm_dir() / f"{name}.npy"
+    if not path.is_file():
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(load_fn()))
+        os.replace(tmp_path, path)
+    return _open(path), path
+
+
+class UInt8Dataset(Dataset):
+    """Images kept as a single uint8 (N x C x H x W) tensor with its labels.
+
+    The transform operates on uint8 batches (see data_aug.data.transforms), and
+    __getitems__ serves a whole index batch with one gather and one transform
+    call instead of a PIL round trip per image.
+    """
+
+    batched = True
+
+    def __init__(self, data, targets, transform=None):
+        super().__init__()
+
+        self.data = data
+        self.targets = targets
+        self.transform = transform
+
+        self._paths = None
+        self._channels_last = False
+
+    @classmethod
+    def from_files(cls, data_path, targets_path, transform=None, channels_last=False):
+        """Memory-map .npy (or uint8 idx) files of images and targets.
+
+        With channels_last, the images file is (N x H x W x C) and is exposed
+        as a permuted (N x C x H x W) view. Single channel (N x H x W) images
+        are exposed as (N x 1 x H x W).
+        """
+        dataset = cls(None, None, transform=transform)
+        dataset._paths = (Path(data_path), Path(targets_path))
+        dataset._channels_last = channels_last
+        dataset._map()
+        return dataset
+
+    @classmethod
+    def shared(cls, name, load_fn, transform=None):
+        """Build from arrays shared across processes.
+
+        load_fn returns (images, targets), images as uint8 (N x C x H x W). It
+        is only called when the shared copy does not exist yet.
+        """
+        cache = {}
+
+        def _load(i):
+            if not cache:
+                cache.update(enumerate(load_fn()))
+            return cache[i]
+
+        _, data_path = shared_array(f"{name}-data", lambda: _load(0))
+        _, targets_path = shared_array(f"{name}-targets", lambda: _load(1))
+
+        return cls.from_files(data_path, targets_path, transform=transform)
+
+    def _map(self):
+        self.data = _open(self._paths[0])
+        if self._channels_last:
+            self.data = self.data.permute(0, 3, 1, 2)
+        elif self.data.dim() == 3:
+            self.data = self.data.unsqueeze(1)
+        self.targets = _open(self._paths[1]).long()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._paths is not None:
+            ## Re-map in spawned workers instead of pickling the pixels.
+            state["data"] = state["targets"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._paths is not None:
+            self._map()
+
+    def decode(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        return self.data[indices], self.targets[indices]
+
+    def transform_batch(self, X, Y):
+        if self.transform is not None:
+            X = self.transform(X)
+        return X, Y
+
+    def get_batch(self, indices):
+        return self.transform_batch(*self.decode(indices))
+
+    def __getitems__(self, indices):
+        X, Y = self.get_batch(indices)
+        return list(zip(X, Y))
+
+    def __getitem__(self, i):
+        X, Y = self.get_batch([i])
+        return X[0], Y[0]
+
+    def __len__(self):
+        return len(self.data)
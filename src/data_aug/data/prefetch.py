@@ -0,0 +1,132 @@
+"""Background batch pipeline for the training loops.
+
+Prefetcher wraps any iterable of (X, Y) or (X, X_aug, Y) batches. A
+background thread pulls batches from it, pins them and issues the host to
+device copies on a side CUDA stream, keeping up to depth batches ready
+while the current step runs. The loop itself only waits when no batch is
+ready, and that time is reported per pass in stats.
+"""
+import queue
+import threading
+import time
+
+import torch
+
+
+__all__ = [
+    "Prefetcher",
+]
+
+
+def _apply(batch, fn):
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_apply(b, fn) for b in batch)
+    return batch
+
+
+class _Done:
+    pass
+
+
+class Prefetcher:
+    """Drop-in wrapper around a DataLoader or TensorLoader.
+
+    Batches come out already on device, so the X.to(device) at the top of
+    the loops is a no-op. dataset and len() are forwarded, which is all the
+    loops read from the loader. Every iteration gets its own thread, so the
+    loader can still be iterated inside a pass (e.g. get_log_p on the train
+    loader during cSGLD).
+
+    After a pass is exhausted, stats holds the seconds the loop waited on
+    data ("wait"), the seconds the pass took ("total") and the number of
+    batches.
+    """
+
+    def __init__(self, loader, device=None, depth=2, pin_memory=True):
+        self.loader = loader
+        self.device = torch.device(device) if device is not None else None
+        self.depth = depth
+
+        self.use_cuda = self.device is not None and self.device.type == "cuda"
+        self.pin_memory = pin_memory and self.use_cuda
+
+        self.stats = {"wait": 0.0, "total": 0.0, "batches": 0}
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _copy(self, x):
+        if self.pin_memory and not x.is_cuda and not x.is_pinned():
+            x = x.pin_memory()
+        return x.to(self.device, non_blocking=self.use_cuda)
+
+    def _produce(self, out, stop):
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        try:
+            for batch in self.loader:
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = _apply(batch, self._copy)
+                        event = stream.record_event()
+                elif self.device is not None:
+                    batch = _apply(batch, self._copy)
+
+                while not stop.is_set():
+                    try:
+                        out.put((batch, event), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            out.put((_Done, None))
+        except Exception as exc:
+            out.put((exc, None))
+
+    def __iter__(self):
+        out = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(out, stop), daemon=True)
+        worker.start()
+
+        wait, n = 0.0, 0
+        start = time.perf_counter()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                batch, event = out.get()
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    ## Copies were allocated on the side stream.
+                    _apply(batch, lambda x: x.record_stream(stream))
+                wait += time.perf_counter() - t0
+
+                if batch is _Done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+
+                n += 1
+                yield batch
+
+            self.stats = {
+                "wait": wait,
+                "total": time.perf_counter() - start,
+                "batches": n,
+            }
+        finally:
+            stop.set()
+            ## Unblock a producer waiting on a full queue.
+            while worker.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
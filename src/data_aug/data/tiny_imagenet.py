@@ -0,0 +1,86 @@
+"""Packed Tiny ImageNet.
+
+pack_tiny_imagenet decodes the train and val JPEGs once into
+
+  <root>/tiny-imagenet-200/packed/{split}_images.npy   uint8 (N x 64 x 64 x 3)
+  <root>/tiny-imagenet-200/packed/{split}_targets.npy  int64 (N,)
+
+which get_tiny_imagenet memory-maps instead of going through ImageFolder.
+"""
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from torchvision.datasets.folder import make_dataset, IMG_EXTENSIONS
+
+
+__all__ = [
+    "packed_paths",
+    "pack_tiny_imagenet",
+]
+
+
+def packed_paths(root, split):
+    packed_dir = Path(root) / "tiny-imagenet-200" / "packed"
+    return packed_dir / f"{split}_images.npy", packed_dir / f"{split}_targets.npy"
+
+
+def _decode(path):
+    with open(path, "rb") as f:
+        return np.asarray(Image.open(f).convert("RGB"))
+
+
+def _val_samples(val_dir, class_to_idx):
+    ## Original layout: val/images/*.JPEG with labels in val_annotations.txt.
+    annotations = val_dir / "val_annotations.txt"
+    if annotations.is_file():
+        samples = []
+        with open(annotations) as f:
+            for line in f:
+                name, wnid = line.split("\t")[:2]
+                samples.append((str(val_dir / "images" / name), class_to_idx[wnid]))
+        return samples
+
+    ## Re-organized into one folder per class, as read by ImageFolder.
+    return make_dataset(str(val_dir), class_to_idx, extensions=IMG_EXTENSIONS)
+
+
+def _pack(samples, images_path, targets_path, num_workers=8):
+    tmp_path = images_path.with_suffix(f".{os.getpid()}.tmp")
+    images = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.uint8, shape=(len(samples), 64, 64, 3)
+    )
+
+    paths = [p for p, _ in samples]
+    with Pool(num_workers) as pool:
+        for i, x in enumerate(pool.imap(_decode, paths, chunksize=256)):
+            images[i] = x
+
+    images.flush()
+    del images
+    np.save(targets_path, np.array([y for _, y in samples], dtype=np.int64))
+    os.replace(tmp_path, images_path)
+
+
+def pack_tiny_imagenet(root, num_workers=8):
+    """Decode train and val once. Labels follow the ImageFolder class order."""
+    base_dir = Path(root) / "tiny-imagenet-200"
+
+    classes = sorted(d.name for d in os.scandir(base_dir / "train") if d.is_dir())
+    class_to_idx = {c: i for i, c in enumerate(classes)}
+
+    splits = {
+        "train": make_dataset(
+            str(base_dir / "train"), class_to_idx, extensions=IMG_EXTENSIONS
+        ),
+        "val": _val_samples(base_dir / "val", class_to_idx),
+    }
+
+    for split, samples in splits.items():
+        images_path, targets_path = packed_paths(root, split)
+        images_path.parent.mkdir(parents=True, exist_ok=True)
+        _pack(samples, images_path, targets_path, num_workers=num_workers)
+
+    return {split: len(samples) for split, samples in splits.items()}
@@ -0,0 +1,133 @@
+"""Batched transforms on uint8 image tensors.
+
+Every transform takes a tensor of shape (... x C x H x W), so the same
+object can be applied to a single image or to a whole minibatch, and
+random parameters are drawn independently for each image.
+"""
+import math
+import torch
+import torch.nn.functional as F
+
+
+__all__ = [
+    "Compose",
+    "Lambda",
+    "Normalize",
+    "RandomCrop",
+    "RandomHorizontalFlip",
+    "RandomVerticalFlip",
+    "RandomRotation",
+]
+
+
+def _as_batch(x):
+    return x.reshape(-1, *x.shape[-3:])
+
+
+class _Transform:
+    def __repr__(self):
+        ## Deterministic, so it can be part of a cache key.
+        args = ", ".join(f"{k}={v!r}" for k, v in vars(self).items())
+        return f"{type(self).__name__}({args})"
+
+
+class Compose(_Transform):
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+
+class Lambda(_Transform):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, x):
+        return self.fn(x)
+
+
+class Normalize(_Transform):
+    """Scales uint8 inputs to [0, 1] and normalizes, like ToTensor + Normalize."""
+
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+
+    def __call__(self, x):
+        if x.dtype == torch.uint8:
+            x = x.float().div_(255.0)
+        return x.sub(self.mean.to(x.device)).div_(self.std.to(x.device))
+
+
+class RandomCrop(_Transform):
+    """Zero-padded random crop, equivalent to transforms.RandomCrop(size, padding)."""
+
+    def __init__(self, size, padding=0):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, x):
+        shape = x.shape
+        x = _as_batch(x)
+        B, _, H, W = x.shape
+
+        if self.padding > 0:
+            x = F.pad(x, [self.padding] * 4)
+
+        off_h = torch.randint(0, H + 2 * self.padding - self.size + 1, (B, 1))
+        off_w = torch.randint(0, W + 2 * self.padding - self.size + 1, (B, 1))
+        rows = (off_h + torch.arange(self.size)).to(x.device)
+        cols = (off_w + torch.arange(self.size)).to(x.device)
+        b_idx = torch.arange(B, device=x.device).view(-1, 1, 1)
+
+        ## Advanced indexing moves the channel dimension last.
+        out = x[b_idx, :, rows.unsqueeze(-1), cols.unsqueeze(1)].permute(0, 3, 1, 2)
+        return out.reshape(*shape[:-2], self.size, self.size)
+
+
+class _RandomFlip(_Transform):
+    def __init__(self, dim, p=0.5):
+        self.dim = dim
+        self.p = p
+
+    def __call__(self, x):
+        shape = x.shape
+        x = _as_batch(x)
+        flip = (torch.rand(x.size(0), device=x.device) < self.p).view(-1, 1, 1, 1)
+        return torch.where(flip, x.flip(self.dim), x).reshape(shape)
+
+
+class RandomHorizontalFlip(_RandomFlip):
+    def __init__(self, p=0.5):
+        super().__init__(-1, p=p)
+
+
+class RandomVerticalFlip(_RandomFlip):
+    def __init__(self, p=0.5):
+        super().__init__(-2, p=p)
+
+
+class RandomRotation(_Transform):
+    """Rotation by an angle in [-degrees, degrees], nearest interpolation, zero fill."""
+
+    def __init__(self, degrees):
+        self.degrees = degrees
+
+    def __call__(self, x):
+        shape, dtype = x.shape, x.dtype
+        x = _as_batch(x)
+        B = x.size(0)
+
+        theta = (torch.rand(B, device=x.device) * 2 - 1) * math.radians(self.degrees)
+        cos, sin = theta.cos(), theta.sin()
+        zero = torch.zeros_like(theta)
+        affine = torch.stack(
+            [torch.stack([cos, -sin, zero], -1), torch.stack([sin, cos, zero], -1)], 1
+        )
+
+        grid = F.affine_grid(affine, list(x.shape), align_corners=False)
+        out = F.grid_sample(x.float(), grid, mode="nearest", align_corners=False)
+        return out.to(dtype).reshape(shape)
@@ -1,15 +1,20 @@
+import os
 from pathlib import Path
 from PIL import Image
 
 import torch
 import numpy as np
 
-from torch.utils.data import random_split, Dataset
+from torch.utils.data import random_split, ConcatDataset, Dataset
 from torch.distributions import Categorical
 from torchvision.datasets import CIFAR10, MNIST, ImageFolder
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as TF
 
 from .augmentations import augmentations, augmentations_all
+from .data import AugMix, AugBankDataset, UInt8Dataset, cache_key
+from .data.tiny_imagenet import packed_paths
+from .data import transforms as batch_transforms
 
 _CIFAR_TRAIN_TRANSFORM = transforms.Compose(
     [
@@ -45,6 +50,32 @@ _TINY_IMAGENET_TEST_TRANSFORM = transforms.Compose(
     ]
 )
 
+## uint8 batch counterparts of the above, for the in-memory datasets and
+## the augmented views of AugmentedDataset.
+_CIFAR_TRAIN_BATCH_TRANSFORM = batch_transforms.Compose(
+    [
+        batch_transforms.RandomCrop(32, padding=4),
+        batch_transforms.RandomHorizontalFlip(),
+        batch_transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+    ]
+)
+
+_CIFAR_TEST_BATCH_TRANSFORM = batch_transforms.Normalize(
+    (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
+)
+
+_TINY_IMAGENET_TRAIN_BATCH_TRANSFORM = batch_transforms.Compose(
+    [
+        batch_transforms.RandomRotation(20),
+        batch_transforms.RandomHorizontalFlip(),
+        batch_transforms.Normalize([0.4802, 0.4481, 0.3975], [0.2302, 0.2265, 0.2262]),
+    ]
+)
+
+_TINY_IMAGENET_TEST_BATCH_TRANSFORM = batch_transforms.Normalize(
+    [0.4802, 0.4481, 0.3975], [0.2302, 0.2265, 0.2262]
+)
+
 _MNIST_TRAIN_TRANSFORM = transforms.Compose(
     [
         transforms.RandomCrop(28, padding=4),
@@ -61,21 +92,24 @@ _MNIST_TEST_TRANSFORM = transforms.Compose(
     ]
 )
 
-rng_permute = np.random.RandomState(1)
-idx_permute = torch.from_numpy(rng_permute.permutation(784))
+_MNIST_TRAIN_BATCH_TRANSFORM = batch_transforms.Compose(
+    [
+        batch_transforms.RandomCrop(28, padding=4),
+        batch_transforms.RandomHorizontalFlip(),
+        batch_transforms.Normalize((0.1307,), (0.3081,)),
+    ]
+)
+
+_MNIST_TEST_BATCH_TRANSFORM = batch_transforms.Normalize((0.1307,), (0.3081,))
 
 
-def _my_permute(x):
-    return x.view(-1)[idx_permute].view(1, 28, 28)
+def mnist_permutation(seed=1):
+    """Fixed permutation of the 784 MNIST pixels for permuted-MNIST."""
+    return torch.from_numpy(np.random.RandomState(seed).permutation(28 * 28))
 
 
-_MNIST_TRAIN_TRANSFORM_PERM = transforms.Compose(
-    [
-        transforms.ToTensor(),
-        transforms.Normalize((0.1307,), (0.3081,)),
-        transforms.Lambda(_my_permute),
-    ]
-)
+def _permute_pixels(data, idx_permute):
+    return data.flatten(-2)[..., idx_permute].view(data.shape)
 
 
 # this and AugMixDataset copied from https://github.com/google-research/augmix/blob/master/cifar.py
@@ -137,13 +171,42 @@ class AugMixDataset(Dataset):
 
 def prepare_transforms(train_data, augment="std"):
     if augment == "augmix":
-        test_transform = _CIFAR_TEST_TRANSFORM
-        # test_transform.transforms.pop(0)
-        train_data.transform.transforms.pop(-1)
-        train_data.transform.transforms.pop(-1)
-        dataset = AugMixDataset(train_data, preprocess=test_transform, no_jsd=True)
+        ## NOTE: AugMixDataset with aug() is the PIL reference implementation.
+        dataset = BatchAugMixDataset(
+            train_data,
+            AugMix((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+            base_transform=batch_transforms.Compose(
+                [
+                    batch_transforms.RandomCrop(32, padding=4),
+                    batch_transforms.RandomHorizontalFlip(),
+                ]
+            ),
+            preprocess=_CIFAR_TEST_BATCH_TRANSFORM,
+            no_jsd=True,
+        )
+        for attr in ["total_augs", "total_classes"]:
+            if hasattr(train_data, attr):
+                setattr(dataset, attr, getattr(train_data, attr))
         return dataset
 
+    if getattr(train_data, "batched", False):
+        ## uint8 batch datasets (in_memory) take the batch transforms.
+        augment_transform = {
+            "std": [
+                batch_transforms.RandomCrop(32, padding=4),
+                batch_transforms.RandomHorizontalFlip(),
+            ],
+            "flips": [batch_transforms.RandomHorizontalFlip()],
+            "vflips": [batch_transforms.RandomVerticalFlip()],
+            "crops": [batch_transforms.RandomCrop(32, padding=4)],
+        }
+        if augment not in augment_transform:
+            raise NotImplementedError(augment)
+        train_data.transform = batch_transforms.Compose(
+            augment_transform[augment] + [_CIFAR_TEST_BATCH_TRANSFORM]
+        )
+        return train_data
+
     if augment == "std":
         transform = _CIFAR_TRAIN_TRANSFORM
     elif augment == "flips":
@@ -180,6 +243,30 @@ def prepare_transforms(train_data, augment="std"):
     return train_data
 
 
+def decode(dataset, indices):
+    """Untransformed uint8 (B x C x H x W) images and (B,) targets at indices.
+
+    Reads the images straight from the underlying storage, without going
+    through (or touching) the dataset transform.
+    """
+    if hasattr(dataset, "decode"):
+        return dataset.decode(indices)
+
+    if isinstance(dataset, ImageFolder):
+        X = [TF.pil_to_tensor(dataset.loader(dataset.samples[i][0])) for i in indices]
+        Y = [dataset.samples[i][1] for i in indices]
+    elif isinstance(dataset, MNIST):
+        X = [dataset.data[i].unsqueeze(0) for i in indices]
+        Y = [int(dataset.targets[i]) for i in indices]
+    elif isinstance(dataset, CIFAR10):
+        X = [torch.from_numpy(dataset.data[i]).permute(2, 0, 1) for i in indices]
+        Y = [dataset.targets[i] for i in indices]
+    else:
+        raise NotImplementedError
+
+    return torch.stack(X), torch.tensor(Y)
+
+
 class WrapperDataset(Dataset):
     def __init__(self, dataset):
         super().__init__()
@@ -205,6 +292,21 @@ class WrapperDataset(Dataset):
     def __getitem__(self, i):
         return self.dataset[i]
 
+    def __getitems__(self, indices):
+        if hasattr(self.dataset, "__getitems__"):
+            return self.dataset.__getitems__(indices)
+        return [self.dataset[i] for i in indices]
+
+    @property
+    def batched(self):
+        return getattr(self.dataset, "batched", False)
+
+    def decode(self, indices):
+        return decode(self.dataset, indices)
+
+    def transform_batch(self, X, Y):
+        return self.dataset.transform_batch(X, Y)
+
     def __len__(self):
         return len(self.dataset)
 
@@ -222,7 +324,7 @@ class LabelNoiseDataset(WrapperDataset):
                 Categorical(probs=torch.ones(self.C) / self.C).sample(
                     torch.Size([len(orig_targets)])
                 ),
-                torch.Tensor(orig_targets).long(),
+                torch.as_tensor(orig_targets).long(),
             )
 
     def __getitem__(self, i):
@@ -230,32 +332,100 @@ class LabelNoiseDataset(WrapperDataset):
         y = self.noisy_targets[i]
         return X, y
 
+    def __getitems__(self, indices):
+        batch = super().__getitems__(indices)
+        return [(X, self.noisy_targets[i]) for (X, _), i in zip(batch, indices)]
+
+    def decode(self, indices):
+        X, _ = super().decode(indices)
+        return X, self.noisy_targets[indices]
+
 
 class AugmentedDataset(WrapperDataset):
-    def __init__(self, dataset, base_transform=None, n_aug=1):
+    """Returns the clean view and n_aug augmented views of each image.
+
+    Each image is decoded once. The clean view is base_transform of it and the
+    augmented views come from one aug_transform call over n_aug copies, so the
+    wrapped dataset's own transform is never used or modified. Both are uint8
+    batch transforms (see data_aug.data.transforms).
+    """
+
+    batched = True
+
+    def __init__(self, dataset, base_transform=None, aug_transform=None, n_aug=1):
         super().__init__(dataset)
 
         self.n_aug = n_aug
         self.base_transform = base_transform
+        self.aug_transform = aug_transform
+
+    def _views(self, X):
+        X_orig = X
+        if self.base_transform is not None:
+            X_orig = self.base_transform(X)
+
+        X_augs = X.unsqueeze(1).expand(-1, self.n_aug, *X.shape[1:])
+        if self.aug_transform is not None:
+            X_augs = self.aug_transform(X_augs)
+
+        return X_orig, X_augs
+
+    def transform_batch(self, X, Y):
+        return (*self._views(X), Y)
 
     def __getitem__(self, i):
-        orig_transform = self.transform
+        return self.__getitems__([i])[0]
+
+    def __getitems__(self, indices):
+        return list(zip(*self.transform_batch(*self.decode(indices))))
+
+
+class BatchAugMixDataset(WrapperDataset):
+    """AugMixDataset on uint8 batches, using data_aug.data.AugMix.
+
+    base_transform is applied to the decoded images before AugMix (e.g. the
+    usual random crops and flips) and preprocess produces the clean view in
+    JSD mode.
+    """
+
+    batched = True
+
+    def __init__(
+        self, dataset, augmix, base_transform=None, preprocess=None, no_jsd=False
+    ):
+        super().__init__(dataset)
+
+        self.augmix = augmix
+        self.base_transform = base_transform
+        self.preprocess = preprocess
+        self.no_jsd = no_jsd
 
-        self.transform = None
-        X_orig, y = self.dataset[i]
+    def transform_batch(self, X, Y):
         if self.base_transform is not None:
-            X_orig = self.base_transform(X_orig)
+            X = self.base_transform(X)
 
-        self.transform = orig_transform
-        X_augs = torch.stack([self.dataset[i][0] for _ in range(self.n_aug)])
+        if self.no_jsd:
+            return self.augmix(X), Y
 
-        return X_orig, X_augs, y
+        ## Both augmented copies come from one AugMix call.
+        X_aug = self.augmix(X.unsqueeze(1).expand(-1, 2, *X.shape[1:]))
+        return (self.preprocess(X), X_aug[:, 0], X_aug[:, 1]), Y
+
+    def __getitems__(self, indices):
+        X, Y = self.transform_batch(*self.decode(indices))
+        if not self.no_jsd:
+            X = list(zip(*X))
+        return list(zip(X, Y))
+
+    def __getitem__(self, i):
+        return self.__getitems__([i])[0]
 
 
 class CIFAR10FixedAug(CIFAR10):
     """Wrapper class to return original image + augmentations as a single dataset.
 
-    Use only via get_cifar10_with_aug.
+    Use only via get_cifar10_with_aug. Legacy directory of per-image .pt
+    files; banks written by experiments/make_aug_bank.py load much faster.
     """
 
     def __init__(self, aug_dir=None, **kwargs):
@@ -310,87 +480,208 @@ def train_test_split(dataset, val_size=0.1, seed=None):
     return train, test
 
 
-def get_cifar10(root=None, label_noise=0, augment=True, n_aug=1, return_orig=False):
-    train_data = CIFAR10(
-        root=root,
-        train=True,
-        download=True,
-        transform=_CIFAR_TRAIN_TRANSFORM if augment else _CIFAR_TEST_TRANSFORM,
+def _data_root(root=None):
+    """root, or as in the experiment scripts $DATADIR, else
+    ~/.cache/data_aug/datasets when None."""
+    if root is None:
+        root = os.environ.get("DATADIR")
+    if root is None:
+        root = Path.home() / ".cache" / "data_aug" / "datasets"
+    return root
+
+
+def _shared_cifar10(root=None, train=True, transform=None):
+    root = _data_root(root)
+
+    def _load():
+        data = CIFAR10(root=root, train=train, download=True)
+        return data.data.transpose(0, 3, 1, 2), np.array(data.targets)
+
+    split = "train" if train else "test"
+    return UInt8Dataset.shared(
+        f"cifar10-{split}-{cache_key(Path(root).resolve())}", _load, transform=transform
     )
+
+
+def get_cifar10(
+    root=None, label_noise=0, augment=True, n_aug=1, return_orig=False, in_memory=False
+):
+    if in_memory:
+        train_data = _shared_cifar10(
+            root=root,
+            train=True,
+            transform=_CIFAR_TRAIN_BATCH_TRANSFORM
+            if augment
+            else _CIFAR_TEST_BATCH_TRANSFORM,
+        )
+    else:
+        train_data = CIFAR10(
+            root=root,
+            train=True,
+            download=True,
+            transform=_CIFAR_TRAIN_TRANSFORM if augment else _CIFAR_TEST_TRANSFORM,
+        )
     if label_noise > 0:
         train_data = LabelNoiseDataset(train_data, n_labels=10, label_noise=label_noise)
     if augment and return_orig:
         train_data = AugmentedDataset(
-            train_data, base_transform=_CIFAR_TEST_TRANSFORM, n_aug=n_aug
+            train_data,
+            base_transform=_CIFAR_TEST_BATCH_TRANSFORM,
+            aug_transform=_CIFAR_TRAIN_BATCH_TRANSFORM,
+            n_aug=n_aug,
         )
 
     setattr(train_data, "total_augs", 9 * 9 * 2)
     setattr(train_data, "total_classes", 10)
 
-    test_data = CIFAR10(
-        root=root, train=False, download=True, transform=_CIFAR_TEST_TRANSFORM
-    )
+    if in_memory:
+        test_data = _shared_cifar10(
+            root=root, train=False, transform=_CIFAR_TEST_BATCH_TRANSFORM
+        )
+    else:
+        test_data = CIFAR10(
+            root=root, train=False, download=True, transform=_CIFAR_TEST_TRANSFORM
+        )
 
     return train_data, test_data
 
 
+def _mnist_idx(root=None, train=True, transform=None):
+    """Memory-maps the raw idx files under <root>/MNIST/raw directly."""
+    root = _data_root(root)
+    prefix = "train" if train else "t10k"
+    raw_dir = Path(root) / "MNIST" / "raw"
+    images_path = raw_dir / f"{prefix}-images-idx3-ubyte"
+    labels_path = raw_dir / f"{prefix}-labels-idx1-ubyte"
+    if not (images_path.is_file() and labels_path.is_file()):
+        MNIST(root=root, train=train, download=True)
+
+    return UInt8Dataset.from_files(images_path, labels_path, transform=transform)
+
+
 def get_mnist(
-    root=None, label_noise=0, augment=True, n_aug=1, return_orig=False, perm=False
+    root=None,
+    label_noise=0,
+    augment=True,
+    n_aug=1,
+    return_orig=False,
+    perm=False,
+    perm_seed=1,
+    in_memory=False,
 ):
-    if augment:
-        train_data = MNIST(
-            root=root, train=True, download=True, transform=_MNIST_TRAIN_TRANSFORM
-        )
+    ## Permuted-MNIST permutes the stored uint8 pixels once up front, which
+    ## commutes with ToTensor + Normalize, so it costs the same as plain MNIST.
+    if in_memory:
+        root = _data_root(root)
+        if perm:
+            raw_data = _mnist_idx(root=root, train=True)
+            train_data = UInt8Dataset.shared(
+                f"mnist-train-perm{perm_seed}-{cache_key(Path(root).resolve())}",
+                lambda: (
+                    _permute_pixels(raw_data.data, mnist_permutation(perm_seed)),
+                    raw_data.targets,
+                ),
+                transform=_MNIST_TEST_BATCH_TRANSFORM,
+            )
+        else:
+            train_data = _mnist_idx(
+                root=root,
+                train=True,
+                transform=_MNIST_TRAIN_BATCH_TRANSFORM
+                if augment
+                else _MNIST_TEST_BATCH_TRANSFORM,
+            )
     else:
-        train_data = MNIST(
-            root=root, train=True, download=True, transform=_MNIST_TEST_TRANSFORM
-        )
-    if perm:
-        train_data = MNIST(
-            root=root, train=True, download=True, transform=_MNIST_TRAIN_TRANSFORM_PERM
-        )
+        if perm:
+            train_data = MNIST(
+                root=root, train=True, download=True, transform=_MNIST_TEST_TRANSFORM
+            )
+            train_data.data = _permute_pixels(
+                train_data.data, mnist_permutation(perm_seed)
+            )
+        elif augment:
+            train_data = MNIST(
+                root=root, train=True, download=True, transform=_MNIST_TRAIN_TRANSFORM
+            )
+        else:
+            train_data = MNIST(
+                root=root, train=True, download=True, transform=_MNIST_TEST_TRANSFORM
+            )
     if label_noise > 0:
         train_data = LabelNoiseDataset(train_data, n_labels=10, label_noise=label_noise)
     if augment and return_orig:
         train_data = AugmentedDataset(
-            train_data, base_transform=_MNIST_TEST_TRANSFORM, n_aug=n_aug
+            train_data,
+            base_transform=_MNIST_TEST_BATCH_TRANSFORM,
+            aug_transform=_MNIST_TRAIN_BATCH_TRANSFORM,
+            n_aug=n_aug,
         )
 
     setattr(train_data, "total_augs", 9 * 9 * 2)
     setattr(train_data, "total_classes", 10)
 
-    test_data = MNIST(
-        root=root, train=False, download=True, transform=_MNIST_TEST_TRANSFORM
-    )
+    if in_memory:
+        test_data = _mnist_idx(
+            root=root, train=False, transform=_MNIST_TEST_BATCH_TRANSFORM
+        )
+    else:
+        test_data = MNIST(
+            root=root, train=False, download=True, transform=_MNIST_TEST_TRANSFORM
+        )
 
     return train_data, test_data
 
 
+def _packed_tiny_imagenet(root, split, transform=None):
+    """Packed split from experiments/pack_tiny_imagenet.py, or None."""
+    images_path, targets_path = packed_paths(root, split)
+    if not images_path.is_file():
+        return None
+    return UInt8Dataset.from_files(
+        images_path, targets_path, transform=transform, channels_last=True
+    )
+
+
 def get_tiny_imagenet(
     root=None, label_noise=0, augment=True, n_aug=1, return_orig=False
 ):
-    train_data = ImageFolder(
-        root=Path(root) / "tiny-imagenet-200" / "train",
-        transform=_TINY_IMAGENET_TRAIN_TRANSFORM
+    train_data = _packed_tiny_imagenet(
+        root,
+        "train",
+        transform=_TINY_IMAGENET_TRAIN_BATCH_TRANSFORM
         if augment
-        else _TINY_IMAGENET_TEST_TRANSFORM,
+        else _TINY_IMAGENET_TEST_BATCH_TRANSFORM,
     )
+    if train_data is None:
+        train_data = ImageFolder(
+            root=Path(root) / "tiny-imagenet-200" / "train",
+            transform=_TINY_IMAGENET_TRAIN_TRANSFORM
+            if augment
+            else _TINY_IMAGENET_TEST_TRANSFORM,
+        )
     if label_noise > 0:
         train_data = LabelNoiseDataset(
             train_data, n_labels=200, label_noise=label_noise
         )
     if augment and return_orig:
         train_data = AugmentedDataset(
-            train_data, base_transform=_TINY_IMAGENET_TEST_TRANSFORM, n_aug=n_aug
+            train_data,
+            base_transform=_TINY_IMAGENET_TEST_BATCH_TRANSFORM,
+            aug_transform=_TINY_IMAGENET_TRAIN_BATCH_TRANSFORM,
+            n_aug=n_aug,
         )
 
     setattr(train_data, "total_augs", 20 * 2)
     setattr(train_data, "total_classes", 200)
 
-    val_data = ImageFolder(
-        root=Path(root) / "tiny-imagenet-200" / "val",
-        transform=_TINY_IMAGENET_TEST_TRANSFORM,
+    val_data = _packed_tiny_imagenet(
+        root, "val", transform=_TINY_IMAGENET_TEST_BATCH_TRANSFORM
     )
+    if val_data is None:
+        val_data = ImageFolder(
+            root=Path(root) / "tiny-imagenet-200" / "val",
+            transform=_TINY_IMAGENET_TEST_TRANSFORM,
+        )
 
     ## NOTE: Folder not in the right format.
     # test_data = ImageFolder(root=Path(root) / 'tiny-imagenet-200' / 'test', transform=_TINY_IMAGENET_TEST_TRANSFORM)
@@ -399,17 +690,31 @@ def get_tiny_imagenet(
 
 
 def get_cifar10_fixed_aug(root=None, val_size=0, seed=None, aug_dir=None):
-    train_data = CIFAR10FixedAug(
-        root=root,
-        train=True,
-        download=True,
-        aug_dir=aug_dir,
-        transform=_CIFAR_TEST_TRANSFORM,
-    )
+    if (Path(aug_dir) / "index.npy").is_file():
+        ## Bank from experiments/make_aug_bank.py.
+        train_data = ConcatDataset(
+            [
+                _shared_cifar10(
+                    root=root, train=True, transform=_CIFAR_TEST_BATCH_TRANSFORM
+                ),
+                AugBankDataset(aug_dir, transform=_CIFAR_TEST_BATCH_TRANSFORM),
+            ]
+        )
+        test_data = _shared_cifar10(
+            root=root, train=False, transform=_CIFAR_TEST_BATCH_TRANSFORM
+        )
+    else:
+        train_data = CIFAR10FixedAug(
+            root=root,
+            train=True,
+            download=True,
+            aug_dir=aug_dir,
+            transform=_CIFAR_TEST_TRANSFORM,
+        )
 
-    test_data = CIFAR10(
-        root=root, train=False, download=True, transform=_CIFAR_TEST_TRANSFORM
-    )
+        test_data = CIFAR10(
+            root=root, train=False, download=True, transform=_CIFAR_TEST_TRANSFORM
+        )
 
     if val_size != 0:
         train_data, val_data = train_test_split(
@@ -2,3 +2,10 @@ from .resnet import ResNet18
 from .resnet_frn import ResNet18 as ResNet18FRN
 from .lenet import LeNet
 from .resnet_fixup import ResNet18 as ResNet18Fixup
+from .zoo import get_net
+from .prepare import prepare_model, compile_fn
+from .sample_cache import SampleCache, sample_cache
+from .export import export_inference, inference_graph, load_sample
+from .quantize import calibration_batches, quantize_inference, quantize_sample
+from .checkpoint import checkpoint_stages, checkpoint_to_budget
+from .ensemble import Ensemble, load_ensemble, predictive, select_samples
@@ -0,0 +1,154 @@
+import logging
+import contextlib
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+__all__ = [
+    'stages',
+    'activation_bytes',
+    'checkpoint_stages',
+    'checkpoint_to_budget',
+]
+
+
+def stages(net):
+    '''Names of the residual stages (layer1, layer2, ...) of a ResNet.'''
+    return [name for name, _ in net.named_children() if name.startswith('layer')]
+
+
+def _tensor_bytes(t):
+    return t.numel() * t.element_size()
+
+
+def _batch_norms(module):
+    return [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+
+
+def _forward_overrides(modules):
+    ## Instance-level forward replacements, e.g. by nn.ghost_batches.
+    return [m.__dict__.get('forward') for m in modules]
+
+
+def _set_forward_overrides(modules, forwards):
+    for m, forward in zip(modules, forwards):
+        if forward is None:
+            m.__dict__.pop('forward', None)
+        else:
+            m.forward = forward
+
+
+@contextlib.contextmanager
+def _batch_norm_state(module, forwards=None):
+    ## Recomputation must normalize exactly like the original forward, which
+    ## may have run under nn.ghost_batches, and must not update BatchNorm
+    ## running statistics a second time, so they are restored afterwards.
+    ## Switching tracking off instead would change the tensors batch_norm
+    ## saves for backward.
+    bns = _batch_norms(module)
+    current = _forward_overrides(bns)
+    state = [b.clone() for m in bns for b in m.buffers()]
+    if forwards is not None:
+        _set_forward_overrides(bns, forwards)
+    try:
+        yield
+    finally:
+        _set_forward_overrides(bns, current)
+        with torch.no_grad():
+            for b, s in zip([b for m in bns for b in m.buffers()], state):
+                b.copy_(s)
+
+
+def checkpoint_stages(net, names):
+    '''
+    Recompute the activations of the given stages of net in backward instead
+    of storing them, in place. Only the input of each checkpointed stage is
+    kept. Parameters and state_dict() are unchanged.
+    '''
+    for name in names:
+        stage = getattr(net, name)
+        forward = type(stage).forward.__get__(stage)
+
+        def context_fn(stage=stage):
+            forwards = _forward_overrides(_batch_norms(stage))
+            return contextlib.nullcontext(), _batch_norm_state(stage, forwards)
+
+        def checkpointed(x, _forward=forward, _context_fn=context_fn):
+            if not torch.is_grad_enabled():
+                return _forward(x)
+            return checkpoint(_forward, x, use_reentrant=False, context_fn=_context_fn)
+
+        stage.forward = checkpointed
+
+    return net
+
+
+def activation_bytes(net, X):
+    '''
+    Bytes per input saved for backward by each stage of net (and by the rest
+    of the network under None), and the size per input of each stage's input,
+    measured with one training-mode forward pass on X.
+    '''
+    saved = { name: 0 for name in stages(net) + [None] }
+    inputs = {}
+    state = { 'stage': None, 'seen': set() }
+
+    def pack(t):
+        key = (t.untyped_storage().data_ptr(), t.storage_offset(), t.shape)
+        if key not in state['seen']:
+            state['seen'].add(key)
+            saved[state['stage']] += _tensor_bytes(t)
+        return t
+
+    hooks = []
+    for name in stages(net):
+        def pre_hook(module, args, name=name):
+            state['stage'] = name
+            inputs[name] = _tensor_bytes(args[0])
+
+        def hook(module, args, output):
+            state['stage'] = None
+
+        stage = getattr(net, name)
+        hooks += [stage.register_forward_pre_hook(pre_hook), stage.register_forward_hook(hook)]
+
+    training = net.training
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t), _batch_norm_state(net):
+            net.train()(X)
+    finally:
+        net.train(training)
+        for h in hooks:
+            h.remove()
+
+    n = X.size(0)
+    return { k: v / n for k, v in saved.items() }, { k: v / n for k, v in inputs.items() }
+
+
+def checkpoint_to_budget(net, X, n_inputs, budget):
+    '''
+    Checkpoint the fewest stages of net such that the activations saved for
+    backward on n_inputs inputs like X are estimated to fit into budget
+    bytes, in place. Stages saving the most memory go first.
+
+    Returns the names of the checkpointed stages.
+    '''
+    saved, inputs = activation_bytes(net, X)
+    savings = sorted(stages(net), key=lambda name: inputs[name] - saved[name])
+
+    total = sum(saved.values()) * n_inputs
+    names = []
+    for name in savings:
+        if total <= budget:
+            break
+        names.append(name)
+        total -= (saved[name] - inputs[name]) * n_inputs
+
+    if total > budget:
+        logging.warning(f'Estimated activations of {total / 2**30:.2f} GiB exceed the budget of '
+                        f'{budget / 2**30:.2f} GiB with all stages checkpointed.')
+    logging.info(f'Checkpointing stages {names}, estimated activations {total / 2**30:.2f} GiB.')
+
+    checkpoint_stages(net, names)
+    return names
@@ -0,0 +1,99 @@
+from pathlib import Path
+import torch
+import torch.nn as nn
+
+from .export import load_sample
+
+
+__all__ = [
+    'Ensemble',
+    'load_ensemble',
+    'predictive',
+    'select_samples',
+]
+
+
+class Ensemble(nn.Module):
+    '''Posterior samples as one module returning stacked logits [S, B, C].'''
+    def __init__(self, members):
+        super().__init__()
+
+        self.members = nn.ModuleList(members)
+
+    def forward(self, X):
+        return torch.stack([m(X) for m in self.members])
+
+
+def load_ensemble(net, samples_dir, export=True, cache=True):
+    '''
+    All samples under samples_dir (see load_sample), in a stable order.
+    '''
+    members = [load_sample(net, sample_path, export=export, cache=cache)
+               for sample_path in sorted(Path(samples_dir).rglob('*.pt'))]
+    return Ensemble(members).eval()
+
+
+def predictive(logits):
+    '''
+    Posterior predictive of stacked logits [S, B, C]: the mean probabilities,
+    their entropy (total uncertainty), the mean entropy of the samples
+    (aleatoric) and the difference, the mutual information between the
+    prediction and the parameters (epistemic).
+    '''
+    log_p = logits.float().log_softmax(dim=-1)
+    log_mean = log_p.logsumexp(dim=0) - torch.log(torch.tensor(float(log_p.size(0))))
+    mean = log_mean.exp()
+
+    entropy = -(mean * log_mean).sum(dim=-1)
+    aleatoric = -(log_p.exp() * log_p).sum(dim=-1).mean(dim=0)
+
+    return {
+        'probs': mean,
+        'log_probs': log_mean,
+        'entropy': entropy,
+        'aleatoric': aleatoric,
+        'mutual_info': (entropy - aleatoric).clamp(min=0.),
+    }
+
+
+@torch.no_grad()
+def select_samples(logits, Y, k=None, criterion='nll'):
+    '''
+    Greedy forward selection of k (default: all) of the samples with stacked
+    logits [S, N, C] on inputs with labels Y, as indices in the order they
+    were picked, so every prefix is the selection for its size.
+
+    With criterion 'nll', each step adds the sample that minimizes the NLL
+    of the predictive of the selection. With 'diversity', the first sample
+    is the one with the lowest NLL and each step adds the sample whose
+    predictions are farthest (in KL) from the predictive of the selection,
+    which skips near-duplicates such as consecutive samples of one cycle.
+    '''
+    log_p = logits.float().log_softmax(dim=-1)
+    S = log_p.size(0)
+    k = S if k is None else min(k, S)
+
+    ## Likelihoods of the labels are all the NLL criterion needs.
+    p_y = log_p.gather(-1, Y.view(1, -1, 1).expand(S, -1, 1)).squeeze(-1).exp()
+
+    selected = []
+    remaining = torch.ones(S, dtype=torch.bool, device=log_p.device)
+    sum_p_y = torch.zeros_like(p_y[0])
+    sum_p = torch.zeros_like(log_p[0])
+    while len(selected) < k:
+        n = len(selected) + 1
+        if criterion == 'nll' or not selected:
+            score = -((sum_p_y + p_y) / n).clamp(min=1e-12).log().mean(dim=-1)
+        elif criterion == 'diversity':
+            log_mean = (sum_p / (n - 1)).clamp(min=1e-12).log()
+            score = -(log_p.exp() * (log_p - log_mean)).sum(dim=-1).mean(dim=-1)
+        else:
+            raise NotImplementedError(criterion)
+
+        i = score.masked_fill(~remaining, float('inf')).argmin().item()
+        selected.append(i)
+        remaining[i] = False
+        sum_p_y += p_y[i]
+        sum_p += log_p[i].exp()
+
+    return selected
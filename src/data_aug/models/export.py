@@ -0,0 +1,179 @@
+import os
+import copy
+import logging
+import operator
+from pathlib import Path
+import torch
+import torch.nn as nn
+from torch import fx
+from torch.fx.experimental.optimization import fuse as fuse_batchnorm
+
+from .resnet_fixup import FixupBasicBlock, FixupResNet
+from .sample_cache import sample_cache
+
+
+__all__ = [
+    'copy_model',
+    'export_inference',
+    'inference_graph',
+    'load_sample',
+]
+
+
+@torch.no_grad()
+def _fold_output_bias(layer, bias):
+    folded = bias.expand(layer.weight.size(0)).clone()
+    if layer.bias is not None:
+        folded += layer.bias
+    layer.bias = nn.Parameter(folded)
+    bias.zero_()
+
+
+@torch.no_grad()
+def _fold_fixup(net):
+    '''
+    Fold the scalar Fixup biases and scales that follow a layer into that
+    layer's weight and bias, in place. Biases in front of padded convolutions
+    (bias1a, bias2a) are not exactly foldable and stay.
+    '''
+    for m in net.modules():
+        if isinstance(m, FixupBasicBlock):
+            _fold_output_bias(m.conv1, m.bias1b)
+            m.conv2.weight.mul_(m.scale)
+            m.scale.fill_(1.)
+            _fold_output_bias(m.conv2, m.bias2b)
+        elif isinstance(m, FixupResNet):
+            _fold_output_bias(m.conv1, m.bias1)
+            ## fc(x + b) = fc(x) + b * W.sum(1).
+            m.fc.bias.add_(m.fc.weight.sum(dim=1) * m.bias2)
+            m.bias2.zero_()
+    return net
+
+
+def _drop_identity_ops(gm):
+    '''Remove x + 0 and x * 1 with constant attributes from the graph.'''
+    def const(arg):
+        if isinstance(arg, fx.Node) and arg.op == 'get_attr':
+            return operator.attrgetter(arg.target)(gm)
+        return None
+
+    identities = { operator.add: 0., torch.add: 0., operator.mul: 1., torch.mul: 1. }
+    for node in list(gm.graph.nodes):
+        if node.op != 'call_function' or node.target not in identities or len(node.args) != 2:
+            continue
+        x, c = node.args
+        value = const(c)
+        if value is None or not isinstance(x, fx.Node):
+            continue
+        if bool((value == identities[node.target]).all()):
+            node.replace_all_uses_with(x)
+            gm.graph.erase_node(node)
+
+    gm.graph.eliminate_dead_code()
+    gm.delete_all_unused_submodules()
+    gm.recompile()
+    return gm
+
+
+def copy_model(net):
+    '''
+    Deep copy of net, without the forwards replaced on net or its submodules
+    (by prepare_model, checkpoint_stages, ...), which stay bound to the
+    original modules.
+    '''
+    forwards = { m: m.__dict__.pop('forward') for m in net.modules() if 'forward' in m.__dict__ }
+    try:
+        return copy.deepcopy(net)
+    finally:
+        for m, forward in forwards.items():
+            m.__dict__['forward'] = forward
+
+
+def inference_graph(net, state_dict=None):
+    '''
+    Eval-mode torch.fx copy of net, with state_dict loaded if given: conv+BN
+    folded, Fixup scalars folded and the resulting identity ops dropped.
+    net is not modified.
+    '''
+    net = copy_model(net).eval()
+
+    if state_dict is not None:
+        net.load_state_dict(state_dict)
+
+    for m in net.modules():
+        ## The fused FRN+TLU autograd function is for training only.
+        if hasattr(m, 'fused'):
+            m.fused = False
+
+    _fold_fixup(net)
+    gm = fuse_batchnorm(fx.symbolic_trace(net), inplace=True, no_trace=True)
+    return _drop_identity_ops(gm).eval()
+
+
+def export_inference(net, state_dict=None):
+    '''
+    Inference-only copy of net (see inference_graph), scripted and frozen.
+
+    Eval-mode outputs match net up to float rounding. net is not modified.
+    '''
+    return torch.jit.freeze(torch.jit.script(inference_graph(net, state_dict=state_dict)))
+
+
+def _export_path(sample_path, device):
+    sample_path = Path(sample_path)
+    return sample_path.with_name(f'{sample_path.stem}.{device.type}.ts')
+
+
+def _load_state_dict(sample_path, device, cache=None):
+    if cache is None:
+        return torch.load(sample_path, map_location=device)
+    return cache.state_dict(sample_path, map_location=device)
+
+
+def _load_exported(net, sample_path, device):
+    path = _export_path(sample_path, device)
+    if path.is_file() and path.stat().st_mtime >= sample_path.stat().st_mtime:
+        return torch.jit.load(path, map_location=device)
+
+    ## Not through the sample cache, which holds the exported module instead.
+    state_dict = _load_state_dict(sample_path, device)
+    try:
+        exported = export_inference(net, state_dict=state_dict)
+    except Exception as e:
+        logging.warning(f'Could not export {sample_path}, evaluating eagerly: {e}')
+        return None
+
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    torch.jit.save(exported, tmp_path)
+    os.replace(tmp_path, path)
+
+    return exported
+
+
+def load_sample(net, sample_path, export=True, cache=True):
+    '''
+    The posterior sample at sample_path, ready for evaluation.
+
+    With export, this is the exported inference module, cached next to the
+    sample as <name>.<device type>.ts and rebuilt when the sample is newer.
+    Otherwise, or when export fails, the sample is loaded into a copy of net
+    (see copy_model). net itself is never modified.
+
+    cache is a SampleCache, True for the one shared in this process (see
+    sample_cache) or False. Exported modules are cached as such, other
+    samples as CPU state dicts. Cached exported modules are shared by all
+    callers.
+    '''
+    sample_path = Path(sample_path)
+    device = next(net.parameters()).device
+    cache = sample_cache() if cache is True else cache or None
+
+    if export:
+        build = lambda: _load_exported(net, sample_path, device)
+        exported = build() if cache is None else cache.module(sample_path, build, 'export', device)
+        if exported is not None:
+            return exported
+
+    model = copy_model(net)
+    model.load_state_dict(_load_state_dict(sample_path, device, cache=cache))
+    return model.eval()
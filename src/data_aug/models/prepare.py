@@ -0,0 +1,106 @@
+import os
+import logging
+import functools
+import torch
+import torch.nn as nn
+
+
+__all__ = [
+    'prepare_model',
+    'compile_fn',
+]
+
+
+def _set_cache_dir(cache_dir):
+    ## Inductor's FX graph and kernel caches live here, so later runs on the
+    ## host reuse the compiled artifacts instead of compiling again.
+    if cache_dir is not None:
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = str(cache_dir)
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+
+
+def _compile_errors():
+    ## Failures of the compiler itself, as opposed to errors raised by fn
+    ## (CUDA OOM, bad inputs, ...), which must propagate.
+    try:
+        from torch._dynamo import exc
+    except ImportError:
+        return ()
+    names = ['BackendCompilerFailed', 'Unsupported', 'InternalTorchDynamoError']
+    return tuple(getattr(exc, n) for n in names if hasattr(exc, n))
+
+
+def compile_fn(fn, cache_dir=None, name=None, **compile_kwargs):
+    '''
+    torch.compile fn, falling back to calling fn eagerly for good if
+    compilation is unsupported or fails on the first call. Any other error,
+    and any error on later calls, is raised as is.
+    '''
+    _set_cache_dir(cache_dir)
+    name = name or getattr(fn, '__qualname__', repr(fn))
+
+    try:
+        compiled = torch.compile(fn, **compile_kwargs)
+    except Exception as e:
+        logging.warning(f'torch.compile unavailable for {name}, running eagerly: {e}')
+        return fn
+
+    state = { 'compiled': compiled, 'first': True }
+    compile_errors = _compile_errors()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if state['compiled'] is None:
+            return fn(*args, **kwargs)
+        if not state['first']:
+            return state['compiled'](*args, **kwargs)
+        try:
+            out = state['compiled'](*args, **kwargs)
+        except compile_errors as e:
+            ## Compilation fails before fn runs, so calling it again does
+            ## not repeat side effects.
+            logging.warning(f'Compiling {name} failed, running eagerly: {e}')
+            state['compiled'] = None
+            return fn(*args, **kwargs)
+        state['first'] = False
+        return out
+
+    return wrapper
+
+
+def _has_conv(net):
+    return any(isinstance(m, nn.Conv2d) for m in net.modules())
+
+
+def prepare_model(net, channels_last=False, compile=False, cache_dir=None, **compile_kwargs):
+    '''
+    Prepare a model of the zoo for training or evaluation, in place.
+
+    channels_last converts conv models and their 4-D inputs to the
+    channels-last memory format. compile replaces net.forward by its
+    torch.compile'd version (see compile_fn), which leaves parameter names and
+    state_dict() untouched, so checkpoints and samples stay interchangeable
+    with eager models.
+    '''
+    forward = net.forward
+    wrapped = False
+
+    if channels_last and _has_conv(net):
+        net.to(memory_format=torch.channels_last)
+
+        def forward(x, *args, _forward=forward, **kwargs):
+            if x.dim() == 4:
+                x = x.contiguous(memory_format=torch.channels_last)
+            return _forward(x, *args, **kwargs)
+        wrapped = True
+
+    if compile:
+        forward = compile_fn(forward, cache_dir=cache_dir, name=type(net).__name__,
+                             **compile_kwargs)
+        wrapped = True
+
+    ## Not `forward is not net.forward`: each access is a new bound method.
+    if wrapped:
+        net.forward = forward
+
+    return net
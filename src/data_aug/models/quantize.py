@@ -0,0 +1,68 @@
+from pathlib import Path
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .export import inference_graph
+from .sample_cache import sample_cache
+
+
+__all__ = [
+    'calibration_batches',
+    'quantize_inference',
+    'quantize_sample',
+]
+
+
+def calibration_batches(dataset, n_samples=512, batch_size=128, seed=0):
+    '''A fixed random subset of the inputs in dataset, as a list of batches.'''
+    g = torch.Generator().manual_seed(seed)
+    idx = torch.randperm(len(dataset), generator=g)[:n_samples].tolist()
+    X = torch.stack([dataset[i][0] for i in idx])
+    return list(X.split(batch_size))
+
+
+@torch.no_grad()
+def quantize_inference(net, mode='static', calibration=None, state_dict=None, backend=None):
+    '''
+    Int8 CPU copy of net, with state_dict loaded if given, scripted and
+    frozen. net is not modified.
+
+    dynamic quantizes the weights of linear layers only, with activations
+    quantized on the fly. static quantizes convolutions and linear layers
+    (after BN folding, see inference_graph) with activation ranges observed
+    on calibration, a list of input batches. Ops without an int8 kernel, such
+    as FRN, run in fp32 in between.
+    '''
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+
+    gm = inference_graph(net, state_dict=state_dict).cpu()
+
+    if mode == 'dynamic':
+        qnet = quantize_dynamic(gm, {nn.Linear}, dtype=torch.qint8)
+    elif mode == 'static':
+        if not calibration:
+            raise ValueError('Static quantization needs calibration batches.')
+        qnet = prepare_fx(gm, get_default_qconfig_mapping(backend), (calibration[0].cpu(),))
+        for X in calibration:
+            qnet(X.cpu())
+        qnet = convert_fx(qnet)
+    else:
+        raise NotImplementedError(mode)
+
+    return torch.jit.freeze(torch.jit.script(qnet.eval()))
+
+
+def quantize_sample(net, sample_path, mode='static', calibration=None, cache=True):
+    '''
+    The posterior sample at sample_path, quantized (see quantize_inference).
+    cache is as in load_sample.
+    '''
+    cache = sample_cache() if cache is True else cache or None
+    if cache is None:
+        state_dict = torch.load(Path(sample_path), map_location='cpu')
+    else:
+        state_dict = cache.state_dict(sample_path, map_location='cpu')
+    return quantize_inference(net, mode=mode, calibration=calibration, state_dict=state_dict)
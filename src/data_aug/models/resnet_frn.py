@@ -1,13 +1,14 @@
 import torch.nn as nn
 import torch.nn.functional as F
-from ..nn import FilterResponseNorm2d, TLU2d
+from ..nn import FilterResponseNorm2d, TLU2d, filter_response_norm_tlu
 
 
 class _BasicBlock(nn.Module):
     expansion = 1
 
-    def __init__(self, in_planes, planes, stride=1):
+    def __init__(self, in_planes, planes, stride=1, fused=True):
         super().__init__()
+        self.fused = fused
         self.conv1 = nn.Conv2d(
             in_planes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
         self.bn1 = FilterResponseNorm2d(planes)
@@ -26,6 +27,11 @@ class _BasicBlock(nn.Module):
             )
 
     def forward(self, x):
+        if self.fused:
+            out = filter_response_norm_tlu(self.conv1(x), self.bn1, self.tlu1)
+            return filter_response_norm_tlu(self.conv2(out), self.bn2, self.tlu2,
+                                            residual=self.shortcut(x))
+
         out = self.tlu1(self.bn1(self.conv1(x)))
         out = self.bn2(self.conv2(out))
         out += self.shortcut(x)
@@ -34,9 +40,10 @@ class _BasicBlock(nn.Module):
 
 
 class _ResNet(nn.Module):
-    def __init__(self, block, num_blocks, num_classes=10):
+    def __init__(self, block, num_blocks, num_classes=10, fused=True):
         super().__init__()
         self.in_planes = 64
+        self.fused = fused
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
                                stride=1, padding=1, bias=False)
@@ -55,12 +62,15 @@ class _ResNet(nn.Module):
         strides = [stride] + [1]*(num_blocks-1)
         layers = []
         for stride in strides:
-            layers.append(block(self.in_planes, planes, stride))
+            layers.append(block(self.in_planes, planes, stride, fused=self.fused))
             self.in_planes = planes * block.expansion
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        out = self.tlu1(self.bn1(self.conv1(x)))
+        if self.fused:
+            out = filter_response_norm_tlu(self.conv1(x), self.bn1, self.tlu1)
+        else:
+            out = self.tlu1(self.bn1(self.conv1(x)))
         out = self.layer1(out)
         out = self.layer2(out)
         out = self.layer3(out)
@@ -0,0 +1,158 @@
+import os
+import threading
+import collections
+from pathlib import Path
+import torch
+
+
+__all__ = [
+    'SampleCache',
+    'sample_cache',
+]
+
+
+class _FlatState:
+    '''
+    A state dict packed into one contiguous CPU buffer per dtype, with the
+    entries as views into it.
+    '''
+    def __init__(self, state_dict):
+        self.metadata = getattr(state_dict, '_metadata', None)
+        self.layout = []
+        self.others = {}
+
+        groups = collections.defaultdict(list)
+        for k, v in state_dict.items():
+            if isinstance(v, torch.Tensor):
+                group = v.dtype
+                offset = sum(t.numel() for t in groups[group])
+                self.layout.append((k, group, offset, v.shape))
+                groups[group].append(v.detach().cpu().reshape(-1))
+            else:
+                self.layout.append((k, None, None, None))
+                self.others[k] = v
+
+        self.buffers = { g: torch.cat(ts) for g, ts in groups.items() }
+
+    @property
+    def nbytes(self):
+        return sum(b.numel() * b.element_size() for b in self.buffers.values())
+
+    def state_dict(self, device='cpu'):
+        ## One copy per buffer to device, the entries are views of those.
+        buffers = { g: b.to(device) for g, b in self.buffers.items() }
+        state_dict = collections.OrderedDict()
+        for k, group, offset, shape in self.layout:
+            if group is None:
+                state_dict[k] = self.others[k]
+            else:
+                state_dict[k] = buffers[group][offset:offset + shape.numel()].view(shape)
+        if self.metadata is not None:
+            state_dict._metadata = self.metadata
+        return state_dict
+
+
+class SampleCache:
+    '''
+    LRU cache of posterior samples in memory, up to max_bytes in total.
+
+    state_dict() holds samples as deserialized state dicts, packed flat on
+    the CPU, so repeated evaluations of a sample bank skip torch.load and
+    copy each sample to the device in one transfer per dtype. module() holds
+    ready to run modules built from a sample (e.g. exported ones, see
+    load_sample), on their device and sized by their file. Entries
+    are keyed by the resolved path and modification time, so rewritten
+    samples are reloaded. Returned tensors and modules are shared between
+    callers and must not be modified.
+
+    stats counts hits, misses and evictions, and the bytes and entries held.
+    '''
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes': self.nbytes,
+            'entries': len(self._entries),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _key(self, kind, path, *extra):
+        path = Path(path).resolve()
+        return (kind, str(path), path.stat().st_mtime_ns, *extra)
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+        return None
+
+    def _put(self, key, value, nbytes):
+        with self._lock:
+            ## Older versions of the same file are never asked for again.
+            for k in [k for k in self._entries if k[:2] == key[:2] and k[2] != key[2]]:
+                self.nbytes -= self._entries.pop(k)[1]
+
+            if key in self._entries or nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, (_, n) = self._entries.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+
+    def state_dict(self, path, map_location='cpu'):
+        '''torch.load(path, map_location), from memory if cached.'''
+        key = self._key('state_dict', path)
+        flat = self._get(key)
+        if flat is None:
+            flat = _FlatState(torch.load(path, map_location='cpu'))
+            self._put(key, flat, flat.nbytes)
+        return flat.state_dict(map_location)
+
+    def module(self, path, build, *extra):
+        '''
+        build(), from memory if cached for path and extra (e.g. the device).
+        None, for a failed build, is returned but not cached.
+        '''
+        key = self._key('module', path, *map(str, extra))
+        module = self._get(key)
+        if module is None:
+            module = build()
+            if module is not None:
+                self._put(key, module, Path(path).stat().st_size)
+        return module
+
+
+_sample_cache = None
+
+
+def sample_cache():
+    '''
+    The cache shared by everything in this process that loads samples, with
+    a budget of $DATA_AUG_SAMPLE_CACHE_MB (default: 1024) MiB.
+    '''
+    global _sample_cache
+    if _sample_cache is None:
+        _sample_cache = SampleCache(max_bytes=int(os.environ.get('DATA_AUG_SAMPLE_CACHE_MB', 1024)) * 2**20)
+    return _sample_cache
@@ -0,0 +1,28 @@
+from .resnet import ResNet18
+from .resnet_frn import ResNet18 as ResNet18FRN
+from .resnet_fixup import ResNet18 as ResNet18Fixup
+from .lenet import LeNet
+from .mlp import MLP
+
+
+__all__ = [
+    'get_net',
+]
+
+
+def get_net(dirty_lik, num_classes):
+    '''
+    The network of the samples of a run, by its dirty_lik argument: True or
+    'std' (ResNet18 with BatchNorm), False or 'frn', 'fixup', 'lenet', 'mlp'.
+    '''
+    if dirty_lik is True or dirty_lik == 'std':
+        return ResNet18(num_classes=num_classes)
+    elif dirty_lik is False or dirty_lik == 'frn':
+        return ResNet18FRN(num_classes=num_classes)
+    elif dirty_lik == 'fixup':
+        return ResNet18Fixup(num_classes=num_classes)
+    elif dirty_lik == 'lenet':
+        return LeNet(num_classes=num_classes)
+    elif dirty_lik == 'mlp':
+        return MLP(num_classes=num_classes)
+    raise NotImplementedError
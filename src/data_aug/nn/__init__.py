@@ -4,4 +4,5 @@ from .energy_loss import GaussianPriorAugmentedCELoss,\
                          KLAugmentedNoisyDirichletLoss, \
                          CPriorAugmentedCELoss
 from .filter_response_norm import FilterResponseNorm1d, FilterResponseNorm2d, FilterResponseNorm3d,\
-                                  TLU1d, TLU2d, TLU3d
+                                  TLU1d, TLU2d, TLU3d, filter_response_norm_tlu
+from .ghost_batch_norm import ghost_batches
@@ -9,6 +9,7 @@ __all__ = [
     'TLU1d',
     'TLU2d',
     'TLU3d',
+    'filter_response_norm_tlu',
 ]
 
 
@@ -79,3 +80,71 @@ class FilterResponseNorm3d(_FilterResponseNorm):
     '''
     def __init__(self, num_features, **kwargs):
         super().__init__(num_features, [-3, -2, -1], **kwargs)
+
+
+class _FilterResponseNormTLU(torch.autograd.Function):
+    '''
+    max(gamma * x / sqrt(mean(x^2) + |eps|) + beta [+ residual], tau)
+
+    Only the input, the per-channel rsqrt and a boolean mask of the
+    non-thresholded outputs are saved; the normalized activations are
+    recomputed in backward.
+    '''
+    @staticmethod
+    def forward(ctx, inputs, gamma, beta, eps, tau, avg_dims, residual):
+        rs = ((inputs**2).mean(dim=avg_dims, keepdim=True) + eps.abs()).rsqrt()
+
+        out = torch.addcmul(beta, inputs * rs, gamma)
+        if residual is not None:
+            out += residual
+        mask = out > tau
+        out = torch.where(mask, out, tau)
+
+        ctx.avg_dims = avg_dims
+        ctx.has_residual = residual is not None
+        ctx.save_for_backward(inputs, rs, mask, gamma, eps, tau)
+
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        inputs, rs, mask, gamma, eps, tau = ctx.saved_tensors
+        avg_dims = ctx.avg_dims
+        reduce_dims = [0] + list(avg_dims)
+
+        grad_z = grad_out * mask
+        grad_tau = (grad_out - grad_z).sum(dim=reduce_dims, keepdim=True)
+        grad_beta = grad_z.sum(dim=reduce_dims, keepdim=True)
+        grad_gamma = (grad_z * inputs * rs).sum(dim=reduce_dims, keepdim=True)
+
+        grad_x_hat = grad_z * gamma
+        ## d rs / d x_j = -rs^3 x_j / N for N averaged elements.
+        dot = (grad_x_hat * inputs).mean(dim=avg_dims, keepdim=True)
+        grad_inputs = rs * grad_x_hat - rs**3 * dot * inputs
+
+        grad_eps = None
+        if ctx.needs_input_grad[3]:
+            n = inputs[(0,) * (inputs.dim() - len(avg_dims))].numel()
+            grad_eps = (-0.5 * n * rs**3 * dot).sum() * eps.sign()
+
+        grad_residual = grad_z if ctx.has_residual else None
+
+        return grad_inputs, grad_gamma, grad_beta, grad_eps, grad_tau, None, grad_residual
+
+
+def filter_response_norm_tlu(inputs, frn, tlu, residual=None):
+    '''
+    tlu(frn(inputs) [+ residual]) in one pass, with a memory-saving backward.
+
+    Takes the parameters of existing FilterResponseNorm and TLU modules, so
+    models keep their state_dict layout. Under torch.compile the plain
+    formulation is traced instead and left to the compiler to fuse.
+    '''
+    if torch.compiler.is_compiling():
+        out = frn(inputs)
+        if residual is not None:
+            out = out + residual
+        return tlu(out)
+
+    return _FilterResponseNormTLU.apply(inputs, frn.gamma, frn.beta, frn.eps, tlu.tau,
+                                        tuple(frn.avg_dims), residual)
@@ -0,0 +1,33 @@
+import contextlib
+import torch
+import torch.nn as nn
+
+
+__all__ = [
+    'ghost_batches',
+]
+
+
+def _ghost_forward(module, sizes, inputs):
+    return torch.cat([type(module).forward(module, x) for x in inputs.split(sizes)])
+
+
+@contextlib.contextmanager
+def ghost_batches(net, sizes):
+    '''
+    Within the context, training-mode BatchNorm layers of net normalize each
+    consecutive chunk of sizes (along the batch dimension) with its own
+    batch statistics and update their running statistics once per chunk, in
+    order. A forward on the concatenation of several batches then matches
+    separate forwards on each of them, while all other layers run once on
+    the whole batch.
+    '''
+    bns = [m for m in net.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+    for m in bns:
+        m.forward = lambda inputs, m=m: _ghost_forward(m, sizes, inputs)
+    try:
+        yield
+    finally:
+        for m in bns:
+            del m.forward
@@ -1 +1,4 @@
 from .sgld import SGLD
+from .compiled_step import CompiledSGLDStep
+from .subspace import TrajectoryCollector, Subspace, SubspaceModel
+from .swag import SWAGCollector, bn_update
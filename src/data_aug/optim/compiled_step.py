@@ -0,0 +1,90 @@
+import contextlib
+import functools
+import torch
+import torch._dynamo
+
+from ..models.prepare import compile_fn
+
+
+def _trace_autograd():
+  ## Lets dynamo trace torch.autograd.grad into the graph instead of breaking.
+  if hasattr(torch._dynamo.config, 'trace_autograd_ops'):
+    return torch._dynamo.config.patch(trace_autograd_ops=True)
+  return contextlib.nullcontext()
+
+
+class CompiledSGLDStep:
+  """A whole SGLD/SGHMC iteration as one torch.compile'd region.
+
+  Calling step(*batch, noise=...) evaluates energy_fn(*batch) (forward and
+  energy), takes its gradient and applies the same update as SGLD.step,
+  Langevin noise included. Parameters, momentum buffers and hyperparameters
+  are read from sgld, so eager and compiled steps can be mixed freely;
+  gradients are not stored in .grad.
+
+  There is one compiled function per noise phase (e.g. the optimization
+  and sampling phases of CosineLR). Learning rates are passed as tensors,
+  so schedules do not trigger recompilation. Random numbers come from the
+  eager generator (inductor's fallback_random), which is much faster on CPU
+  than generated RNG kernels. The noise has the distribution of SGLD.step's,
+  but not the same draws for a given seed.
+  """
+  def __init__(self, sgld, energy_fn, **compile_kwargs):
+    self.sgld = sgld
+    self.energy_fn = energy_fn
+
+    self._params = [p for group in sgld.param_groups for p in group['params']]
+    self._lrs = [torch.tensor(0., device=group['params'][0].device)
+                 for group in sgld.param_groups]
+
+    options = { 'fallback_random': True, **compile_kwargs.pop('options', {}) }
+    self._steps = {
+      noise: compile_fn(functools.partial(self._step, noise=noise),
+                        name=f'sgld_step(noise={noise})', options=options,
+                        **compile_kwargs)
+      for noise in [False, True]
+    }
+
+  def _update(self, lrs, grads, noise):
+    grads = iter(grads)
+    for group, lr in zip(self.sgld.param_groups, lrs):
+      weight_decay = group['weight_decay']
+      momentum = group['momentum']
+
+      for p in group['params']:
+        d_p = next(grads)
+        if d_p is None:
+          continue
+
+        if weight_decay != 0:
+          d_p = d_p.add(p, alpha=weight_decay)
+
+        if momentum != 0:
+          buf = self.sgld.state[p]['momentum_buffer']
+
+          buf.mul_(1 - momentum).sub_(lr * d_p)
+          if noise:
+            buf.add_(torch.randn_like(d_p) * (2 * lr * momentum * self.sgld.T).sqrt())
+
+          p.add_(buf)
+        else:
+          p.sub_(lr * d_p)
+
+          if noise:
+            p.add_(torch.randn_like(d_p) * (2 * lr * self.sgld.T).sqrt())
+
+  def _step(self, lrs, *batch, noise=True):
+    energy = self.energy_fn(*batch)
+    grads = torch.autograd.grad(energy, self._params, allow_unused=True)
+
+    with torch.no_grad():
+      self._update(lrs, grads, noise)
+
+    return energy.detach()
+
+  def __call__(self, *batch, noise=True):
+    for lr, group in zip(self._lrs, self.sgld.param_groups):
+      lr.fill_(group['lr'])
+
+    with _trace_autograd():
+      return self._steps[bool(noise)](self._lrs, *batch)
@@ -0,0 +1,151 @@
+import copy
+import collections
+import torch
+import torch.nn as nn
+from torch.func import functional_call
+
+
+def _flatten(params):
+  ## reshape, as channels-last weights cannot be viewed flat.
+  return torch.cat([p.detach().reshape(-1) for p in params])
+
+
+class TrajectoryCollector:
+  """Flattened parameter snapshots of a network during training.
+
+  Meant to be called once per epoch of an SGD run (see run_sgd in
+  experiments/train_lik.py). From the start-th call on, every freq-th call
+  stores a snapshot on the CPU, keeping the last max_snapshots.
+  """
+  def __init__(self, start=0, freq=1, max_snapshots=20):
+    self.start = start
+    self.freq = freq
+    self.snapshots = collections.deque(maxlen=max_snapshots)
+    self.n_calls = 0
+
+  @torch.no_grad()
+  def collect(self, net):
+    self.n_calls += 1
+    if self.n_calls > self.start and (self.n_calls - self.start) % self.freq == 0:
+      self.snapshots.append(_flatten(net.parameters()).cpu())
+
+
+class Subspace:
+  """Affine subspace shift + z @ basis of the parameters of a network.
+
+  basis has one row of the size of all parameters of the network per
+  dimension. Parameters are named and shaped as in the network it was built
+  from, and weights(z) returns them for functional_call.
+  """
+  def __init__(self, shift, basis, names, shapes):
+    self.shift = shift
+    self.basis = basis
+    self.names = list(names)
+    self.shapes = [torch.Size(s) for s in shapes]
+
+  @property
+  def dim(self):
+    return self.basis.size(0)
+
+  @staticmethod
+  def _layout(net):
+    names, params = zip(*net.named_parameters())
+    return names, [p.shape for p in params], _flatten(params)
+
+  @classmethod
+  def random(cls, net, dim, seed=0):
+    """Random unit directions around the current parameters of net."""
+    names, shapes, shift = cls._layout(net)
+    g = torch.Generator().manual_seed(seed)
+    basis = torch.randn(dim, shift.numel(), generator=g).to(shift)
+    basis /= basis.norm(dim=-1, keepdim=True)
+    return cls(shift, basis, names, shapes)
+
+  @classmethod
+  def pca(cls, net, snapshots, dim):
+    """Mean and top principal components of a trajectory of snapshots.
+
+    Components are scaled by their standard deviation along the trajectory,
+    so unit coordinates correspond to typical deviations.
+    """
+    if len(snapshots) < 2:
+      raise ValueError(f'A PCA subspace needs at least two snapshots, got {len(snapshots)}.')
+    names, shapes, _ = cls._layout(net)
+    W = torch.stack(list(snapshots))
+    shift = W.mean(dim=0)
+    _, S, Vh = torch.linalg.svd(W - shift, full_matrices=False)
+    dim = min(dim, W.size(0) - 1)
+    basis = Vh[:dim] * (S[:dim] / (W.size(0) - 1) ** .5).unsqueeze(-1)
+    return cls(shift, basis, names, shapes)
+
+  def to(self, device):
+    self.shift, self.basis = self.shift.to(device), self.basis.to(device)
+    return self
+
+  def weights(self, z):
+    flat = self.shift + z @ self.basis
+    sizes = [s.numel() for s in self.shapes]
+    return { name: w.view(shape) for name, w, shape in zip(self.names, flat.split(sizes), self.shapes) }
+
+  def state_dict(self):
+    return { 'shift': self.shift, 'basis': self.basis, 'names': self.names, 'shapes': [list(s) for s in self.shapes] }
+
+  @classmethod
+  def from_state_dict(cls, state_dict):
+    return cls(**state_dict)
+
+
+class SubspaceModel(nn.Module):
+  """net evaluated at the parameters given by the coordinates z in subspace.
+
+  z is the only parameter. Buffers of net (e.g. BatchNorm running
+  statistics) are used and updated as usual, and saved in state_dict()
+  next to z as net.<name>, so a sample is z plus the buffers of net.
+  """
+  def __init__(self, net, subspace, z=None):
+    super().__init__()
+
+    ## Not registered as a submodule: its parameters are a function of z.
+    object.__setattr__(self, 'net', net)
+    self.subspace = subspace
+    self.z = nn.Parameter(torch.zeros(subspace.dim, device=subspace.shift.device) if z is None else z)
+
+  def __deepcopy__(self, memo):
+    ## The subspace is fixed and can be large, so copies share it.
+    memo[id(self.subspace)] = self.subspace
+    model = type(self).__new__(type(self))
+    memo[id(self)] = model
+    ## net is no submodule, so copy_model does not see the forwards replaced
+    ## on it (e.g. by prepare_model), which stay bound to the original net.
+    forwards = { m: m.__dict__.pop('forward') for m in self.net.modules() if 'forward' in m.__dict__ }
+    try:
+      for k, v in self.__dict__.items():
+        model.__dict__[k] = copy.deepcopy(v, memo)
+    finally:
+      for m, forward in forwards.items():
+        m.__dict__['forward'] = forward
+    return model
+
+  def train(self, mode=True):
+    self.net.train(mode)
+    return super().train(mode)
+
+  def _save_to_state_dict(self, destination, prefix, keep_vars):
+    super()._save_to_state_dict(destination, prefix, keep_vars)
+    for name, b in self.net.named_buffers():
+      destination[f'{prefix}net.{name}'] = b if keep_vars else b.detach()
+
+  def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                            error_msgs):
+    with torch.no_grad():
+      for name, b in self.net.named_buffers():
+        key = f'{prefix}net.{name}'
+        if key in state_dict:
+          b.copy_(state_dict.pop(key))
+        elif strict:
+          missing_keys.append(key)
+    super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                  error_msgs)
+
+  def forward(self, *args, **kwargs):
+    return functional_call(self.net, self.subspace.weights(self.z), args, kwargs)
@@ -0,0 +1,118 @@
+import collections
+import torch
+import torch.nn as nn
+
+
+def _flatten(params):
+  ## reshape, as channels-last weights cannot be viewed flat.
+  return torch.cat([p.detach().reshape(-1) for p in params])
+
+
+class SWAGCollector:
+  """SWAG posterior of the parameters of a network along an SGD run.
+
+  Meant to be called once per epoch of an SGD run (see run_sgd in
+  experiments/train_lik.py). From the start-th call on, every freq-th call
+  updates the running first and second moments of the parameters and keeps
+  the deviation from the running mean, up to the last max_rank, all on the
+  CPU. Memory is (2 + max_rank) times the parameter count.
+
+  .. _SWAG\: A Simple Baseline for Bayesian Uncertainty in Deep Learning:
+        https://arxiv.org/abs/1902.02476
+  """
+  def __init__(self, start=0, freq=1, max_rank=20):
+    self.start = start
+    self.freq = freq
+    self.max_rank = max_rank
+
+    self.n_calls = 0
+    self.n_models = 0
+    self.mean = None
+    self.sq_mean = None
+    self.deviations = collections.deque(maxlen=max_rank)
+
+  @torch.no_grad()
+  def collect(self, net):
+    self.n_calls += 1
+    if self.n_calls <= self.start or (self.n_calls - self.start) % self.freq != 0:
+      return
+
+    w = _flatten(net.parameters()).cpu()
+    if self.mean is None:
+      self.mean, self.sq_mean = torch.zeros_like(w), torch.zeros_like(w)
+
+    self.n_models += 1
+    self.mean += (w - self.mean) / self.n_models
+    self.sq_mean += (w * w - self.sq_mean) / self.n_models
+    self.deviations.append(w - self.mean)
+
+  @torch.no_grad()
+  def sample(self, scale=.5, cov=True, generator=None):
+    """Flat parameters drawn from the SWAG Gaussian.
+
+    With cov, the covariance is half diagonal and half the low rank part
+    spanned by the deviations; scale multiplies the covariance.
+    """
+    if self.n_models == 0:
+      raise RuntimeError(f'No SWAG moments collected (start={self.start}, {self.n_calls} calls to collect).')
+    var = (self.sq_mean - self.mean ** 2).clamp(min=1e-30)
+    eps = torch.randn(self.mean.shape, generator=generator)
+    if not cov or len(self.deviations) < 2:
+      return self.mean + (scale * var).sqrt() * eps
+
+    D = torch.stack(list(self.deviations), dim=1)
+    z = torch.randn(D.size(1), generator=generator)
+    dw = var.sqrt() * eps / 2 ** .5 + D @ z / (2 * (D.size(1) - 1)) ** .5
+    return self.mean + scale ** .5 * dw
+
+  @torch.no_grad()
+  def sample_into(self, net, **kwargs):
+    """Draw parameters (see sample) and copy them into net, in place, so
+    parameters keep their memory format."""
+    w = self.sample(**kwargs)
+    offset = 0
+    for p in net.parameters():
+      p.copy_(w[offset:offset + p.numel()].view_as(p))
+      offset += p.numel()
+    return net
+
+  def state_dict(self):
+    return {
+      'n_models': self.n_models,
+      'mean': self.mean,
+      'sq_mean': self.sq_mean,
+      'deviations': list(self.deviations),
+    }
+
+  def load_state_dict(self, state_dict):
+    self.n_models = state_dict['n_models']
+    self.mean, self.sq_mean = state_dict['mean'], state_dict['sq_mean']
+    self.deviations = collections.deque(state_dict['deviations'], maxlen=self.max_rank)
+
+
+@torch.no_grad()
+def bn_update(net, data_loader, n_batches=None, device=None):
+  """Recompute BatchNorm running statistics of net as plain averages over
+  (the first n_batches of) data_loader. Without BatchNorm, this is a no-op.
+  """
+  bns = [m for m in net.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+  if not bns:
+    return net
+
+  momenta = [m.momentum for m in bns]
+  for m in bns:
+    m.reset_running_stats()
+    m.momentum = None
+
+  training = net.training
+  net.train()
+  for i, batch in enumerate(data_loader):
+    if n_batches is not None and i >= n_batches:
+      break
+    net(batch[0].to(device))
+  net.train(training)
+
+  for m, momentum in zip(bns, momenta):
+    m.momentum = momentum
+
+  return net
@@ -0,0 +1,194 @@
+"""Local HTTP inference server for the posterior predictive of a sample bank.
+
+MicroBatcher groups inputs submitted from any number of threads into one
+batch, waiting at most max_delay seconds after the first input of a batch
+(or until max_batch_size inputs are queued), runs all samples once per
+batch and hands every caller its own rows. make_server puts it behind a
+stdlib ThreadingHTTPServer:
+
+    POST /predict  {"inputs": [[...], ...]}  (a batch of inputs, nested lists)
+    -> {"probs": [[...]], "entropy": [...], "mutual_info": [...]}
+    GET  /stats    -> batcher counters
+
+See experiments/serve_ensemble.py and experiments/benchmark_serve.py.
+"""
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from .models.ensemble import predictive
+
+
+__all__ = [
+    "MicroBatcher",
+    "make_server",
+    "predictive_fn",
+]
+
+
+def predictive_fn(ensemble, device=None):
+    """Batch of inputs -> predictive mean, entropy and mutual information (on CPU)."""
+
+    @torch.no_grad()
+    def fn(X):
+        pred = predictive(ensemble(X.to(device)))
+        return {k: pred[k].cpu() for k in ["probs", "entropy", "mutual_info"]}
+
+    return fn
+
+
+class MicroBatcher:
+    """Dynamic micro-batching of calls to fn from many threads.
+
+    fn maps a batch [B, ...] to a dict of tensors with leading dimension B.
+    submit(X) queues a batch of inputs and returns a Future of fn's output
+    for those rows. A single worker thread runs fn, so fn need not be
+    thread safe. stats counts batches, inputs and the time spent in fn.
+
+    Batches hold at most max_batch_size inputs, unless a single submission
+    is larger. stop() finishes the inputs already submitted; submitting
+    after it raises RuntimeError.
+    """
+
+    def __init__(self, fn, max_batch_size=64, max_delay=5e-3):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self.stats = {"batches": 0, "inputs": 0, "compute": 0.0}
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = False
+        ## A request that did not fit into the previous batch.
+        self._next = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit(self, X):
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("MicroBatcher is stopped")
+            self._queue.put((X, future))
+        return future
+
+    def __call__(self, X):
+        return self.submit(X).result()
+
+    def _collect(self):
+        """Block for the first request, then gather more until the batch is
+        full or max_delay has passed since the first one arrived. Requests
+        already queued by then are taken along (up to max_batch_size), a
+        request that would overflow the batch starts the next one."""
+        first, self._next = self._next or self._queue.get(), None
+        if first is None:
+            return None, True
+        pending, size = [first], first[0].size(0)
+        deadline = time.perf_counter() + self.max_delay
+        while size < self.max_batch_size:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return pending, True
+            if size + item[0].size(0) > self.max_batch_size:
+                self._next = item
+                break
+            pending.append(item)
+            size += item[0].size(0)
+        return pending, False
+
+    def _run(self):
+        done = False
+        while not done:
+            pending, done = self._collect()
+            if not pending:
+                continue
+
+            start = time.perf_counter()
+            try:
+                out = self.fn(torch.cat([X for X, _ in pending]))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.stats["compute"] += time.perf_counter() - start
+            self.stats["batches"] += 1
+            self.stats["inputs"] += sum(X.size(0) for X, _ in pending)
+
+            offset = 0
+            for X, future in pending:
+                n = X.size(0)
+                future.set_result({k: v[offset : offset + n] for k, v in out.items()})
+                offset += n
+
+
+def make_server(batcher, input_shape, host="127.0.0.1", port=8000):
+    """ThreadingHTTPServer answering /predict through batcher. Inputs must
+    have input_shape (without the batch dimension). port=0 picks a free
+    port, see server.server_address."""
+    input_shape = tuple(input_shape)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            self._reply(200, batcher.stats)
+
+        def do_POST(self):
+            if self.path != "/predict":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                X = torch.tensor(body["inputs"], dtype=torch.float32)
+            except (KeyError, TypeError, ValueError) as e:
+                return self._reply(400, {"error": f"malformed request: {e}"})
+            if tuple(X.shape[1:]) != input_shape:
+                return self._reply(
+                    400,
+                    {"error": f"expected inputs of shape [B, {', '.join(map(str, input_shape))}]"},
+                )
+            try:
+                out = batcher(X)
+            except Exception as e:
+                return self._reply(500, {"error": repr(e)})
+            self._reply(200, {k: v.tolist() for k, v in out.items()})
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
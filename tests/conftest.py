@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+## As with PYTHONPATH="$(pwd)/src" (see README).
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
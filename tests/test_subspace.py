@@ -0,0 +1,25 @@
+import torch
+
+from data_aug.models import ResNet18FRN, prepare_model, load_sample
+from data_aug.optim import Subspace, SubspaceModel
+
+
+def test_load_subspace_sample_channels_last(tmp_path):
+  torch.manual_seed(0)
+  net = prepare_model(ResNet18FRN(num_classes=10), channels_last=True)
+  model = SubspaceModel(net, Subspace.random(net, dim=2)).eval()
+  X = torch.randn(4, 3, 32, 32)
+
+  with torch.no_grad():
+    at_zero = model(X)
+    model.z.fill_(50.)
+    at_z = model(X)
+    torch.save(model.state_dict(), tmp_path / 'sample.pt')
+    model.z.zero_()
+
+    sample = load_sample(model, tmp_path / 'sample.pt', export=False, cache=False)
+    out = sample(X)
+
+  assert not torch.allclose(at_z, at_zero)
+  assert torch.allclose(out, at_z, atol=1e-5)
+  assert model.z.abs().sum() == 0